@@ -1,21 +1,55 @@
 #!/usr/bin/env python3
 #-*- coding: utf-8 -*-
 
-from os import makedirs, urandom
-from os.path import dirname, join, abspath
-from sys import version_info
+from argparse import ArgumentParser
+from os import _exit, environ, kill, makedirs, remove, urandom
+from os.path import abspath, dirname, exists, join
+from signal import SIG_IGN, SIGINT, SIGTERM, signal
+from socket import (AF_INET, AF_INET6, SO_REUSEADDR, SOCK_STREAM, SOL_SOCKET,
+                    socket)
+from sys import platform, version_info
+from shutil import rmtree
+from threading import Thread
+from time import monotonic, sleep
+from typing import Union
+from traceback import print_exc
 
 from flask import Flask, render_template, request
 from waitress.server import create_server
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from backend.db import DBConnection, close_db, setup_db
+from backend.db import (DBConnection, close_db, pool, read_pool, setup_db,
+                        writer)
+from backend.hash_stores import (import_password_list, open_breach_store,
+                                 open_rank_store)
+from backend.metrics import Gauge
+from backend.range_cache import range_cache
+from backend.security import kdf_executor
+from backend.sessions import sessions
 from frontend.api import api
+from frontend.assets import assets, load_manifest
+from frontend.metrics import metrics, record_request, start_timer
+from frontend.responses import CompactJSONProvider, compress_response
 from frontend.ui import ui
 
-HOST = '0.0.0.0'
-PORT = '8080'
-THREADS = 10
+HOST = environ.get('ONEPASS_HOST', '0.0.0.0')
+PORT = environ.get('ONEPASS_PORT', '8080')
+THREADS = int(environ.get('ONEPASS_THREADS', 10))
+WORKERS = int(environ.get('ONEPASS_WORKERS', 1))
+METRICS_HOST = environ.get('ONEPASS_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = environ.get('ONEPASS_METRICS_PORT')
+TRUSTED_PROXIES = int(environ.get('ONEPASS_TRUSTED_PROXIES', 0))
 DB_FILENAME = 'db', 'Onepass.db'
+BREACH_STORE_FILENAME = 'db', 'pwned_passwords.bin'
+RANK_STORE_FILENAME = 'db', 'common_passwords.bin'
+RANGE_CACHE_FILENAME = 'db', 'pwned_ranges.db'
+COMMON_PASSWORDS_FILENAME = 'db', 'common_passwords.txt'
+SESSIONS_FILENAME = 'db', 'sessions.db'
+COMMON_PASSWORDS_POLL_INTERVAL = 10 # seconds
+COMMON_PASSWORDS_WAIT_TIMEOUT = 3600 # seconds
+COMMON_PASSWORDS_ATTEMPTS = 5
+COMMON_PASSWORDS_RETRY_DELAY = 60 # seconds, doubled after every attempt
+COMMON_PASSWORDS_URL = 'https://raw.githubusercontent.com/danielmiessler/SecLists/master/Passwords/Common-Credentials/10-million-password-list-top-1000000.txt'
 
 def _folder_path(*folders) -> str:
 	"""Turn filepaths relative to the project folder into absolute paths
@@ -25,9 +59,12 @@ def _folder_path(*folders) -> str:
 	"""
 	return join(dirname(abspath(__file__)), *folders)
 
-def _create_app() -> Flask:
+def _create_app(trusted_proxies: int = TRUSTED_PROXIES) -> Flask:
 	"""Create a Flask app instance
 
+	Args:
+		trusted_proxies (int, optional): The amount of reverse proxies in front of the server. The client address is then taken from the X-Forwarded-For header they set, so that rate limiting is per client instead of per proxy. Defaults to TRUSTED_PROXIES.
+
 	Returns:
 		Flask: The created app instance
 	"""	
@@ -38,8 +75,18 @@ def _create_app() -> Flask:
 		static_url_path='/static'
 	)
 	app.config['SECRET_KEY'] = urandom(32)
-	app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
-	app.config['JSON_SORT_KEYS'] = False
+	app.json = CompactJSONProvider(app)
+	if trusted_proxies:
+		app.wsgi_app = ProxyFix(
+			app.wsgi_app,
+			x_for=trusted_proxies,
+			x_proto=trusted_proxies
+		)
+	# after_request functions run in reverse order,
+	# so the recorded time includes compressing
+	app.before_request(start_timer)
+	app.after_request(record_request)
+	app.after_request(compress_response)
 
 	# Add error handlers
 	@app.errorhandler(404)
@@ -63,15 +110,297 @@ def _create_app() -> Flask:
 
 	app.register_blueprint(ui)
 	app.register_blueprint(api, url_prefix="/api")
+	app.register_blueprint(assets)
+	load_manifest()
 
 	# Setup closing database
 	app.teardown_appcontext(close_db)
 	
 	return app
 
-def Onepass() -> None:
+def _load_common_passwords() -> None:
+	"""Build the rank store of most used passwords if needed and start using it.
+	The list is read from the local file if it's there, otherwise it's
+	downloaded. An interrupted build continues where it left off on the next
+	attempt or start. Failed attempts are retried with increasing delays. A
+	rank store that can't be opened is removed, and so is the progress of a
+	build that failed for another reason than I/O, so that they're rebuilt.
+
+	Returns:
+		None
+	"""
+	rank_store_location = _folder_path(*RANK_STORE_FILENAME)
+	delay = COMMON_PASSWORDS_RETRY_DELAY
+	for attempt in range(1, COMMON_PASSWORDS_ATTEMPTS + 1):
+		try:
+			if not exists(rank_store_location):
+				local_list = _folder_path(*COMMON_PASSWORDS_FILENAME)
+				source = local_list if exists(local_list) else COMMON_PASSWORDS_URL
+				import_password_list(source, rank_store_location)
+			open_rank_store(rank_store_location)
+			return
+
+		except Exception as e:
+			print(f'Error: failed to load the list of most used passwords (attempt {attempt} of {COMMON_PASSWORDS_ATTEMPTS}): {e}')
+			if exists(rank_store_location):
+				try:
+					remove(rank_store_location)
+				except OSError:
+					pass
+			elif not isinstance(e, OSError):
+				rmtree(rank_store_location + '.parts', ignore_errors=True)
+
+		if attempt < COMMON_PASSWORDS_ATTEMPTS:
+			sleep(delay)
+			delay *= 2
+
+	print('Error: gave up loading the list of most used passwords')
+	return
+
+def _wait_for_common_passwords() -> None:
+	"""Start using the rank store of most used passwords once another worker
+	process has built it. Gives up after COMMON_PASSWORDS_WAIT_TIMEOUT.
+
+	Returns:
+		None
+	"""
+	rank_store_location = _folder_path(*RANK_STORE_FILENAME)
+	deadline = monotonic() + COMMON_PASSWORDS_WAIT_TIMEOUT
+	while monotonic() < deadline:
+		if exists(rank_store_location):
+			try:
+				open_rank_store(rank_store_location)
+				return
+			except Exception:
+				# being replaced by the worker that builds it
+				pass
+		sleep(COMMON_PASSWORDS_POLL_INTERVAL)
+
+	print('Error: gave up waiting for the list of most used passwords')
+	return
+
+def _listen(host: str, port: str, reuse_port: bool) -> socket:
+	"""Create the socket for the server to listen on
+
+	Args:
+		host (str): The host to bind to
+		port (str): The port to bind to
+		reuse_port (bool): Let other processes bind to the same port, so that the kernel divides the connections over them
+
+	Returns:
+		socket: The bound socket
+	"""
+	sock = socket(AF_INET6 if ':' in host else AF_INET, SOCK_STREAM)
+	sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+	if reuse_port:
+		from socket import SO_REUSEPORT
+		sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+	sock.bind((host, int(port)))
+	return sock
+
+def _serve_metrics(host: str, port: str, worker: Union[int, None]):
+	"""Serve the metrics on their own listener, in a thread
+
+	Args:
+		host (str): The host to bind to
+		port (str): The port to bind to
+		worker (Union[int, None]): The index of the worker process, added as label to the metrics, or None when there is only one process
+
+	Returns:
+		The waitress server of the metrics
+	"""
+	app = Flask(__name__)
+	app.config['METRICS_WORKER'] = worker
+	app.register_blueprint(metrics)
+	server = create_server(app, sockets=[_listen(host, port, False)], threads=1)
+	Thread(target=server.run, name='metrics', daemon=True).start()
+	return server
+
+def _serve(
+	app: Flask,
+	threads: int,
+	sock: socket,
+	build_rank_store: bool,
+	metrics_host: str = METRICS_HOST,
+	metrics_port: Union[str, None] = METRICS_PORT,
+	worker: Union[int, None] = None
+) -> None:
+	"""Run the server in this process until it's stopped
+
+	Args:
+		app (Flask): The app to serve
+		threads (int): The amount of threads that handle requests
+		sock (socket): The socket to listen on
+		build_rank_store (bool): Wether this process should build the rank store of most used passwords if needed, instead of waiting for another process to do so
+		metrics_host (str, optional): The host to serve the metrics on. Defaults to METRICS_HOST.
+		metrics_port (Union[str, None], optional): The port to serve the metrics on, or None to not serve them. Defaults to METRICS_PORT.
+		worker (Union[int, None], optional): The index of this worker process, or None when there is only one process. Defaults to None.
+
+	Returns:
+		None
+	"""
+	#use local breach store if it has been imported
+	breach_store_location = _folder_path(*BREACH_STORE_FILENAME)
+	if exists(breach_store_location):
+		open_breach_store(breach_store_location)
+	else:
+		range_cache.persist(_folder_path(*RANGE_CACHE_FILENAME))
+
+	#a database connection per thread that handles requests
+	pool.resize(threads)
+	read_pool.resize(threads)
+
+	#create waitress server	and run
+	server = create_server(app, sockets=[sock], threads=threads)
+	dispatcher = server.task_dispatcher
+	Gauge(
+		'onepass_waitress_queue_depth',
+		'Requests waiting for a free server thread',
+		lambda: len(dispatcher.queue)
+	)
+	Gauge(
+		'onepass_waitress_active_threads',
+		'Server threads handling a request',
+		lambda: dispatcher.active_count
+	)
+
+	metrics_server = None
+	if metrics_port is not None:
+		metrics_server = _serve_metrics(metrics_host, metrics_port, worker)
+
+	#load list of most used passwords while already accepting requests
+	Thread(
+		target=_load_common_passwords if build_rank_store else _wait_for_common_passwords,
+		name='common_passwords',
+		daemon=True
+	).start()
+
+	server.run()
+
+	if metrics_server is not None:
+		metrics_server.close()
+	sessions.stop()
+	writer.stop()
+	kdf_executor.stop()
+	pool.checkpoint()
+	pool.close()
+	read_pool.close()
+	return
+
+def _serve_workers(
+	app: Flask,
+	host: str,
+	port: str,
+	threads: int,
+	workers: int,
+	metrics_host: str = METRICS_HOST,
+	metrics_port: Union[str, None] = METRICS_PORT
+) -> None:
+	"""Fork worker processes that each run a server on the same port and
+	restart them if they die. Sessions are shared between the workers
+	through a SQLite database. Each worker serves it's metrics on it's own
+	port: the metrics port plus the index of the worker.
+
+	Args:
+		app (Flask): The app to serve
+		host (str): The host to bind to
+		port (str): The port to bind to
+		threads (int): The amount of threads per worker that handle requests
+		workers (int): The amount of worker processes
+		metrics_host (str, optional): The host to serve the metrics on. Defaults to METRICS_HOST.
+		metrics_port (Union[str, None], optional): The port to serve the metrics of the first worker on, or None to not serve them. Defaults to METRICS_PORT.
+
+	Returns:
+		None
+	"""
+	from os import fork, wait
+
+	# without SO_REUSEPORT, the workers share the socket of this process
+	try:
+		from socket import SO_REUSEPORT
+		shared_sock = None
+	except ImportError:
+		shared_sock = _listen(host, port, False)
+
+	children = {}
+	stopping = False
+
+	def start_worker(index: int) -> None:
+		pid = fork()
+		if pid:
+			children[pid] = index
+			return
+
+		# worker process
+		signal(SIGINT, _stop_worker)
+		signal(SIGTERM, _stop_worker)
+		try:
+			sessions.share(_folder_path(*SESSIONS_FILENAME))
+			sock = shared_sock or _listen(host, port, True)
+			_serve(
+				app, threads, sock, index == 0,
+				metrics_host,
+				None if metrics_port is None else str(int(metrics_port) + index),
+				index
+			)
+		except Exception:
+			print_exc()
+			_exit(1)
+		finally:
+			_exit(0)
+
+	def stop(signum, frame) -> None:
+		nonlocal stopping
+		stopping = True
+		for pid in children:
+			kill(pid, SIGTERM)
+		return
+
+	for index in range(workers):
+		start_worker(index)
+	signal(SIGINT, stop)
+	signal(SIGTERM, stop)
+
+	while children:
+		try:
+			pid, _ = wait()
+		except ChildProcessError:
+			break
+		index = children.pop(pid, None)
+		if index is not None and not stopping:
+			print(f'Worker {index} stopped unexpectedly; restarting it')
+			sleep(1)
+			start_worker(index)
+	return
+
+def _stop_worker(signum, frame) -> None:
+	"""Stop the server of a worker process when it's asked to. Both the
+	parent and the terminal can ask, so further requests are ignored.
+	"""
+	signal(SIGINT, SIG_IGN)
+	signal(SIGTERM, SIG_IGN)
+	raise SystemExit
+
+def Onepass(
+	host: str = HOST,
+	port: str = PORT,
+	threads: int = THREADS,
+	workers: int = WORKERS,
+	metrics_host: str = METRICS_HOST,
+	metrics_port: Union[str, None] = METRICS_PORT,
+	trusted_proxies: int = TRUSTED_PROXIES
+) -> None:
 	"""The main function of Onepass
 
+	Args:
+		host (str, optional): The host to bind to. Defaults to HOST.
+		port (str, optional): The port to bind to. Defaults to PORT.
+		threads (int, optional): The amount of threads per process that handle requests. Defaults to THREADS.
+		workers (int, optional): The amount of processes that serve requests. Defaults to WORKERS.
+		metrics_host (str, optional): The host to serve the metrics on. Defaults to METRICS_HOST.
+		metrics_port (Union[str, None], optional): The port to serve the metrics on, or None to not serve them. With multiple workers, worker n uses this port plus n. Defaults to METRICS_PORT.
+		trusted_proxies (int, optional): The amount of reverse proxies in front of the server whose X-Forwarded-For header is trusted. Defaults to TRUSTED_PROXIES.
+
 	Returns:
 		None
 	"""
@@ -80,20 +409,42 @@ def Onepass() -> None:
 		print('Error: the minimum python version required is python3.7 (currently ' + version_info.major + '.' + version_info.minor + '.' + version_info.micro + ')')
 
 	#register web server
-	app = _create_app()
+	app = _create_app(trusted_proxies)
 	with app.app_context():
 		db_location = _folder_path(*DB_FILENAME)
 		makedirs(dirname(db_location), exist_ok=True)
 		DBConnection.file = db_location
 		setup_db()
 
-	#create waitress server	and run
-	server = create_server(app, host=HOST, port=PORT, threads=THREADS)
-	print(f'Onepass running on http://{HOST}:{PORT}/')
-	server.run()
+	if workers > 1 and platform.startswith('win'):
+		print('Warning: multiple workers are not supported on this platform; using one')
+		workers = 1
+
+	print(f'Onepass running on http://{host}:{port}/')
+	if metrics_port is not None:
+		print(f'Metrics on http://{metrics_host}:{metrics_port}/metrics')
+	if workers > 1:
+		# the workers open their own database connections
+		pool.close()
+		read_pool.close()
+		_serve_workers(app, host, port, threads, workers, metrics_host, metrics_port)
+	else:
+		_serve(app, threads, _listen(host, port, False), True, metrics_host, metrics_port)
 
 	print('\nBye')
 	return
 
 if __name__ == "__main__":
-	Onepass()
+	parser = ArgumentParser(description='Run the Onepass server')
+	parser.add_argument('--host', default=HOST, help='The host to bind to; env: ONEPASS_HOST')
+	parser.add_argument('--port', default=PORT, help='The port to bind to; env: ONEPASS_PORT')
+	parser.add_argument('--threads', type=int, default=THREADS, help='The amount of threads per process that handle requests; env: ONEPASS_THREADS')
+	parser.add_argument('--workers', type=int, default=WORKERS, help='The amount of processes that serve requests, to use multiple CPU cores; env: ONEPASS_WORKERS')
+	parser.add_argument('--metrics-host', default=METRICS_HOST, help='The host to serve the metrics on; env: ONEPASS_METRICS_HOST')
+	parser.add_argument('--metrics-port', default=METRICS_PORT, help='The port to serve the metrics on; with multiple workers, worker n uses this port plus n. Not served if not given; env: ONEPASS_METRICS_PORT')
+	parser.add_argument('--trusted-proxies', type=int, default=TRUSTED_PROXIES, help='The amount of reverse proxies in front of the server; their X-Forwarded-For header is used as client address for rate limiting. Leave at 0 when clients connect directly, as the header can be forged; env: ONEPASS_TRUSTED_PROXIES')
+	args = parser.parse_args()
+	Onepass(
+		args.host, args.port, args.threads, max(args.workers, 1),
+		args.metrics_host, args.metrics_port, max(args.trusted_proxies, 0)
+	)
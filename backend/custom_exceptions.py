@@ -1,5 +1,15 @@
 #-*- coding: utf-8 -*-
 
+from math import ceil
+
+class ApiKeyInvalid(Exception):
+	"""No api key was given or there is no session with it"""
+	api_response = {'error': 'ApiKeyInvalid', 'result': {}, 'code': 401}
+
+class ApiKeyExpired(Exception):
+	"""The session of the api key has expired"""
+	api_response = {'error': 'ApiKeyExpired', 'result': {}, 'code': 401}
+
 class UsernameTaken(Exception):
 	"""The username is already taken"""
 	api_response = {'error': 'UsernameTaken', 'result': {}, 'code': 400}
@@ -20,6 +30,40 @@ class PasswordNotFound(Exception):
 	"""The password in the vault with the id can not be found"""
 	api_response = {'error': 'PasswordNotFound', 'result': {}, 'code': 404}
 
+class CursorInvalid(Exception):
+	"""The cursor given for paging is not valid"""
+	api_response = {'error': 'CursorInvalid', 'result': {}, 'code': 400}
+
+class ImportInvalid(Exception):
+	"""The file to import is not a valid CSV or JSON export"""
+	api_response = {'error': 'ImportInvalid', 'result': {}, 'code': 400}
+
+class DatabaseUnavailable(Exception):
+	"""The database write could not be done in time or the writer thread stopped"""
+	api_response = {'error': 'DatabaseUnavailable', 'result': {}, 'code': 503}
+
+class TooManyRequests(Exception):
+	"""Too many logins or registrations were attempted from the address or for the username"""
+	error = 'TooManyRequests'
+
+	def __init__(self, retry_after: float = 1):
+		self.retry_after = max(1, ceil(retry_after))
+		super().__init__(self.retry_after)
+
+	@property
+	def api_response(self):
+		return {
+			'error': self.error,
+			'result': {'retry_after': self.retry_after},
+			'code': 429,
+			'headers': {'Retry-After': str(self.retry_after)}
+		}
+
+class ServerBusy(TooManyRequests):
+	"""Too many logins or registrations are being processed at the moment,
+	or all database connections are in use"""
+	error = 'ServerBusy'
+
 class KeyNotFound(Exception):
 	"""A key was not found in the input that is required to be given"""	
 	def __init__(self, key: str=''):
@@ -29,3 +73,30 @@ class KeyNotFound(Exception):
 	@property
 	def api_response(self):
 		return {'error': 'KeyNotFound', 'result': {'key': self.key}, 'code': 400}
+
+class BatchTooLarge(Exception):
+	"""The batch has more operations than are allowed in one go"""
+	def __init__(self, max_operations: int):
+		self.max_operations = max_operations
+		super().__init__(self.max_operations)
+
+	@property
+	def api_response(self):
+		return {
+			'error': 'BatchTooLarge',
+			'result': {'max_operations': self.max_operations},
+			'code': 400
+		}
+
+class BatchOperationFailed(Exception):
+	"""One of the operations in a batch failed, so none of them were done"""
+	def __init__(self, index: int, error: Exception):
+		self.index = index
+		self.error = error
+		super().__init__(self.index, self.error)
+
+	@property
+	def api_response(self):
+		response = dict(self.error.api_response)
+		response['result'] = {**response['result'], 'index': self.index}
+		return response
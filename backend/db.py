@@ -1,39 +1,291 @@
 #-*- coding: utf-8 -*-
 
-from sqlite3 import Connection, Cursor, Row, connect
-from threading import current_thread
-from typing import Union
-from urllib import request
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from pathlib import Path
+from queue import Empty, Queue
+from sqlite3 import Connection, Cursor, Error, OperationalError, Row
+from threading import Condition, Event, Lock, Thread, current_thread
+from time import monotonic, perf_counter
+from typing import Any, Callable, List, Tuple, Union
 
 from flask import g
 
-__DATABASE_VERSION__ = 1
+from backend.custom_exceptions import DatabaseUnavailable, ServerBusy
+from backend.metrics import Histogram
 
-class Singleton(type):
-	_instances = {}
-	def __call__(cls, *args, **kwargs):
-		i = f'{cls}{current_thread()}'
-		if i not in cls._instances:
-			cls._instances[i] = super(Singleton, cls).__call__(*args, **kwargs)
-			
-		return cls._instances[i]
+__DATABASE_VERSION__ = 5
+
+POOL_SIZE = 10
+POOL_TIMEOUT = 20.0
+IDLE_TIMEOUT = 300.0
+CACHE_SIZE = -8_000 # KiB
+MMAP_SIZE = 67_108_864 # bytes
+WAL_AUTOCHECKPOINT = 1000 # pages
+JOURNAL_SIZE_LIMIT = 16_777_216 # bytes
+WRITE_BATCH_SIZE = 64
+WRITE_TIMEOUT = 30.0
+QUERY_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+query_seconds = Histogram(
+	'onepass_db_query_duration_seconds',
+	'Time to execute a database query (for SELECT, until the first row)',
+	('statement',)
+)
 
-class DBConnection(Connection, metaclass=Singleton):
+class DBConnection(Connection):
 	file = ''
 	
-	def __init__(self, timeout: float) -> None:
-		super().__init__(self.file, timeout=timeout)
-		super().cursor().execute("PRAGMA foreign_keys = ON;")
+	def __init__(self, timeout: float, read_only: bool = False) -> None:
+		self.read_only = read_only
+		if read_only:
+			super().__init__(
+				f'{Path(self.file).as_uri()}?mode=ro',
+				timeout=timeout,
+				check_same_thread=False,
+				uri=True
+			)
+		else:
+			super().__init__(self.file, timeout=timeout, check_same_thread=False)
+		super().cursor().executescript(f"""
+			PRAGMA foreign_keys = ON;
+			PRAGMA synchronous = NORMAL;
+			PRAGMA wal_autocheckpoint = {WAL_AUTOCHECKPOINT};
+			PRAGMA journal_size_limit = {JOURNAL_SIZE_LIMIT};
+			PRAGMA cache_size = {CACHE_SIZE};
+			PRAGMA mmap_size = {MMAP_SIZE};
+			PRAGMA temp_store = MEMORY;
+			PRAGMA query_only = {'ON' if read_only else 'OFF'};
+		""")
+		return
+
+	def healthy(self) -> bool:
+		"""Check if the connection can still be used
+
+		Returns:
+			bool: Wether the connection works and has no open transaction
+		"""
+		try:
+			return (
+				not self.in_transaction
+				and self.execute("SELECT 1;").fetchone() is not None
+			)
+		except Error:
+			return False
+
+class ConnectionPool:
+	"""A bounded pool of database connections. Connections that have been idle
+	for longer than idle_timeout are closed, both when connections are
+	acquired or released and by a background pruner. When all connections
+	are checked out, acquiring waits until one is released. Size the pool to
+	the amount of threads that handle requests (see resize()).
+	"""
+	def __init__(
+		self,
+		read_only: bool = False,
+		max_size: int = POOL_SIZE,
+		idle_timeout: float = IDLE_TIMEOUT,
+		timeout: float = POOL_TIMEOUT
+	):
+		self.read_only = read_only
+		self.max_size = max_size
+		self.idle_timeout = idle_timeout
+		self.timeout = timeout
+		self._idle: List[Tuple[float, DBConnection]] = []
+		self._checked_out = 0
+		self._condition = Condition()
+		self._stop = Event()
+		self._thread: Union[Thread, None] = None
+		self.created = 0
+		self.closed = 0
+		self.waits = 0
+		self.wait_time = 0.0
+
+	def _prune(self, now: float) -> None:
+		"""Close connections that have been idle for too long. Requires the lock.
+
+		Args:
+			now (float): The current monotonic time
+		"""
+		while self._idle and self._idle[0][0] < now - self.idle_timeout:
+			self._idle.pop(0)[1].close()
+			self.closed += 1
+		return
+
+	def _start(self) -> None:
+		"""Start the pruner if it isn't running. Requires the lock.
+		"""
+		if self._thread is None or not self._thread.is_alive():
+			self._stop.clear()
+			self._thread = Thread(target=self._run, name='pool_pruner', daemon=True)
+			self._thread.start()
+		return
+
+	def _run(self) -> None:
+		"""Close idle connections every idle_timeout seconds, so that they're
+		also closed when no requests come in
+		"""
+		while not self._stop.wait(self.idle_timeout):
+			with self._condition:
+				self._prune(monotonic())
+		return
+
+	def resize(self, max_size: int) -> None:
+		"""Change the maximum amount of connections
+
+		Args:
+			max_size (int): The new maximum
+		"""
+		with self._condition:
+			self.max_size = max_size
+			self._condition.notify_all()
+		return
+
+	def acquire(self) -> DBConnection:
+		"""Check out a connection
+
+		Raises:
+			ServerBusy: No connection was released in time
+
+		Returns:
+			DBConnection: The connection
+		"""
+		with self._condition:
+			self._start()
+			if not self._idle and self._checked_out >= self.max_size:
+				self.waits += 1
+				start = monotonic()
+				if not self._condition.wait_for(
+					lambda: self._idle or self._checked_out < self.max_size,
+					self.timeout
+				):
+					raise ServerBusy
+				self.wait_time += monotonic() - start
+
+			self._prune(monotonic())
+			self._checked_out += 1
+			while self._idle:
+				db = self._idle.pop()[1]
+				if db.healthy():
+					return db
+				db.close()
+				self.closed += 1
+
+		try:
+			db = DBConnection(timeout=self.timeout, read_only=self.read_only)
+		except Exception:
+			with self._condition:
+				self._checked_out -= 1
+				self._condition.notify()
+			raise
+		with self._condition:
+			self.created += 1
+		return db
+
+	def release(self, db: DBConnection) -> None:
+		"""Return a connection to the pool
+
+		Args:
+			db (DBConnection): The connection
+		"""
+		usable = True
+		try:
+			if db.in_transaction:
+				db.rollback()
+		except Error:
+			usable = False
+			db.close()
+
+		with self._condition:
+			self._checked_out -= 1
+			if usable:
+				self._idle.append((monotonic(), db))
+			else:
+				self.closed += 1
+			self._prune(monotonic())
+			self._condition.notify()
 		return
 
+	def close(self) -> None:
+		"""Close all idle connections and stop the pruner
+		"""
+		with self._condition:
+			self._stop.set()
+			thread, self._thread = self._thread, None
+			for _, db in self._idle:
+				db.close()
+			self.closed += len(self._idle)
+			self._idle = []
+		if thread is not None:
+			thread.join()
+		return
+
+	def stats(self) -> dict:
+		"""Get the statistics of the pool
+
+		Returns:
+			dict: The amount of connections checked out and idle, how many were created and closed, how often acquiring had to wait and the total time waited
+		"""
+		with self._condition:
+			return {
+				'checked_out': self._checked_out,
+				'idle': len(self._idle),
+				'created': self.created,
+				'closed': self.closed,
+				'waits': self.waits,
+				'wait_time': self.wait_time
+			}
+
+	def checkpoint(self) -> None:
+		"""Checkpoint the write-ahead log into the database and truncate it.
+		Between these, SQLite checkpoints automatically every WAL_AUTOCHECKPOINT pages.
+		"""
+		db = self.acquire()
+		try:
+			db.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+		finally:
+			self.release(db)
+		return
+
+pool = ConnectionPool()
+read_pool = ConnectionPool(read_only=True)
+
+def _statement_type(sql: str) -> str:
+	"""Get the type of an SQL statement, to label its timing with
+
+	Args:
+		sql (str): The SQL statement
+
+	Returns:
+		str: One of QUERY_STATEMENTS or 'OTHER'
+	"""
+	words = sql.split(None, 1)
+	statement = words[0].upper() if words else ''
+	return statement if statement in QUERY_STATEMENTS else 'OTHER'
+
 class Extended_Cursor(Cursor):
-	"""Extended version of the sqlite3 Cursor object. Adds the exists function.
+	"""Extended version of the sqlite3 Cursor object. Adds the exists function
+	and records how long queries take.
 
 	Args:
 		Cursor (_type_): The Cursor instance to use
 	"""	
 	def __init__(self, connection):
 		super().__init__(connection)
+
+	def execute(self, __sql: str, __parameters: Any = ()) -> "Extended_Cursor":
+		start = perf_counter()
+		try:
+			return super().execute(__sql, __parameters)
+		finally:
+			query_seconds.observe(perf_counter() - start, _statement_type(__sql))
+
+	def executemany(self, __sql: str, __parameters: Any) -> "Extended_Cursor":
+		start = perf_counter()
+		try:
+			return super().executemany(__sql, __parameters)
+		finally:
+			query_seconds.observe(perf_counter() - start, _statement_type(__sql))
 		
 	def exists(self, __sql: str, __parameters: Union[list, tuple]) -> bool:
 		"""Check if an entry exists in a database table
@@ -49,6 +301,8 @@ class Extended_Cursor(Cursor):
 
 def get_db(output_type: Union[dict, tuple]=tuple) -> Extended_Cursor:
 	"""Get a database cursor instance. Coupled to Flask's g.
+	If g.db_read_only is set, the cursor uses a read-only connection,
+	which never takes the write lock.
 
 	Args:
 		output_type (Union[dict, tuple], optional): The type of output: a tuple or dictionary with the row values. Defaults to tuple.
@@ -59,7 +313,10 @@ def get_db(output_type: Union[dict, tuple]=tuple) -> Extended_Cursor:
 	try:
 		cursor = g.cursor
 	except AttributeError:
-		db = DBConnection(timeout=20.0)
+		if g.get('db_read_only', False):
+			db = read_pool.acquire()
+		else:
+			db = pool.acquire()
 		cursor = g.cursor = Extended_Cursor(db)
 		
 	if output_type is dict:
@@ -69,25 +326,334 @@ def get_db(output_type: Union[dict, tuple]=tuple) -> Extended_Cursor:
 	return g.cursor
 
 def close_db(e=None) -> None:
-	"""Savely closes the database connection
+	"""Savely commits and returns the database connection to the pool
 	"""	
 	try:
 		cursor = g.cursor
 		db = cursor.connection
 		cursor.close()
 		delattr(g, 'cursor')
-		db.commit()
 	except AttributeError:
-		pass
+		return
+
+	try:
+		db.commit()
+	finally:
+		if db.read_only:
+			read_pool.release(db)
+		else:
+			pool.release(db)
 	return
 
+class WriteQueue:
+	"""Runs database writes on one dedicated writer thread. Writes that are
+	queued while a transaction is being committed are grouped into the next
+	transaction (group commit). Each write runs in it's own savepoint, so a
+	write that fails doesn't affect the others in the transaction.
+	"""
+	def __init__(self, max_batch: int = WRITE_BATCH_SIZE):
+		self.max_batch = max_batch
+		self.batches = 0
+		self.writes = 0
+		self._queue: Queue = Queue()
+		self._thread: Union[Thread, None] = None
+		self._lock = Lock()
+
+	def _start(self, job: Tuple[Callable[[Extended_Cursor], Any], Future]) -> None:
+		"""Queue a write and start the writer thread if it isn't running.
+		Writes that were left in the queue by a writer thread that stopped
+		are failed first.
+
+		Args:
+			job (Tuple[Callable[[Extended_Cursor], Any], Future]): The write and it's future
+		"""
+		with self._lock:
+			running = self._thread is not None and self._thread.is_alive()
+			if not running:
+				self._fail_queued(DatabaseUnavailable())
+			self._queue.put(job)
+			if not running:
+				self._thread = Thread(target=self._run, name='writer', daemon=True)
+				self._thread.start()
+		return
+
+	def _fail_queued(self, exception: Exception) -> None:
+		"""Fail the writes that are waiting in the queue
+
+		Args:
+			exception (Exception): The exception to fail them with
+		"""
+		while True:
+			try:
+				job = self._queue.get_nowait()
+			except Empty:
+				break
+			if job is not None and job[1].set_running_or_notify_cancel():
+				job[1].set_exception(exception)
+		return
+
+	def execute(
+		self,
+		operation: Callable[[Extended_Cursor], Any],
+		timeout: Union[float, None] = WRITE_TIMEOUT
+	) -> Any:
+		"""Run a write on the writer thread and wait until it's committed
+
+		Args:
+			operation (Callable[[Extended_Cursor], Any]): The function that does the write using the given cursor
+			timeout (Union[float, None], optional): The seconds to wait for the commit, or None to wait for as long as it takes. Defaults to WRITE_TIMEOUT.
+
+		Raises:
+			DatabaseUnavailable: The write didn't start in time and is cancelled. A write that has started is always waited for, so that the caller can update its caches when it's committed.
+			ServerBusy: The database was locked by another process for too long
+			Exception: Any exception raised by the operation or the commit
+
+		Returns:
+			Any: The return value of the operation
+		"""
+		future = Future()
+		self._start((operation, future))
+		try:
+			return future.result(timeout=timeout)
+		except FutureTimeoutError:
+			if future.cancel():
+				raise DatabaseUnavailable
+		return future.result()
+
+	def depth(self) -> int:
+		"""Get the amount of writes waiting to be run
+
+		Returns:
+			int: The amount of queued writes
+		"""
+		return self._queue.qsize()
+
+	def stop(self) -> None:
+		"""Run the queued writes and stop the writer thread
+		"""
+		with self._lock:
+			thread = self._thread
+			if thread is not None and thread.is_alive():
+				self._queue.put(None)
+		# joined without the lock, as a failing writer thread takes it
+		if thread is not None:
+			thread.join()
+		with self._lock:
+			if self._thread is thread:
+				self._thread = None
+		return
+
+	def _run(self) -> None:
+		"""Take writes from the queue and run them in batches. When something
+		fails outside of a write, the writes in the batch and in the queue are
+		failed and the thread stops; the next write starts a new one.
+		"""
+		jobs = []
+		db = None
+		try:
+			db = DBConnection(timeout=POOL_TIMEOUT)
+			db.isolation_level = None
+			cursor = Extended_Cursor(db)
+			stopping = False
+			while not stopping:
+				jobs = [self._queue.get()]
+				while len(jobs) < self.max_batch:
+					try:
+						jobs.append(self._queue.get_nowait())
+					except Empty:
+						break
+				if None in jobs:
+					stopping = True
+				# skip writes that timed out while waiting
+				jobs = [
+					j for j in jobs
+					if j is not None and j[1].set_running_or_notify_cancel()
+				]
+				if not jobs:
+					continue
+
+				results = self._run_batch(db, cursor, jobs)
+				self.batches += 1
+				self.writes += len(jobs)
+				for future, result, exception in results:
+					if exception is None:
+						future.set_result(result)
+					else:
+						future.set_exception(exception)
+				jobs = []
+
+		except Exception as e:
+			with self._lock:
+				for _, future in jobs:
+					if not future.done():
+						future.set_exception(e)
+				self._fail_queued(e)
+				if self._thread is current_thread():
+					self._thread = None
+
+		finally:
+			if db is not None:
+				try:
+					db.close()
+				except Error:
+					pass
+		return
+
+	def _run_batch(
+		self,
+		db: DBConnection,
+		cursor: Extended_Cursor,
+		jobs: List[Tuple[Callable[[Extended_Cursor], Any], Future]]
+	) -> List[Tuple[Future, Any, Union[Exception, None]]]:
+		"""Run writes in one transaction, each in it's own savepoint
+
+		Args:
+			db (DBConnection): The connection of the writer thread
+			cursor (Extended_Cursor): The cursor of the connection
+			jobs (List[Tuple[Callable[[Extended_Cursor], Any], Future]]): The writes and their futures
+
+		Raises:
+			Exception: The transaction could not be rolled back
+
+		Returns:
+			List[Tuple[Future, Any, Union[Exception, None]]]: The future, result and exception of each write. When the database is locked by another process, the exception of all writes is ServerBusy.
+		"""
+		results = []
+		try:
+			cursor.execute("BEGIN IMMEDIATE;")
+			for operation, future in jobs:
+				cursor.row_factory = None
+				cursor.execute("SAVEPOINT write;")
+				try:
+					results.append((future, operation(cursor), None))
+					cursor.execute("RELEASE write;")
+				except Exception as e:
+					cursor.execute("ROLLBACK TO write;")
+					cursor.execute("RELEASE write;")
+					results.append((future, None, e))
+			cursor.execute("COMMIT;")
+
+		except Exception as e:
+			if db.in_transaction:
+				db.rollback()
+			if isinstance(e, OperationalError) and 'locked' in str(e):
+				e = ServerBusy()
+			results = [(future, None, e) for _, future in jobs]
+
+		return results
+
+writer = WriteQueue()
+
+def _migrate_to_v2(cursor: Extended_Cursor) -> None:
+	"""Move the list of most used passwords out of the database
+	"""
+	cursor.execute("DROP TABLE IF EXISTS most_used_passwords;")
+	return
+
+def _migrate_to_v3(cursor: Extended_Cursor) -> None:
+	"""Add an index on vault(user_id)
+
+	Because id is the rowid, the index is ordered on (user_id, id),
+	so it also serves the ordering on id within a vault.
+	"""
+	cursor.execute("CREATE INDEX IF NOT EXISTS vault_user_id ON vault(user_id);")
+	return
+
+def _migrate_to_v4(cursor: Extended_Cursor) -> None:
+	"""Store the key derivation function and its cost per user.
+	Existing accounts used pbkdf2_sha256 with 100.000 iterations.
+	"""
+	cursor.execute("""
+		ALTER TABLE users
+		ADD COLUMN kdf_algorithm VARCHAR(255) NOT NULL DEFAULT 'pbkdf2_sha256';
+	""")
+	cursor.execute("""
+		ALTER TABLE users
+		ADD COLUMN kdf_cost INTEGER NOT NULL DEFAULT 100000;
+	""")
+	return
+
+def _migrate_to_v5(cursor: Extended_Cursor) -> None:
+	"""Add a log of the changes to vaults, for syncing clients.
+	Entries from before the log are sent on a client's first sync.
+	"""
+	cursor.execute("""
+		CREATE TABLE IF NOT EXISTS vault_changes(
+			seq INTEGER PRIMARY KEY AUTOINCREMENT,
+			user_id INTEGER NOT NULL,
+			password_id INTEGER NOT NULL,
+			deleted BOOLEAN NOT NULL DEFAULT 0,
+			changed_at INTEGER NOT NULL,
+
+			UNIQUE (user_id, password_id),
+			FOREIGN KEY (user_id) REFERENCES users(id)
+		);
+	""")
+	cursor.execute("""
+		CREATE INDEX IF NOT EXISTS vault_changes_user_seq
+		ON vault_changes(user_id, seq);
+	""")
+	cursor.execute("""
+		CREATE INDEX IF NOT EXISTS vault_changes_tombstones
+		ON vault_changes(user_id, changed_at)
+		WHERE deleted = 1;
+	""")
+	cursor.execute("""
+		ALTER TABLE users
+		ADD COLUMN changes_floor INTEGER NOT NULL DEFAULT 0;
+	""")
+	return
+
+# The version each migration brings the database to, the migration
+# and wether the database should be vacuumed afterwards
+MIGRATIONS = (
+	(2, _migrate_to_v2, True),
+	(3, _migrate_to_v3, False),
+	(4, _migrate_to_v4, False),
+	(5, _migrate_to_v5, False)
+)
+
 def migrate_db(current_db_version: int) -> None:
 	"""
 	Migrate a Onepass database from it's current version
 	to the newest version suppoted by the Onepass version installed.
+	Each migration runs in it's own transaction together with the update
+	of the database version, so an interrupted migration can be rerun.
+
+	Args:
+		current_db_version (int): The version the database is currently at
 	"""
 	print('Migrating database to newer version...')
-	
+	cursor = get_db()
+	db = cursor.connection
+	db.commit()
+
+	vacuum = False
+	for version, migration, vacuum_after in MIGRATIONS:
+		if version <= current_db_version:
+			continue
+
+		description = migration.__doc__.strip().splitlines()[0]
+		print(f'\tVersion {version}: {description}')
+		start = perf_counter()
+		try:
+			cursor.execute("BEGIN;")
+			migration(cursor)
+			cursor.execute(
+				"UPDATE config SET value = ? WHERE key = 'database_version';",
+				(version,)
+			)
+			db.commit()
+		except Exception:
+			db.rollback()
+			raise
+		print(f'\tDone in {perf_counter() - start:.2f}s')
+		vacuum = vacuum or vacuum_after
+
+	if vacuum:
+		print('\tReclaiming free space...')
+		cursor.execute("VACUUM;")
+
 	return
 
 def setup_db() -> None:
@@ -95,12 +661,16 @@ def setup_db() -> None:
 	"""
 	cursor = get_db()
 
+	cursor.execute("PRAGMA journal_mode = WAL;")
 	cursor.executescript("""
 		CREATE TABLE IF NOT EXISTS users(
 			id INTEGER PRIMARY KEY,
 			username VARCHAR(255) UNIQUE NOT NULL,
 			salt VARCHAR(40) NOT NULL,
-			encrypted_key VARCHAR(255) NOT NULL
+			encrypted_key VARCHAR(255) NOT NULL,
+			kdf_algorithm VARCHAR(255) NOT NULL DEFAULT 'pbkdf2_sha256',
+			kdf_cost INTEGER NOT NULL DEFAULT 100000,
+			changes_floor INTEGER NOT NULL DEFAULT 0
 		);
 		CREATE TABLE IF NOT EXISTS vault(
 			id INTEGER PRIMARY KEY,
@@ -112,9 +682,22 @@ def setup_db() -> None:
 			
 			FOREIGN KEY (user_id) REFERENCES users(id)
 		);
-		CREATE TABLE IF NOT EXISTS most_used_passwords(
-			password VARCHAR(255) UNIQUE NOT NULL
+		CREATE INDEX IF NOT EXISTS vault_user_id ON vault(user_id);
+		CREATE TABLE IF NOT EXISTS vault_changes(
+			seq INTEGER PRIMARY KEY AUTOINCREMENT,
+			user_id INTEGER NOT NULL,
+			password_id INTEGER NOT NULL,
+			deleted BOOLEAN NOT NULL DEFAULT 0,
+			changed_at INTEGER NOT NULL,
+
+			UNIQUE (user_id, password_id),
+			FOREIGN KEY (user_id) REFERENCES users(id)
 		);
+		CREATE INDEX IF NOT EXISTS vault_changes_user_seq
+		ON vault_changes(user_id, seq);
+		CREATE INDEX IF NOT EXISTS vault_changes_tombstones
+		ON vault_changes(user_id, changed_at)
+		WHERE deleted = 1;
 		CREATE TABLE IF NOT EXISTS config(
 			key VARCHAR(255) PRIMARY KEY,
 			value TEXT NOT NULL
@@ -130,21 +713,5 @@ def setup_db() -> None:
 	current_db_version = int(cursor.execute("SELECT value FROM config WHERE key = 'database_version' LIMIT 1;").fetchone()[0])
 	if current_db_version < __DATABASE_VERSION__:
 		migrate_db(current_db_version)
-		cursor.execute(
-			"UPDATE config SET value = ? WHERE key = 'database_version' LIMIT 1;",
-			(__DATABASE_VERSION__,)
-		)
-	
-	cursor.execute("SELECT password FROM most_used_passwords LIMIT 1;")
-	if cursor.fetchone() is None:
-		cursor.executemany(
-			"INSERT OR IGNORE INTO most_used_passwords VALUES (?)",
-			map(
-				lambda p: (p,),
-				request.urlopen(
-					'https://raw.githubusercontent.com/danielmiessler/SecLists/master/Passwords/Common-Credentials/10-million-password-list-top-1000000.txt'
-				).read().decode().split('\n')
-			)
-		)
 
 	return
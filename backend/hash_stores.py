@@ -0,0 +1,519 @@
+#-*- coding: utf-8 -*-
+
+"""
+Compact, memory-mapped stores of sorted (hash, value) records.
+
+File layout:
+	header: magic (4 bytes), format version (1 byte), key size (1 byte),
+		padding (2 bytes), record count (8 bytes)
+	records: key (key size bytes) + value (4 bytes, big endian),
+		sorted on key
+
+Because the records have a fixed size and are sorted, a lookup is a binary
+search directly on the mapped file. Only the pages touched by the search are
+read in, so resident memory stays flat no matter how big the file is.
+"""
+
+from argparse import ArgumentParser
+from hashlib import sha1
+from heapq import merge
+from json import dump, load
+from mmap import ACCESS_READ, mmap
+from os import close, makedirs, remove, replace
+from os.path import abspath, dirname, join
+from shutil import rmtree
+from struct import Struct
+from tempfile import mkstemp
+from typing import BinaryIO, Iterable, Iterator, List, Tuple, Union
+from urllib import request
+
+HEADER = Struct('>4sBBxxQ')
+MAGIC = b'OPHS'
+FORMAT_VERSION = 1
+VALUE = Struct('>I')
+MAX_VALUE = 0xFFFFFFFF
+CHUNK_SIZE = 1_000_000
+# the list of most used passwords has about a million lines, so it's split
+# into chunks that are small enough to checkpoint the import regularly
+PASSWORD_LIST_CHUNK_SIZE = 50_000
+DOWNLOAD_TIMEOUT = 10.0 # seconds
+READ_BLOCK_SIZE = 4096
+
+def search_records(
+	buffer: Union[bytes, mmap],
+	offset: int,
+	count: int,
+	record_size: int,
+	key: bytes
+) -> Union[int, None]:
+	"""Binary search for a key in a buffer of sorted fixed-size records
+
+	Args:
+		buffer (Union[bytes, mmap]): The buffer holding the records
+		offset (int): The position in the buffer where the records start
+		count (int): The amount of records in the buffer
+		record_size (int): The size of one record (key + value)
+		key (bytes): The key to search for
+
+	Returns:
+		Union[int, None]: The value of the record or None if the key is not found
+	"""
+	key_size = len(key)
+	low, high = 0, count
+	while low < high:
+		middle = (low + high) // 2
+		start = offset + middle * record_size
+		current = buffer[start:start + key_size]
+		if current < key:
+			low = middle + 1
+		elif current > key:
+			high = middle
+		else:
+			return VALUE.unpack_from(buffer, start + key_size)[0]
+	return
+
+def _read_run(file: str, record_size: int) -> Iterator[bytes]:
+	"""Read the records of a sorted run file one by one
+
+	Args:
+		file (str): The filepath of the run
+		record_size (int): The size of one record
+
+	Yields:
+		bytes: A record
+	"""
+	with open(file, 'rb') as f:
+		while True:
+			block = f.read(record_size * READ_BLOCK_SIZE)
+			if not block:
+				return
+			for start in range(0, len(block) - record_size + 1, record_size):
+				yield block[start:start + record_size]
+
+def _write_run(records: List[bytes], file: str) -> None:
+	"""Sort records and write them to a run file.
+	The run file only appears once it has been written completely.
+
+	Args:
+		records (List[bytes]): The records to write
+		file (str): The filepath of the run file
+	"""
+	records.sort()
+	with open(file + '.tmp', 'wb') as f:
+		f.write(b''.join(records))
+	replace(file + '.tmp', file)
+	return
+
+def _temp_run_file(folder: str) -> str:
+	"""Reserve a filepath for a temporary run file
+
+	Args:
+		folder (str): The folder to create the run file in
+
+	Returns:
+		str: The filepath of the run file
+	"""
+	handle, file = mkstemp(suffix='.run', dir=folder)
+	close(handle)
+	return file
+
+def _merge_runs(runs: List[str], file: str, key_size: int) -> int:
+	"""Merge sorted run files into one hash file.
+	When a key occurs multiple times, the record with the lowest value is kept.
+
+	Args:
+		runs (List[str]): The filepaths of the runs
+		file (str): The filepath to write the hash file to
+		key_size (int): The size of the keys
+
+	Returns:
+		int: The amount of records in the hash file
+	"""
+	record_size = key_size + VALUE.size
+	count = 0
+	temp_file = file + '.tmp'
+	with open(temp_file, 'wb') as f:
+		f.write(HEADER.pack(MAGIC, FORMAT_VERSION, key_size, 0))
+		previous_key = None
+		for record in merge(*(_read_run(r, record_size) for r in runs)):
+			key = record[:key_size]
+			if key == previous_key:
+				continue
+			previous_key = key
+			f.write(record)
+			count += 1
+		f.seek(0)
+		f.write(HEADER.pack(MAGIC, FORMAT_VERSION, key_size, count))
+	replace(temp_file, file)
+	return count
+
+def _pack_record(key: bytes, value: int, key_size: int) -> bytes:
+	"""Turn a key and value into a record
+
+	Args:
+		key (bytes): The key
+		value (int): The value
+		key_size (int): The size the key should have
+
+	Raises:
+		ValueError: The key has the wrong size
+
+	Returns:
+		bytes: The record
+	"""
+	if len(key) != key_size:
+		raise ValueError(f'Key has size {len(key)} instead of {key_size}')
+	return key + VALUE.pack(min(value, MAX_VALUE))
+
+def build_hash_file(
+	records: Iterable[Tuple[bytes, int]],
+	file: str,
+	key_size: int,
+	chunk_size: int = CHUNK_SIZE
+) -> int:
+	"""Build a sorted hash file from unsorted records, using an external
+	sort so that memory usage is bound by chunk_size instead of the input size.
+	When a key occurs multiple times, the record with the lowest value is kept.
+
+	Args:
+		records (Iterable[Tuple[bytes, int]]): The keys and their values
+		file (str): The filepath to write the hash file to
+		key_size (int): The size of the keys
+		chunk_size (int, optional): The amount of records that is sorted in memory at once. Defaults to CHUNK_SIZE.
+
+	Raises:
+		ValueError: A key has the wrong size
+
+	Returns:
+		int: The amount of records in the hash file
+	"""
+	folder = dirname(abspath(file))
+	runs = []
+	try:
+		# split input in sorted runs
+		chunk = []
+		for key, value in records:
+			chunk.append(_pack_record(key, value, key_size))
+			if len(chunk) == chunk_size:
+				runs.append(_temp_run_file(folder))
+				_write_run(chunk, runs[-1])
+				chunk = []
+		if chunk:
+			runs.append(_temp_run_file(folder))
+			_write_run(chunk, runs[-1])
+		del chunk
+
+		return _merge_runs(runs, file, key_size)
+
+	finally:
+		for run in runs:
+			remove(run)
+
+class SortedHashFile:
+	"""A read-only, memory-mapped file of sorted (hash, value) records
+	"""
+	key_size = 20
+
+	def __init__(self, file: str):
+		"""Open a hash file
+
+		Args:
+			file (str): The filepath of the hash file
+
+		Raises:
+			ValueError: The file is not a valid hash file for this store
+		"""
+		self.file = file
+		with open(file, 'rb') as f:
+			self._map = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+		magic, version, key_size, count = HEADER.unpack_from(self._map, 0)
+		self.record_size = key_size + VALUE.size
+		if (magic != MAGIC
+		or version != FORMAT_VERSION
+		or key_size != self.key_size
+		or len(self._map) != HEADER.size + count * self.record_size):
+			self._map.close()
+			raise ValueError(f'{file} is not a valid hash file')
+		self.record_count = count
+
+	def get(self, key: bytes) -> Union[int, None]:
+		"""Get the value of a key
+
+		Args:
+			key (bytes): The key to look up
+
+		Returns:
+			Union[int, None]: The value or None if the key is not in the file
+		"""
+		return search_records(
+			self._map, HEADER.size, self.record_count, self.record_size, key
+		)
+
+	def close(self) -> None:
+		"""Unmap the file
+		"""
+		self._map.close()
+		return
+
+class BreachStore(SortedHashFile):
+	"""Local copy of the pwnedpasswords.com SHA-1 dump
+	"""
+	key_size = 20
+
+	def count(self, hash: str) -> int:
+		"""Get how many times a password has been seen in breaches
+
+		Args:
+			hash (str): The SHA-1 hex digest of the password
+
+		Returns:
+			int: The amount of times the password has been seen
+		"""
+		return self.get(bytes.fromhex(hash)) or 0
+
+def _parse_breach_dump(dump: str) -> Iterator[Tuple[bytes, int]]:
+	"""Parse a pwnedpasswords.com SHA-1 dump ("HASH:COUNT" per line)
+
+	Args:
+		dump (str): The filepath of the dump
+
+	Yields:
+		Tuple[bytes, int]: The hash and count
+	"""
+	with open(dump, 'r') as f:
+		for line in f:
+			hash, _, count = line.strip().partition(':')
+			if len(hash) != 40:
+				continue
+			yield bytes.fromhex(hash), int(count or 0)
+
+def import_breach_dump(dump: str, file: str) -> int:
+	"""Turn a pwnedpasswords.com SHA-1 dump into a breach store file
+
+	Args:
+		dump (str): The filepath of the dump
+		file (str): The filepath to write the breach store to
+
+	Returns:
+		int: The amount of hashes in the breach store
+	"""
+	return build_hash_file(
+		_parse_breach_dump(dump), file, BreachStore.key_size
+	)
+
+class RankStore(SortedHashFile):
+	"""The list of most used passwords, mapping each password to its place.
+	Keys are the first 8 bytes of the SHA-1 of the password, which keeps the
+	file compact while a false match stays astronomically unlikely.
+	"""
+	key_size = 8
+
+	def rank(self, password: str) -> Union[int, None]:
+		"""Get the place of a password in the list
+
+		Args:
+			password (str): The password to look up
+
+		Returns:
+			Union[int, None]: The place (1 based) or None if it's not in the list
+		"""
+		return self.get(_rank_key(password))
+
+def _rank_key(password: str) -> bytes:
+	"""Get the key of a password in a rank store
+
+	Args:
+		password (str): The password
+
+	Returns:
+		bytes: The key
+	"""
+	return sha1(password.encode()).digest()[:RankStore.key_size]
+
+def _open_password_list(source: str, offset: int) -> BinaryIO:
+	"""Open a list of passwords at a byte offset
+
+	Args:
+		source (str): The url or filepath of the list
+		offset (int): The byte offset to start reading at
+
+	Raises:
+		OSError: The list could not be opened, or the download stalled for DOWNLOAD_TIMEOUT seconds
+
+	Returns:
+		BinaryIO: The opened list, positioned at the offset
+	"""
+	if not source.startswith(('http://', 'https://')):
+		f = open(source, 'rb')
+		f.seek(offset)
+		return f
+
+	response = request.urlopen(
+		request.Request(
+			source,
+			headers={'Range': f'bytes={offset}-'} if offset else {}
+		),
+		timeout=DOWNLOAD_TIMEOUT
+	)
+	if offset and response.status != 206:
+		# server doesn't support ranges so skip to offset ourselves
+		while offset > 0:
+			skipped = len(response.read(min(offset, 1_048_576)))
+			if not skipped:
+				break
+			offset -= skipped
+	return response
+
+def _load_progress(folder: str, source: str) -> dict:
+	"""Load the progress of an interrupted import of a password list
+
+	Args:
+		folder (str): The work folder of the import
+		source (str): The url or filepath of the list that is imported
+
+	Returns:
+		dict: The source, byte offset, last place and amount of runs written
+	"""
+	try:
+		with open(join(folder, 'progress.json'), 'r') as f:
+			progress = load(f)
+		if progress['source'] == source:
+			return progress
+	except (OSError, ValueError, KeyError):
+		pass
+	return {'source': source, 'offset': 0, 'place': 0, 'runs': 0}
+
+def _save_progress(folder: str, progress: dict) -> None:
+	"""Save the progress of an import of a password list
+
+	Args:
+		folder (str): The work folder of the import
+		progress (dict): The progress, as returned by _load_progress
+	"""
+	file = join(folder, 'progress.json')
+	with open(file + '.tmp', 'w') as f:
+		dump(progress, f)
+	replace(file + '.tmp', file)
+	return
+
+def import_password_list(
+	source: str,
+	file: str,
+	chunk_size: int = PASSWORD_LIST_CHUNK_SIZE
+) -> int:
+	"""Turn a list of most used passwords (one per line, most used first)
+	into a rank store file. The list is streamed in chunks of chunk_size
+	passwords. Each chunk is sorted and saved together with the position in
+	the list, so an interrupted import continues where it left off.
+
+	Args:
+		source (str): The url or filepath of the list
+		file (str): The filepath to write the rank store to
+		chunk_size (int, optional): The amount of passwords per chunk. Defaults to PASSWORD_LIST_CHUNK_SIZE.
+
+	Returns:
+		int: The amount of passwords in the rank store
+	"""
+	folder = file + '.parts'
+	makedirs(folder, exist_ok=True)
+	progress = _load_progress(folder, source)
+
+	with _open_password_list(source, progress['offset']) as lines:
+		offset, place = progress['offset'], progress['place']
+		chunk = []
+		for line in lines:
+			offset += len(line)
+			password = line.rstrip(b'\r\n').decode('utf-8', 'replace')
+			if password:
+				place += 1
+				chunk.append(
+					_pack_record(_rank_key(password), place, RankStore.key_size)
+				)
+
+			if len(chunk) == chunk_size:
+				_write_run(chunk, join(folder, f'{progress["runs"]}.run'))
+				chunk = []
+				progress.update(offset=offset, place=place, runs=progress['runs'] + 1)
+				_save_progress(folder, progress)
+
+		if chunk:
+			_write_run(chunk, join(folder, f'{progress["runs"]}.run'))
+			progress.update(offset=offset, place=place, runs=progress['runs'] + 1)
+			_save_progress(folder, progress)
+		del chunk
+
+	count = _merge_runs(
+		[join(folder, f'{r}.run') for r in range(progress['runs'])],
+		file,
+		RankStore.key_size
+	)
+	rmtree(folder)
+	return count
+
+_breach_store: Union[BreachStore, None] = None
+_rank_store: Union[RankStore, None] = None
+
+def open_breach_store(file: str) -> None:
+	"""Use a breach store file for the pwned check
+
+	Args:
+		file (str): The filepath of the breach store
+	"""
+	global _breach_store
+	_breach_store = BreachStore(file)
+	return
+
+def get_breach_store() -> Union[BreachStore, None]:
+	"""Get the breach store that is in use
+
+	Returns:
+		Union[BreachStore, None]: The breach store or None if none is opened
+	"""
+	return _breach_store
+
+def open_rank_store(file: str) -> None:
+	"""Use a rank store file for the most used passwords check
+
+	Args:
+		file (str): The filepath of the rank store
+	"""
+	global _rank_store
+	_rank_store = RankStore(file)
+	return
+
+def get_rank_store() -> Union[RankStore, None]:
+	"""Get the rank store that is in use
+
+	Returns:
+		Union[RankStore, None]: The rank store or None if none is opened
+	"""
+	return _rank_store
+
+if __name__ == '__main__':
+	parser = ArgumentParser(
+		description='Build the hash stores used for checking passwords'
+	)
+	subparsers = parser.add_subparsers(dest='store', required=True)
+	breach_parser = subparsers.add_parser(
+		'breach',
+		help='Import a pwnedpasswords.com SHA-1 dump (ordered by hash or by count)'
+	)
+	breach_parser.add_argument('dump', help='The filepath of the dump')
+	breach_parser.add_argument(
+		'output', help='Where to write the store, e.g. db/pwned_passwords.bin'
+	)
+	rank_parser = subparsers.add_parser(
+		'common',
+		help='Import a list of most used passwords (one per line, most used first)'
+	)
+	rank_parser.add_argument('list', help='The url or filepath of the list')
+	rank_parser.add_argument(
+		'output', help='Where to write the store, e.g. db/common_passwords.bin'
+	)
+	args = parser.parse_args()
+
+	if args.store == 'breach':
+		print(f'Imported {import_breach_dump(args.dump, args.output):_} hashes')
+	elif args.store == 'common':
+		print(f'Imported {import_password_list(args.list, args.output):_} passwords')
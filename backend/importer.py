@@ -0,0 +1,330 @@
+#-*- coding: utf-8 -*-
+
+"""
+Streaming import of password manager exports.
+
+Supported are CSV exports with a header row (Bitwarden, Chrome, Firefox,
+LastPass, KeePass(XC), 1Password, ...) and JSON exports that are either
+a list of entries or an object with the entries under "items" (Bitwarden).
+Entries are parsed one at a time, so memory usage doesn't grow with the
+size of the export.
+"""
+
+from argparse import ArgumentParser
+from codecs import getreader
+from csv import DictReader, Error as CSVError
+from getpass import getpass
+from itertools import chain, islice
+from json import JSONDecodeError, JSONDecoder, dumps
+from os.path import abspath, dirname, join
+from typing import Any, BinaryIO, Iterator, Union
+
+from backend.custom_exceptions import ImportInvalid
+from backend.passwords import Vault
+
+READ_SIZE = 65_536
+FIELD_ALIASES = {
+	'title': ('title', 'name', 'account'),
+	'url': ('url', 'login_uri', 'website', 'web site', 'uri', 'login_url'),
+	'username': ('username', 'login_username', 'login name', 'login', 'user'),
+	'password': ('password', 'login_password')
+}
+JSON_ENTRY_KEYS = ('items', 'entries')
+# the characters that can follow a number or literal
+JSON_DELIMITERS = ',]} \t\r\n'
+
+def _to_entry(row: Any) -> Union[dict, None]:
+	"""Turn a parsed row or object of an export into a vault entry
+
+	Args:
+		row (Any): The row or object
+
+	Returns:
+		Union[dict, None]: The title, url, username and password of the entry or None if there's nothing to import
+	"""
+	if not isinstance(row, dict):
+		return
+
+	values = {
+		k.strip().lower(): v
+		for k, v in row.items()
+		if isinstance(k, str)
+	}
+	login = values.get('login')
+	if isinstance(login, dict):
+		# Bitwarden JSON nests the login info
+		values.update({
+			'login_' + k.lower(): v
+			for k, v in login.items()
+			if isinstance(k, str)
+		})
+		uris = login.get('uris')
+		if isinstance(uris, list) and uris and isinstance(uris[0], dict):
+			values['login_uri'] = uris[0].get('uri')
+
+	entry = {}
+	for field, aliases in FIELD_ALIASES.items():
+		entry[field] = next(
+			(
+				str(values[a])
+				for a in aliases
+				if isinstance(values.get(a), (str, int, float))
+				and values[a] != ''
+			),
+			None
+		)
+	entry['title'] = entry['title'] or entry['url'] or entry['username']
+	if entry['title'] is None:
+		return
+	return entry
+
+def parse_csv(stream: BinaryIO) -> Iterator[Union[dict, None]]:
+	"""Parse a CSV export
+
+	Args:
+		stream (BinaryIO): The export
+
+	Raises:
+		ImportInvalid: The export is not valid CSV
+
+	Yields:
+		Union[dict, None]: The entries, None for rows that can't be imported
+	"""
+	try:
+		for row in DictReader(getreader('utf-8-sig')(stream)):
+			yield _to_entry(row)
+	except (CSVError, UnicodeDecodeError):
+		raise ImportInvalid
+	return
+
+class _JsonStream:
+	"""Incremental reader of a JSON document
+	"""
+	def __init__(self, stream: BinaryIO):
+		self._reader = getreader('utf-8-sig')(stream)
+		self._decoder = JSONDecoder()
+		self._buffer = ''
+		self._position = 0
+		self._eof = False
+
+	def _fill(self) -> bool:
+		"""Read more of the document into the buffer
+
+		Returns:
+			bool: Wether anything was read
+		"""
+		try:
+			chunk = self._reader.read(READ_SIZE)
+		except UnicodeDecodeError:
+			raise ImportInvalid
+		if not chunk:
+			self._eof = True
+			return False
+		self._buffer = self._buffer[self._position:] + chunk
+		self._position = 0
+		return True
+
+	def peek(self) -> str:
+		"""Get the next character that is not whitespace, without consuming it
+
+		Returns:
+			str: The character or an empty string at the end of the document
+		"""
+		while True:
+			while (self._position < len(self._buffer)
+			and self._buffer[self._position].isspace()):
+				self._position += 1
+			if self._position < len(self._buffer) or not self._fill():
+				break
+		return self._buffer[self._position:self._position + 1]
+
+	def expect(self, character: str) -> None:
+		"""Consume the next character that is not whitespace
+
+		Args:
+			character (str): The character it should be
+
+		Raises:
+			ImportInvalid: It's another character
+		"""
+		if self.peek() != character:
+			raise ImportInvalid
+		self._position += 1
+		return
+
+	def value(self) -> Any:
+		"""Consume the next value
+
+		Raises:
+			ImportInvalid: The value is not valid JSON
+
+		Returns:
+			Any: The value
+		"""
+		# strings, arrays and objects end in a closing character, but a number
+		# or literal is only complete once the character after it is read
+		closed = self.peek() in ('"', '[', '{')
+		while True:
+			try:
+				value, end = self._decoder.raw_decode(self._buffer, self._position)
+				if (closed
+				or self._eof
+				or (end < len(self._buffer) and self._buffer[end] in JSON_DELIMITERS)):
+					self._position = end
+					return value
+			except JSONDecodeError:
+				if self._eof:
+					raise ImportInvalid
+			self._fill()
+
+	def end(self) -> None:
+		"""Check that nothing but whitespace follows
+
+		Raises:
+			ImportInvalid: There is more after the document
+		"""
+		if self.peek() != '':
+			raise ImportInvalid
+		return
+
+	def array(self) -> Iterator[Any]:
+		"""Consume an array value by value
+
+		Raises:
+			ImportInvalid: The array is not valid JSON
+
+		Yields:
+			Any: The values in the array
+		"""
+		self.expect('[')
+		if self.peek() == ']':
+			self._position += 1
+			return
+		while True:
+			yield self.value()
+			character = self.peek()
+			self._position += 1
+			if character == ']':
+				return
+			if character != ',':
+				raise ImportInvalid
+
+def parse_json(stream: BinaryIO) -> Iterator[Union[dict, None]]:
+	"""Parse a JSON export
+
+	Args:
+		stream (BinaryIO): The export
+
+	Raises:
+		ImportInvalid: The export is not valid JSON or has no entries
+
+	Yields:
+		Union[dict, None]: The entries, None for objects that can't be imported
+	"""
+	document = _JsonStream(stream)
+	if document.peek() == '[':
+		for row in document.array():
+			yield _to_entry(row)
+		document.end()
+		return
+
+	document.expect('{')
+	found = False
+	while True:
+		if document.peek() != '"':
+			raise ImportInvalid
+		key = document.value()
+		document.expect(':')
+		if key in JSON_ENTRY_KEYS and document.peek() == '[':
+			found = True
+			for row in document.array():
+				yield _to_entry(row)
+		else:
+			document.value()
+		if document.peek() != ',':
+			break
+		document.expect(',')
+	document.expect('}')
+	document.end()
+	if not found:
+		raise ImportInvalid
+	return
+
+def import_export(
+	vault: Vault,
+	stream: BinaryIO,
+	format: str
+) -> Iterator[dict]:
+	"""Import a password manager export into a vault. The first entry is
+	parsed right away, so that an export in the wrong format is rejected
+	before anything is imported.
+
+	Args:
+		vault (Vault): The vault to import into
+		stream (BinaryIO): The export
+		format (str): The format of the export: 'csv' or 'json'
+
+	Raises:
+		ImportInvalid: The export is not valid
+
+	Returns:
+		Iterator[dict]: The amount of imported and skipped entries after each batch. The last one has 'done' set.
+	"""
+	rows = parse_json(stream) if format == 'json' else parse_csv(stream)
+	first_rows = list(islice(rows, 1))
+	skipped = [0]
+
+	def entries() -> Iterator[dict]:
+		for row in chain(first_rows, rows):
+			if row is None:
+				skipped[0] += 1
+			else:
+				yield row
+
+	def progress() -> Iterator[dict]:
+		imported = 0
+		for imported in vault.add_many(entries()):
+			yield {'imported': imported, 'skipped': skipped[0]}
+		yield {'imported': imported, 'skipped': skipped[0], 'done': True}
+
+	return progress()
+
+if __name__ == '__main__':
+	from flask import Flask
+
+	from backend.custom_exceptions import AccessUnauthorized, UserNotFound
+	from backend.db import DBConnection, close_db, setup_db, writer
+	from backend.security import kdf_executor
+	from backend.users import User
+
+	parser = ArgumentParser(
+		prog='python3 -m backend.importer',
+		description='Import a CSV or JSON export of a password manager into a vault'
+	)
+	parser.add_argument('username', help='The user to import into')
+	parser.add_argument('file', help='The export; the extension (.csv or .json) determines the format')
+	parser.add_argument('--database', help='The database file; defaults to db/Onepass.db')
+	args = parser.parse_args()
+
+	DBConnection.file = abspath(args.database or join(
+		dirname(dirname(abspath(__file__))), 'db', 'Onepass.db'
+	))
+	format = 'json' if args.file.lower().endswith('.json') else 'csv'
+
+	app = Flask(__name__)
+	app.teardown_appcontext(close_db)
+	with app.app_context():
+		setup_db()
+	try:
+		with app.app_context():
+			user = User(args.username, getpass('Master password: '))
+			with open(args.file, 'rb') as stream:
+				for progress in import_export(user.vault, stream, format):
+					print(dumps(progress))
+	except (UserNotFound, AccessUnauthorized):
+		print('Error: username or master password incorrect')
+	except ImportInvalid:
+		print('Error: the file is not a valid ' + format.upper() + ' export')
+	finally:
+		writer.stop()
+		kdf_executor.stop()
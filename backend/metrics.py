@@ -0,0 +1,261 @@
+#-*- coding: utf-8 -*-
+
+"""
+Metrics in the Prometheus text format.
+
+Histograms and counters are updated where the work is done. Recording is a
+bisect and a few additions under a lock, so it can stay on in production.
+Gauges and the counters kept by the subsystems themselves (the stats()
+methods) are read when the metrics are collected. All values are of the
+process that serves the request; with multiple workers, each serves its own
+metrics, which are told apart by a worker label.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple, Union
+
+# seconds
+DEFAULT_BUCKETS = (
+	0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+	0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+_registry: List["_Metric"] = []
+_registry_lock = Lock()
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+	"""Format label values for the text format
+
+	Args:
+		names (Tuple[str, ...]): The names of the labels
+		values (Tuple[str, ...]): The values of the labels
+
+	Returns:
+		str: The labels between braces, or an empty string without labels
+	"""
+	if not names:
+		return ''
+	return '{' + ','.join(
+		'{}="{}"'.format(
+			name,
+			str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+		)
+		for name, value in zip(names, values)
+	) + '}'
+
+class _Metric:
+	"""Base of the metrics. Registers the metric on creation.
+	"""
+	type = 'untyped'
+
+	def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self._lock = Lock()
+		with _registry_lock:
+			_registry.append(self)
+
+	def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+		"""Get the current values
+
+		Returns:
+			List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]: The name suffix, label names, label values and value of each sample
+		"""
+		return []
+
+	def collect(self, labels: Union[Dict[str, str], None] = None) -> List[str]:
+		"""Get the metric in the text format
+
+		Args:
+			labels (Union[Dict[str, str], None], optional): Labels to add to every sample. Defaults to None.
+
+		Returns:
+			List[str]: The lines
+		"""
+		labels = labels or {}
+		extra_names, extra_values = tuple(labels.keys()), tuple(labels.values())
+		lines = [
+			f'# HELP {self.name} {self.documentation}',
+			f'# TYPE {self.name} {self.type}'
+		]
+		for suffix, names, values, value in self.samples():
+			lines.append(
+				f'{self.name}{suffix}'
+				f'{_format_labels(extra_names + names, extra_values + values)} '
+				f'{float(value)!r}'
+			)
+		return lines
+
+class Counter(_Metric):
+	"""A value that only goes up, per combination of label values
+	"""
+	type = 'counter'
+
+	def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+		super().__init__(name, documentation, labelnames)
+		self._values: Dict[Tuple[str, ...], float] = {}
+
+	def inc(self, *labels: str, amount: float = 1) -> None:
+		"""Increase the counter
+
+		Args:
+			labels (str): The values of the labels
+			amount (float, optional): The amount to increase with. Defaults to 1.
+		"""
+		with self._lock:
+			self._values[labels] = self._values.get(labels, 0) + amount
+		return
+
+	def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+		with self._lock:
+			return [
+				('_total', self.labelnames, labels, value)
+				for labels, value in self._values.items()
+			]
+
+class Histogram(_Metric):
+	"""The distribution of observed values (usually durations in seconds),
+	per combination of label values
+	"""
+	type = 'histogram'
+
+	def __init__(
+		self,
+		name: str,
+		documentation: str,
+		labelnames: Tuple[str, ...] = (),
+		buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+	):
+		super().__init__(name, documentation, labelnames)
+		self.buckets = tuple(sorted(buckets))
+		# per combination of label values: the count of each bucket
+		# (not cumulative) with one for +Inf, followed by the sum
+		self._series: Dict[Tuple[str, ...], list] = {}
+
+	def observe(self, value: float, *labels: str) -> None:
+		"""Record a value
+
+		Args:
+			value (float): The value
+			labels (str): The values of the labels
+		"""
+		index = bisect_left(self.buckets, value)
+		with self._lock:
+			series = self._series.get(labels)
+			if series is None:
+				series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+			series[index] += 1
+			series[-1] += value
+		return
+
+	def time(self, *labels: str) -> "_Timer":
+		"""Record the duration of a with-block
+
+		Args:
+			labels (str): The values of the labels
+
+		Returns:
+			_Timer: The context manager
+		"""
+		return _Timer(self, labels)
+
+	def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+		with self._lock:
+			series = [(labels, list(counts)) for labels, counts in self._series.items()]
+
+		samples = []
+		bucket_names = self.labelnames + ('le',)
+		bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+		for labels, counts in series:
+			cumulative = 0
+			for bound, count in zip(bounds, counts):
+				cumulative += count
+				samples.append(('_bucket', bucket_names, labels + (bound,), cumulative))
+			samples.append(('_count', self.labelnames, labels, cumulative))
+			samples.append(('_sum', self.labelnames, labels, counts[-1]))
+		return samples
+
+class _Timer:
+	"""Context manager that records how long the block took in a histogram
+	"""
+	__slots__ = ('histogram', 'labels', 'start')
+
+	def __init__(self, histogram: Histogram, labels: Tuple[str, ...]):
+		self.histogram = histogram
+		self.labels = labels
+
+	def __enter__(self) -> None:
+		self.start = perf_counter()
+		return
+
+	def __exit__(self, *args) -> None:
+		self.histogram.observe(perf_counter() - self.start, *self.labels)
+		return
+
+class Gauge(_Metric):
+	"""A value that is read when the metrics are collected
+	"""
+	def __init__(
+		self,
+		name: str,
+		documentation: str,
+		function: Callable[[], Union[float, Dict[Tuple[str, ...], float]]],
+		labelnames: Tuple[str, ...] = (),
+		type: str = 'gauge'
+	):
+		"""
+		Args:
+			name (str): The name of the metric
+			documentation (str): What the metric is
+			function (Callable[[], Union[float, Dict[Tuple[str, ...], float]]]): Gives the value, or the value per combination of label values
+			labelnames (Tuple[str, ...], optional): The names of the labels. Defaults to ().
+			type (str, optional): The type of metric: 'gauge', or 'counter' for totals that a subsystem counts itself. Defaults to 'gauge'.
+		"""
+		super().__init__(name, documentation, labelnames)
+		self.function = function
+		self.type = type
+
+	def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+		suffix = '_total' if self.type == 'counter' else ''
+		values = self.function()
+		if not isinstance(values, dict):
+			return [(suffix, (), (), values)]
+		return [
+			(suffix, self.labelnames, labels, value)
+			for labels, value in values.items()
+		]
+
+def unregister(metric: _Metric) -> None:
+	"""Stop collecting a metric
+
+	Args:
+		metric (_Metric): The metric
+	"""
+	with _registry_lock:
+		if metric in _registry:
+			_registry.remove(metric)
+	return
+
+def render(labels: Union[Dict[str, str], None] = None) -> str:
+	"""Get all metrics in the text format
+
+	Args:
+		labels (Union[Dict[str, str], None], optional): Labels to add to every sample, like the worker. Defaults to None.
+
+	Returns:
+		str: The metrics
+	"""
+	with _registry_lock:
+		metrics = list(_registry)
+
+	lines = []
+	for metric in metrics:
+		try:
+			lines.extend(metric.collect(labels))
+		except Exception:
+			# a subsystem that is stopped shouldn't break the other metrics
+			continue
+	return '\n'.join(lines) + '\n'
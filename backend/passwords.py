@@ -1,11 +1,31 @@
 # -*- coding: utf-8 -*-
 
+from base64 import urlsafe_b64encode
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ctypes import c_uint64
 from hashlib import sha1
-from typing import List, Literal, Union
-from urllib import request
+from itertools import islice
+from json import dumps, loads
+from multiprocessing import Lock as ProcessLock
+from multiprocessing.sharedctypes import RawArray
+from os import urandom
+from sqlite3 import Row
+from threading import Lock, RLock
+from time import perf_counter, time
+from typing import (Any, Dict, Iterable, Iterator, List, Literal, Tuple,
+                    Union)
 
-from backend.custom_exceptions import PasswordNotFound
-from backend.db import get_db
+from cryptography.fernet import InvalidToken
+
+from backend.custom_exceptions import (BatchOperationFailed, BatchTooLarge,
+                                       CursorInvalid, KeyNotFound,
+                                       PasswordNotFound)
+from backend.db import Extended_Cursor, get_db, read_pool, writer
+from backend.hash_stores import get_breach_store, get_rank_store
+from backend.metrics import Counter, Histogram
+from backend.range_cache import range_cache
+from backend.search_index import SearchIndex
 from backend.security import Crypt
 
 class _CheckPassword:
@@ -22,25 +42,32 @@ class _CheckPassword:
 		"""Run all checks on the password
 
 		Returns:
-			dict: The result of the checks
+			dict: The result of the checks. 'common_passwords_loaded' is False
+			while the list of most used passwords is still being loaded.
 		"""		
+		loaded = get_rank_store() is not None
 		for check in self._checks:
 			result = check()
 			if not result is None:
+				result["common_passwords_loaded"] = loaded
 				return result
 
-		return {"place": -1, "message": "No problems found with the password!"}
+		return {
+			"place": -1,
+			"message": "No problems found with the password!",
+			"common_passwords_loaded": loaded
+		}
 
 	def _in_top_million(self) -> Union[dict, None]:
 		"""Check if password is in top 1.000.000 passwords list
 		"""
-		result = get_db().execute(
-			"SELECT rowid FROM most_used_passwords WHERE password = ?",
-			(self.password,)
-		).fetchone()
+		rank_store = get_rank_store()
+		if rank_store is None:
+			return
 
-		if result is not None:
-			place_in_list = f"{result[0]:_}".replace("_", ".")
+		place = rank_store.rank(self.password)
+		if place is not None:
+			place_in_list = f"{place:_}".replace("_", ".")
 			return {
 				"place": place_in_list,
 				"message": f"Password is at place {place_in_list} of 1.000.000 in the list of most used passwords",
@@ -48,16 +75,23 @@ class _CheckPassword:
 		return
 		
 	def _pwned(self) -> Union[dict, None]:
-		"""Check if password has been pwned according to pwnedpasswords.com
+		"""Check if password has been pwned according to pwnedpasswords.com.
+		Uses the local breach store if one is opened, otherwise the (cached)
+		online api.
 		"""
 		hash = sha1(self.password.encode()).hexdigest().upper()
-		pwned_range = dict(
-			map(
-				lambda e: e.split(":"),
-				request.urlopen(f"https://api.pwnedpasswords.com/range/{hash[:5]}").read().decode().split("\r\n")
-			)
-		)
-		count = int(pwned_range.get(hash[5:], 0))
+		breach_store = get_breach_store()
+		source = 'api' if breach_store is None else 'store'
+		start = perf_counter()
+		try:
+			if breach_store is not None:
+				count = breach_store.count(hash)
+			else:
+				count = range_cache.count(hash)
+		except Exception:
+			breach_lookup_errors.inc(source)
+			raise
+		breach_lookup_seconds.observe(perf_counter() - start, source)
 		if count > 0:
 			place_in_list = f"{count:_}".replace("_", ".")
 			return {
@@ -66,16 +100,255 @@ class _CheckPassword:
 			}
 		return
 
+AUDIT_WORKERS = 8
+BATCH_ACTIONS = ('add', 'update', 'delete')
+# a batch runs in the transaction of the writer, which all writes share
+BATCH_MAX_SIZE = 500
+IMPORT_BATCH_SIZE = 500
+VERSION_SLOTS = 65_536
+EXPORT_FETCH_SIZE = 100
+CHANGES_PAGE_SIZE = 1000
+TOMBSTONE_RETENTION = 30 * 24 * 60 * 60 # seconds
+
+breach_lookup_seconds = Histogram(
+	'onepass_breach_lookup_duration_seconds',
+	'Time to look up how often a password has been breached, in the local store or (cached) online api',
+	('source',)
+)
+breach_lookup_errors = Counter(
+	'onepass_breach_lookup_errors',
+	'Breach lookups that failed',
+	('source',)
+)
+_audit_executor = ThreadPoolExecutor(
+	max_workers=AUDIT_WORKERS,
+	thread_name_prefix='audit'
+)
+
+def _check_group(passwords: List[Tuple[int, str]]) -> List[dict]:
+	"""Check passwords that share the same hash prefix.
+	The first check fetches the breach range, the others reuse it from the cache.
+
+	Args:
+		passwords (List[Tuple[int, str]]): The id and decrypted password of each entry
+
+	Returns:
+		List[dict]: The check results, with the id of the entry added
+	"""
+	results = []
+	for id, password in passwords:
+		try:
+			result = _CheckPassword(password).check_password()
+		except Exception:
+			# a failing check shouldn't stop the audit of the other entries
+			result = {"error": "CheckFailed"}
+		results.append({"id": id, **result})
+	return results
+
+def _check_groups(groups: Dict[str, List[Tuple[int, str]]]) -> Iterator[dict]:
+	"""Check groups of passwords concurrently on the audit workers
+
+	Args:
+		groups (Dict[str, List[Tuple[int, str]]]): The passwords grouped by hash prefix
+
+	Yields:
+		dict: The check result of an entry, as soon as it's done
+	"""
+	futures = [_audit_executor.submit(_check_group, g) for g in groups.values()]
+	try:
+		for future in as_completed(futures):
+			yield from future.result()
+	finally:
+		for future in futures:
+			future.cancel()
+	return
+
+# Kept in shared memory, so that the vault versions are the same in all
+# worker processes that are forked after import. Users share a slot when
+# their ids are VERSION_SLOTS apart, which only causes extra cache refills.
+_vault_versions = RawArray(c_uint64, VERSION_SLOTS)
+try:
+	_vault_versions_lock = ProcessLock()
+except (ImportError, OSError):
+	# no working process locks on this platform; only one process is used then
+	_vault_versions_lock = Lock()
+
+# The versions start over when the server is restarted, so the entity tags
+# of vaults also contain this value, which is picked once before forking
+_version_epoch = urandom(4).hex()
+
+def get_vault_version(user_id: int) -> int:
+	"""Get the version of the vault of a user. It changes on every mutation.
+
+	Args:
+		user_id (int): The id of the user
+
+	Returns:
+		int: The version of the vault
+	"""
+	return _vault_versions[user_id % VERSION_SLOTS]
+
+def bump_vault_version(user_id: int) -> Tuple[int, int]:
+	"""Mark the vault of a user as changed
+
+	Args:
+		user_id (int): The id of the user
+
+	Returns:
+		Tuple[int, int]: The version before (1) and after (2) the change
+	"""
+	slot = user_id % VERSION_SLOTS
+	with _vault_versions_lock:
+		old_version = _vault_versions[slot]
+		_vault_versions[slot] = old_version + 1
+	return old_version, old_version + 1
+
+def _log_changes(
+	cursor: Extended_Cursor,
+	user_id: int,
+	password_ids: Iterable[int],
+	deleted: bool = False
+) -> None:
+	"""Record in the change log that entries of a vault were added or updated,
+	or deleted. Only the latest change of each entry is kept, so the log grows
+	with the size of the vault and not with the amount of edits. Run it in
+	the transaction of the change.
+
+	Args:
+		cursor (Extended_Cursor): The cursor of the transaction
+		user_id (int): The id of the user
+		password_ids (Iterable[int]): The ids of the entries
+		deleted (bool, optional): Wether the entries were deleted. Defaults to False.
+	"""
+	now = int(time())
+	cursor.executemany("""
+		INSERT OR REPLACE INTO vault_changes(user_id, password_id, deleted, changed_at)
+		VALUES (?,?,?,?);
+	""", ((user_id, id, deleted, now) for id in password_ids))
+	if deleted:
+		_compact_changes(cursor, user_id, now)
+	return
+
+def _compact_changes(cursor: Extended_Cursor, user_id: int, now: int) -> None:
+	"""Remove the tombstones of entries that were deleted more than
+	TOMBSTONE_RETENTION ago from the change log. Clients that last synced
+	before the newest removed tombstone get the whole vault on their next sync.
+
+	Args:
+		cursor (Extended_Cursor): The cursor of the transaction
+		user_id (int): The id of the user
+		now (int): The current epoch time
+	"""
+	cutoff = now - TOMBSTONE_RETENTION
+	floor = cursor.execute("""
+		SELECT MAX(seq)
+		FROM vault_changes
+		WHERE user_id = ? AND deleted = 1 AND changed_at < ?;
+	""", (user_id, cutoff)).fetchone()[0]
+	if floor is None:
+		return
+
+	cursor.execute(
+		"DELETE FROM vault_changes WHERE user_id = ? AND deleted = 1 AND changed_at < ?;",
+		(user_id, cutoff)
+	)
+	cursor.execute(
+		"UPDATE users SET changes_floor = ? WHERE id = ?;",
+		(floor, user_id)
+	)
+	return
+
+def _title_key(entry: dict) -> Tuple[str, str, int]:
+	"""Get the key to sort a vault entry on title with
+
+	Args:
+		entry (dict): The decrypted vault entry
+
+	Returns:
+		Tuple[str, str, int]: The sort key
+	"""
+	return (entry["title"] or "", entry["username"] or "", entry["id"])
+
+def _encode_cursor(value: Any, key: bytes) -> str:
+	"""Turn the position in a listing into an opaque cursor. The position
+	can contain the title and username of an entry, so it's encrypted with
+	the key of the vault to keep them out of urls and logs.
+
+	Args:
+		value (Any): The json serializable position
+		key (bytes): The key of the vault
+
+	Returns:
+		str: The cursor
+	"""
+	return Crypt(key).encrypt(dumps(value)).decode()
+
+def _decode_cursor(cursor: str, key: bytes, title_key: bool = False) -> Union[int, tuple]:
+	"""Turn a cursor back into the position in a listing
+
+	Args:
+		cursor (str): The cursor
+		key (bytes): The key of the vault
+		title_key (bool, optional): Wether the position is a title sort key instead of an id or offset. Defaults to False.
+
+	Raises:
+		CursorInvalid: The cursor is malformed or not of this vault
+
+	Returns:
+		Union[int, tuple]: The position
+	"""
+	try:
+		value = loads(Crypt(key).decrypt(cursor.encode()))
+		if title_key:
+			value = tuple(value)
+			if len(value) != 3 or not isinstance(value[2], int):
+				raise ValueError
+		elif not isinstance(value, int):
+			raise ValueError
+	except (InvalidToken, ValueError, TypeError):
+		raise CursorInvalid
+	return value
+
+def _page(keys: list, after: Any, limit: int, reverse: bool) -> list:
+	"""Get the keys that come after a key in a sorted list
+
+	Args:
+		keys (list): The sorted keys
+		after (Any): The key to start after. None to start at the beginning.
+		limit (int): The maximum amount of keys to return
+		reverse (bool): Wether to walk the list backwards
+
+	Raises:
+		CursorInvalid: The key to start after can't be compared with the keys
+
+	Returns:
+		list: The keys
+	"""
+	try:
+		if reverse:
+			end = len(keys) if after is None else bisect_left(keys, after)
+			return keys[max(end - limit, 0):end][::-1]
+		start = 0 if after is None else bisect_right(keys, after)
+		return keys[start:start + limit]
+	except TypeError:
+		raise CursorInvalid
+
 class Password:
 	"""Represents a password in the vault of the user
 	"""	
-	def __init__(self, password_id: int, key: bytes):
+	def __init__(self, password_id: int, key: bytes, vault: "Vault" = None):
 		self.id = password_id
 		self.key = key
+		self.vault = vault
 
 		# check if pw exists
-		if not get_db().exists("SELECT id FROM vault WHERE id = ?", (self.id,)):
+		owner = get_db().execute(
+			"SELECT user_id FROM vault WHERE id = ?", (self.id,)
+		).fetchone()
+		# entries of other users are treated as not existing
+		if owner is None or (vault is not None and owner[0] != vault.user_id):
 			raise PasswordNotFound
+		self.user_id: int = owner[0]
 
 	def get(self, _raw: bool = False) -> dict:
 		"""Get all info about the password
@@ -139,40 +412,162 @@ class Password:
 		current_data.update(pw_data)
 
 		# update vault
-		get_db().execute(
-			"""
-			UPDATE vault
-			SET title=?, url=?, username=?, password=?
-			WHERE id = ?;
-		""", (
-			current_data["title"],
-			current_data["url"],
-			current_data["username"],
-			current_data["password"],
-			self.id
-		))
+		def update_password(cursor: Extended_Cursor) -> None:
+			cursor.execute("""
+				UPDATE vault
+				SET title=?, url=?, username=?, password=?
+				WHERE id = ?;
+			""", (
+				current_data["title"],
+				current_data["url"],
+				current_data["username"],
+				current_data["password"],
+				self.id
+			))
+			_log_changes(cursor, self.user_id, (self.id,))
+			return
 
-		return self.get()
+		writer.execute(update_password)
+
+		result = self.get()
+		if self.vault is not None:
+			self.vault._cache_changed(self.id, result)
+		return result
 
 	def delete(self) -> None:
 		"""Delete the password from the vault
 		"""		
-		get_db().execute("DELETE FROM vault WHERE id = ?", (self.id,))
+		def delete_password(cursor: Extended_Cursor) -> None:
+			cursor.execute("DELETE FROM vault WHERE id = ?", (self.id,))
+			_log_changes(cursor, self.user_id, (self.id,), deleted=True)
+			return
+
+		writer.execute(delete_password)
+		if self.vault is not None:
+			self.vault._cache_changed(self.id)
 		return
 
 class Vault:
-	"""Represents the vault of the user account
+	"""Represents the vault of the user account. The decrypted id, title, url
+	and username of the entries are cached, kept sorted and indexed for search
+	and updated in place on changes, so listing and searching don't need the
+	database or decryption.
 	"""	
-	sort_functions = {
-		'title': (lambda p: (p['title'], p['username']), False),
-		'title_reversed': (lambda p: (p['title'], p['username']), True),
-		'date_added': (lambda p: p['id'], False),
-		'date_added_reversed': (lambda p: p['id'], True)
+	sort_orders = {
+		'title': ('title', False),
+		'title_reversed': ('title', True),
+		'date_added': ('id', False),
+		'date_added_reversed': ('id', True)
 	}
 	
 	def __init__(self, user_id: int, key: bytes):
 		self.user_id = user_id
 		self.key = key
+		self._lock = RLock()
+		self._cache: Union[Dict[int, dict], None] = None
+		self._cache_version = -1
+		self._id_order: List[int] = []
+		self._title_order: List[Tuple[str, str, int]] = []
+		self._search_index = SearchIndex()
+
+	def _load_cache(self) -> None:
+		"""Fill the cache if it's empty or if the vault has been changed
+		outside of this instance (e.g. in another session). Requires the lock.
+		"""
+		version = get_vault_version(self.user_id)
+		if self._cache is not None and self._cache_version == version:
+			return
+
+		# fetch vault
+		passwords: list = get_db(dict).execute(
+			"SELECT id, title, url, username FROM vault WHERE user_id = ?",
+			(self.user_id,)
+		).fetchall()
+
+		# decrypt everything
+		c = Crypt(self.key)
+		self._cache = {}
+		for password in passwords:
+			self._cache[password["id"]] = c.decrypt(dict(password))
+
+		self._id_order = sorted(self._cache)
+		self._title_order = sorted(map(_title_key, self._cache.values()))
+		self._search_index = SearchIndex(self._cache.values())
+		self._cache_version = version
+		return
+
+	def _cache_put(self, entry: dict) -> None:
+		"""Add or replace an entry in the cache. Requires the lock.
+
+		Args:
+			entry (dict): The decrypted id, title, url and username of the entry
+		"""
+		self._cache_remove(entry["id"])
+		self._cache[entry["id"]] = entry
+		insort(self._id_order, entry["id"])
+		insort(self._title_order, _title_key(entry))
+		self._search_index.add(entry)
+		return
+
+	def _cache_remove(self, id: int) -> None:
+		"""Remove an entry from the cache if it's in it. Requires the lock.
+
+		Args:
+			id (int): The id of the entry
+		"""
+		entry = self._cache.pop(id, None)
+		if entry is None:
+			return
+		del self._id_order[bisect_left(self._id_order, id)]
+		del self._title_order[bisect_left(self._title_order, _title_key(entry))]
+		self._search_index.remove(id)
+		return
+
+	def etag(self) -> str:
+		"""Get the entity tag of the current version of the vault. Get it
+		before reading the vault, so that a change made in the meantime gives
+		a newer tag on the next request.
+
+		Returns:
+			str: The entity tag, without quotes
+		"""
+		return f'{_version_epoch}-{self.user_id}-{get_vault_version(self.user_id)}'
+
+	def _cache_invalidate(self) -> None:
+		"""Register a change to the vault that is too big to apply to the cache
+		in place, so that the cache is refilled on next use
+		"""
+		with self._lock:
+			bump_vault_version(self.user_id)
+			self._cache = None
+		return
+
+	def _cache_changed(self, id: int, entry: dict = None) -> None:
+		"""Register a change to the vault and update the cache in place
+
+		Args:
+			id (int): The id of the entry that changed
+			entry (dict, optional): The new decrypted info of the entry. Defaults to None, which means that the entry is deleted.
+		"""
+		id = int(id)
+		with self._lock:
+			old_version, new_version = bump_vault_version(self.user_id)
+			if self._cache is None or self._cache_version != old_version:
+				# cache was already outdated, so refill it on next use
+				self._cache = None
+				return
+
+			if entry is None:
+				self._cache_remove(id)
+			else:
+				self._cache_put({
+					"id": id,
+					"title": entry["title"],
+					"url": entry["url"],
+					"username": entry["username"]
+				})
+			self._cache_version = new_version
+		return
 
 	def fetchall(self, sort_by: Literal["title", "title_reversed", "date_added", "date_added_reversed"] = "title") -> List[dict]:
 		"""Get all passwords from the vault
@@ -183,47 +578,482 @@ class Vault:
 		Returns:
 			List[dict]: The id, title, url and username of each entry in the vault of the user account
 		"""		
-		sort_function = self.sort_functions.get(
+		order, reverse = self.sort_orders.get(
 			sort_by,
-			self.sort_functions['title']
+			self.sort_orders['title']
 		)
 
-		# fetch vault
-		passwords: list = get_db(dict).execute(
-			f"SELECT id, title, url, username FROM vault WHERE user_id = ?",
-			(self.user_id,)
+		with self._lock:
+			self._load_cache()
+			if order == 'id':
+				ids = self._id_order
+			else:
+				ids = [k[-1] for k in self._title_order]
+			if reverse:
+				ids = reversed(ids)
+			return [dict(self._cache[id]) for id in ids]
+
+	def _fetch_id_page(self, after: Union[int, None], limit: int, reverse: bool) -> List[dict]:
+		"""Get a page of the vault in order of id straight from the database,
+		only decrypting the entries on the page
+
+		Args:
+			after (Union[int, None]): The id to start after. None to start at the beginning.
+			limit (int): The maximum amount of entries
+			reverse (bool): Wether to go from newest to oldest
+
+		Returns:
+			List[dict]: The id, title, url and username of the entries
+		"""
+		if reverse:
+			comparison, direction = '<', 'DESC'
+		else:
+			comparison, direction = '>', 'ASC'
+		if after is None:
+			after = 9223372036854775807 if reverse else -1
+
+		passwords: list = get_db(dict).execute(f"""
+			SELECT id, title, url, username
+			FROM vault
+			WHERE user_id = ? AND id {comparison} ?
+			ORDER BY id {direction}
+			LIMIT ?;
+			""",
+			(self.user_id, after, limit)
 		).fetchall()
 
-		# decrypt everything
 		c = Crypt(self.key)
-		for i, password in enumerate(passwords):
-			passwords[i] = c.decrypt(dict(password))
+		return [c.decrypt(dict(password)) for password in passwords]
+
+	def fetchpage(
+		self,
+		sort_by: Literal["title", "title_reversed", "date_added", "date_added_reversed"],
+		limit: int,
+		cursor: Union[str, None] = None
+	) -> Tuple[List[dict], Union[str, None]]:
+		"""Get one page of the passwords in the vault. When sorting on date
+		added and the vault isn't cached yet, only the page is fetched and decrypted.
+
+		Args:
+			sort_by (Literal["title", "title_reversed", "date_added", "date_added_reversed"]): How to sort the result
+			limit (int): The maximum amount of passwords on the page
+			cursor (Union[str, None], optional): The cursor returned with the previous page. Defaults to None.
+
+		Raises:
+			CursorInvalid: The cursor is not valid
+
+		Returns:
+			Tuple[List[dict], Union[str, None]]: The passwords like self.fetchall (1) and the cursor of the next page or None if this is the last page (2)
+		"""
+		order, reverse = self.sort_orders.get(
+			sort_by,
+			self.sort_orders['title']
+		)
+		after = None
+		if cursor is not None:
+			after = _decode_cursor(cursor, self.key, title_key=order == 'title')
 
-		# sort result
-		passwords.sort(key=sort_function[0], reverse=sort_function[1])
+		with self._lock:
+			if order == 'id' and (
+				self._cache is None
+				or self._cache_version != get_vault_version(self.user_id)
+			):
+				page = self._fetch_id_page(after, limit + 1, reverse)
+			else:
+				self._load_cache()
+				if order == 'id':
+					ids = _page(self._id_order, after, limit + 1, reverse)
+				else:
+					ids = [
+						k[-1]
+						for k in _page(self._title_order, after, limit + 1, reverse)
+					]
+				page = [dict(self._cache[id]) for id in ids]
 
-		return passwords
+		next_cursor = None
+		if len(page) > limit:
+			page = page[:limit]
+			next_cursor = _encode_cursor(
+				page[-1]["id"] if order == 'id' else _title_key(page[-1]),
+				self.key
+			)
+		return page, next_cursor
 
-	def search(self, query: str) -> List[dict]:
-		"""Search for passwords in the vault
+	def search(self, query: str, limit: Union[int, None] = None) -> List[dict]:
+		"""Search for passwords in the vault. The query matches anywhere in the
+		title, username or url.
 
 		Args:
 			query (str): The term to search for
+			limit (Union[int, None], optional): The maximum amount of results. Defaults to None.
 
 		Returns:
-			List[dict]: All passwords that match. Similar output to self.fetchall
+			List[dict]: All passwords that match, best match first. Similar output to self.fetchall
 		"""		
-		query = query.lower()
-		passwords = self.fetchall()
-		passwords = list(filter(
-			lambda p: (
-				query in p["title"].lower()
-				or query in p["username"].lower()
-				or query in p["url"].lower()
-			),
-			passwords
-		))
-		return passwords
+		if not query.strip():
+			return self.fetchall()[:limit]
+
+		with self._lock:
+			self._load_cache()
+			return [
+				dict(self._cache[id])
+				for id in self._search_index.search(query, limit)
+			]
+
+	def searchpage(
+		self,
+		query: str,
+		limit: int,
+		cursor: Union[str, None] = None
+	) -> Tuple[List[dict], Union[str, None]]:
+		"""Get one page of the search results
+
+		Args:
+			query (str): The term to search for
+			limit (int): The maximum amount of passwords on the page
+			cursor (Union[str, None], optional): The cursor returned with the previous page. Defaults to None.
+
+		Raises:
+			CursorInvalid: The cursor is not valid
+
+		Returns:
+			Tuple[List[dict], Union[str, None]]: The passwords like self.search (1) and the cursor of the next page or None if this is the last page (2)
+		"""
+		offset = 0 if cursor is None else _decode_cursor(cursor, self.key)
+		if offset < 0:
+			raise CursorInvalid
+		results = self.search(query, offset + limit + 1)
+		next_cursor = None
+		if len(results) > offset + limit:
+			next_cursor = _encode_cursor(offset + limit, self.key)
+		return results[offset:offset + limit], next_cursor
+
+	def check_all(self) -> Iterator[dict]:
+		"""Check all passwords in the vault. The vault is decrypted once, up front,
+		and passwords are grouped on hash prefix so that each breach range is
+		looked up only once.
+
+		Returns:
+			Iterator[dict]: The check results (like Password.check, with the id of the entry added) in order of completion. Entries without a password are skipped.
+		"""
+		passwords: list = get_db(dict).execute(
+			"SELECT id, password FROM vault WHERE user_id = ?",
+			(self.user_id,)
+		).fetchall()
+
+		c = Crypt(self.key)
+		groups = {}
+		for password in passwords:
+			if password["password"] is None:
+				continue
+			decrypted_password: str = c.decrypt(password["password"])
+			prefix = sha1(decrypted_password.encode()).hexdigest().upper()[:5]
+			groups.setdefault(prefix, []).append(
+				(password["id"], decrypted_password)
+			)
+
+		return _check_groups(groups)
+
+	def add_many(
+		self,
+		entries: Iterable[dict],
+		batch_size: int = IMPORT_BATCH_SIZE
+	) -> Iterator[int]:
+		"""Add passwords to the vault in batches. Each batch is encrypted and
+		inserted in one transaction, so only one batch is held in memory.
+
+		Args:
+			entries (Iterable[dict]): The title, url, username and password of each entry (title required)
+			batch_size (int, optional): The amount of entries per batch. Defaults to IMPORT_BATCH_SIZE.
+
+		Yields:
+			int: The total amount of entries added so far, after each batch
+		"""
+		c = Crypt(self.key)
+		added = 0
+		entries = iter(entries)
+		while True:
+			rows = [
+				(
+					self.user_id,
+					c.encrypt(entry["title"]),
+					c.encrypt(entry.get("url")),
+					c.encrypt(entry.get("username")),
+					c.encrypt(entry.get("password"))
+				)
+				for entry in islice(entries, batch_size)
+			]
+			if not rows:
+				return
+
+			def insert_batch(cursor: Extended_Cursor) -> None:
+				last_id = cursor.execute(
+					"SELECT IFNULL(MAX(id), 0) FROM vault;"
+				).fetchone()[0]
+				cursor.executemany("""
+					INSERT INTO vault(user_id, title, url, username, password)
+					VALUES (?,?,?,?,?);
+				""", rows)
+				# new rows get ids above the highest one
+				_log_changes(cursor, self.user_id, [r[0] for r in cursor.execute(
+					"SELECT id FROM vault WHERE user_id = ? AND id > ?;",
+					(self.user_id, last_id)
+				)])
+				return
+
+			writer.execute(insert_batch)
+			self._cache_invalidate()
+			added += len(rows)
+			yield added
+
+	def batch(self, operations: List[dict]) -> List[dict]:
+		"""Add, update and delete passwords in one transaction. Either all
+		operations succeed or none of them are done.
+
+		Args:
+			operations (List[dict]): The operations. Each has an 'action' ('add', 'update' or 'delete'). 'add' takes the title (required), url, username and password. 'update' takes the id and the fields to change. 'delete' takes the id.
+
+		Raises:
+			BatchTooLarge: There are more than BATCH_MAX_SIZE operations
+			BatchOperationFailed: An operation is not valid or refers to a password that is not in the vault. Holds the index of the operation and the error.
+
+		Returns:
+			List[dict]: The result of each operation: all info about the password for 'add' and 'update', empty for 'delete'
+		"""
+		if len(operations) > BATCH_MAX_SIZE:
+			raise BatchTooLarge(BATCH_MAX_SIZE)
+
+		c = Crypt(self.key)
+		prepared = []
+		for index, operation in enumerate(operations):
+			try:
+				if not isinstance(operation, dict):
+					raise KeyNotFound('action')
+				action = operation.get('action')
+				if not action in BATCH_ACTIONS:
+					raise KeyNotFound('action')
+				if action != 'delete' and (
+					operation.get('title') is None
+					and (action == 'add' or 'title' in operation)
+				):
+					raise KeyNotFound('title')
+				if action == 'add':
+					id = None
+				else:
+					if not 'id' in operation:
+						raise KeyNotFound('id')
+					try:
+						id = int(operation['id'])
+					except (TypeError, ValueError):
+						raise PasswordNotFound
+			except (KeyNotFound, PasswordNotFound) as e:
+				raise BatchOperationFailed(index, e)
+
+			values = c.encrypt({
+				field: operation[field]
+				for field in ('title', 'url', 'username', 'password')
+				if field in operation and action != 'delete'
+			})
+			prepared.append((action, id, values))
+
+		def run_batch(cursor: Extended_Cursor) -> List[tuple]:
+			rows = []
+			# the last operation on an id decides wether it's deleted
+			deleted: Dict[int, bool] = {}
+			for index, (action, id, values) in enumerate(prepared):
+				if action == 'add':
+					id = cursor.execute(f"""
+						INSERT INTO vault(user_id, {', '.join(values)})
+						VALUES (?{',?' * len(values)});
+					""", (self.user_id, *values.values())).lastrowid
+
+				elif action == 'update':
+					found = cursor.execute(f"""
+						UPDATE vault
+						SET {', '.join(f'{field} = ?' for field in values) or 'id = id'}
+						WHERE id = ? AND user_id = ?;
+					""", (*values.values(), id, self.user_id)).rowcount
+					if not found:
+						raise BatchOperationFailed(index, PasswordNotFound())
+
+				else:
+					found = cursor.execute(
+						"DELETE FROM vault WHERE id = ? AND user_id = ?;",
+						(id, self.user_id)
+					).rowcount
+					if not found:
+						raise BatchOperationFailed(index, PasswordNotFound())
+					rows.append((id, None))
+					deleted[id] = True
+					continue
+
+				rows.append((id, cursor.execute(
+					"SELECT id, title, url, username, password FROM vault WHERE id = ?;",
+					(id,)
+				).fetchone()))
+				deleted[id] = False
+
+			_log_changes(cursor, self.user_id, [i for i, d in deleted.items() if not d])
+			if any(deleted.values()):
+				_log_changes(cursor, self.user_id, [i for i, d in deleted.items() if d], deleted=True)
+			return rows
+
+		results = []
+		for id, row in writer.execute(run_batch):
+			if row is None:
+				self._cache_changed(id)
+				results.append({})
+			else:
+				entry = c.decrypt(dict(zip(
+					('id', 'title', 'url', 'username', 'password'), row
+				)))
+				self._cache_changed(id, entry)
+				results.append(entry)
+		return results
+
+	def _export_rows(self, sql: str, parameters: tuple) -> List[Row]:
+		"""Run a query of the export on a read-only connection that is only
+		held for the query, so that slow downloads don't keep connections
+		from other requests
+
+		Args:
+			sql (str): The query
+			parameters (tuple): The values of the parameters of the query
+
+		Returns:
+			List[Row]: The rows
+		"""
+		db = read_pool.acquire()
+		cursor = Extended_Cursor(db)
+		cursor.row_factory = Row
+		try:
+			return cursor.execute(sql, parameters).fetchall()
+		finally:
+			cursor.close()
+			read_pool.release(db)
+
+	def export(self, encrypted: bool = False) -> Iterator[dict]:
+		"""Go over all passwords in the vault, in order of date added. The rows
+		are read EXPORT_FETCH_SIZE at a time and decrypted as they're yielded,
+		so memory usage doesn't grow with the size of the vault. A database
+		connection is only held while a batch is read.
+
+		Args:
+			encrypted (bool, optional): Yield the entries as stored, encrypted with the key of the user. The first dict is then a header with the salt, encrypted key and key derivation parameters needed to decrypt them with the master password. Defaults to False.
+
+		Yields:
+			dict: The id, title, url, username and password of each entry
+		"""
+		if encrypted:
+			user = self._export_rows(
+				"""
+				SELECT salt, encrypted_key, kdf_algorithm, kdf_cost
+				FROM users
+				WHERE id = ?
+				""",
+				(self.user_id,)
+			)[0]
+			yield {
+				'format': 'onepass-backup',
+				'version': 1,
+				'salt': urlsafe_b64encode(user['salt']).decode(),
+				'encrypted_key': user['encrypted_key'].decode(),
+				'kdf_algorithm': user['kdf_algorithm'],
+				'kdf_cost': user['kdf_cost']
+			}
+
+		c = Crypt(self.key)
+		last_id = -1
+		while True:
+			rows = self._export_rows("""
+				SELECT id, title, url, username, password
+				FROM vault
+				WHERE user_id = ? AND id > ?
+				ORDER BY id
+				LIMIT ?;
+				""",
+				(self.user_id, last_id, EXPORT_FETCH_SIZE)
+			)
+			for row in rows:
+				if encrypted:
+					yield {
+						k: v.decode() if isinstance(v, bytes) else v
+						for k, v in zip(row.keys(), row)
+					}
+				else:
+					yield c.decrypt(dict(row))
+			if len(rows) < EXPORT_FETCH_SIZE:
+				return
+			last_id = rows[-1]['id']
+
+	def changes(self, since: int, limit: int = CHANGES_PAGE_SIZE) -> dict:
+		"""Get what changed in the vault since an earlier sync. Only the entries
+		in the change log after since are read and decrypted. For the first sync
+		(since 0) or when tombstones after since have been compacted, the whole
+		vault is returned with 'reset' set instead.
+
+		Args:
+			since (int): The 'since' returned by the previous sync, 0 for the first sync
+			limit (int, optional): The maximum amount of changes to return. Defaults to CHANGES_PAGE_SIZE.
+
+		Returns:
+			dict: The id, title, url and username of added and updated entries ('entries'), the ids of deleted entries ('deleted'), the value to sync since next time ('since'), wether there are more changes to fetch ('more') and wether the entries replace the copy of the client ('reset')
+		"""
+		cursor = get_db()
+		c = Crypt(self.key)
+		if since > 0:
+			rows = cursor.execute("""
+				SELECT c.seq, c.password_id, v.id IS NULL, v.title, v.url, v.username
+				FROM vault_changes c
+				LEFT JOIN vault v
+				ON v.id = c.password_id AND v.user_id = c.user_id
+				WHERE c.user_id = ? AND c.seq > ?
+				ORDER BY c.seq
+				LIMIT ?;
+			""", (self.user_id, since, limit)).fetchall()
+			# read after the changes, so a compaction in between is noticed
+			floor = cursor.execute(
+				"SELECT changes_floor FROM users WHERE id = ?;",
+				(self.user_id,)
+			).fetchone()[0]
+
+			if since >= floor:
+				entries, deleted = [], []
+				for seq, id, is_deleted, title, url, username in rows:
+					if is_deleted:
+						deleted.append(id)
+					else:
+						entries.append(c.decrypt({
+							'id': id, 'title': title, 'url': url, 'username': username
+						}))
+				return {
+					'entries': entries,
+					'deleted': deleted,
+					'since': rows[-1][0] if rows else since,
+					'more': len(rows) == limit,
+					'reset': False
+				}
+
+		# read the position first, so changes made while reading the vault
+		# are sent again on the next sync instead of missed
+		seq = cursor.execute("""
+			SELECT MAX(changes_floor, IFNULL((
+				SELECT MAX(seq) FROM vault_changes WHERE user_id = users.id
+			), 0))
+			FROM users
+			WHERE id = ?;
+		""", (self.user_id,)).fetchone()[0]
+		entries = get_db(dict).execute(
+			"SELECT id, title, url, username FROM vault WHERE user_id = ? ORDER BY id;",
+			(self.user_id,)
+		).fetchall()
+		return {
+			'entries': [c.decrypt(dict(entry)) for entry in entries],
+			'deleted': [],
+			'since': seq,
+			'more': False,
+			'reset': True
+		}
 
 	def fetchone(self, id: int) -> Password:
 		"""Get one password from the vault
@@ -234,7 +1064,7 @@ class Vault:
 		Returns:
 			Password: A Password instance of the password
 		"""		
-		return Password(id, self.key)
+		return Password(id, self.key, self)
 
 	def add(
 		self,
@@ -263,16 +1093,22 @@ class Vault:
 		pw_data = Crypt(self.key).encrypt(pw_data)
 
 		# insert into vault
-		id = get_db().execute("""
-			INSERT INTO vault(user_id, title, url, username, password)
-			VALUES (?,?,?,?,?);
-		""", (
-			self.user_id,
-			pw_data["title"],
-			pw_data["url"],
-			pw_data["username"],
-			pw_data["password"],
-		)).lastrowid
+		def insert_password(cursor: Extended_Cursor) -> int:
+			id = cursor.execute("""
+				INSERT INTO vault(user_id, title, url, username, password)
+				VALUES (?,?,?,?,?);
+			""", (
+				self.user_id,
+				pw_data["title"],
+				pw_data["url"],
+				pw_data["username"],
+				pw_data["password"],
+			)).lastrowid
+			_log_changes(cursor, self.user_id, (id,))
+			return id
+
+		id = writer.execute(insert_password)
+		self._cache_changed(id, {"title": title, "url": url, "username": username})
 
 		# return info
 		return self.fetchone(id)
@@ -0,0 +1,276 @@
+#-*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from sqlite3 import Error, connect
+from threading import Lock
+from time import time
+from typing import Tuple, Union
+from urllib import request
+
+from backend.hash_stores import MAX_VALUE, VALUE, search_records
+
+RANGE_URL = 'https://api.pwnedpasswords.com/range/{prefix}'
+PREFIX_LENGTH = 5
+SUFFIX_SIZE = 18
+RECORD_SIZE = SUFFIX_SIZE + VALUE.size
+MAX_SIZE = 1024
+TTL = 86400.0
+FETCH_TIMEOUT = 10.0 # seconds
+PERSIST_TIMEOUT = 1.0 # seconds
+PERSIST_MAX_SIZE = 8192 # ranges, about 18 KB each
+PRUNE_INTERVAL = 100 # stored ranges
+
+def _suffix_key(suffix: str) -> bytes:
+	"""Turn the 35 character hex suffix of a hash into a key
+
+	Args:
+		suffix (str): The hex suffix
+
+	Returns:
+		bytes: The key
+	"""
+	return bytes.fromhex('0' + suffix)
+
+def _parse_range(response: str) -> bytes:
+	"""Turn a range response of pwnedpasswords.com into compact sorted records
+
+	Args:
+		response (str): The "SUFFIX:COUNT" lines returned by the api
+
+	Returns:
+		bytes: The records (suffix key + count)
+	"""
+	records = []
+	for line in response.splitlines():
+		suffix, _, count = line.partition(':')
+		if len(suffix) != 35:
+			continue
+		records.append(
+			_suffix_key(suffix) + VALUE.pack(min(int(count or 0), MAX_VALUE))
+		)
+	records.sort()
+	return b''.join(records)
+
+def _fetch_range(prefix: str) -> bytes:
+	"""Fetch a range from pwnedpasswords.com
+
+	Args:
+		prefix (str): The first five characters of the SHA-1 hex digest
+
+	Raises:
+		OSError: The api could not be reached or did not answer within FETCH_TIMEOUT
+
+	Returns:
+		bytes: The range as compact sorted records
+	"""
+	with request.urlopen(
+		RANGE_URL.format(prefix=prefix),
+		timeout=FETCH_TIMEOUT
+	) as response:
+		return _parse_range(response.read().decode())
+
+class RangeCache:
+	"""Cache of pwnedpasswords.com ranges keyed on hash prefix, shared by all
+	threads. Entries expire after ttl seconds and the least recently used
+	entry is evicted when the cache is full. Optionally, ranges are persisted
+	to a SQLite table so that the cache survives restarts. The table is used
+	outside of the lock of the memory and is pruned to persist_max_size
+	ranges every PRUNE_INTERVAL stores. When the table can't be used in
+	time, it's skipped.
+	"""
+	def __init__(
+		self,
+		max_size: int = MAX_SIZE,
+		ttl: float = TTL,
+		persist_max_size: int = PERSIST_MAX_SIZE
+	):
+		self.max_size = max_size
+		self.ttl = ttl
+		self.persist_max_size = persist_max_size
+		self.hits = 0
+		self.misses = 0
+		self._ranges = OrderedDict()
+		self._lock = Lock()
+		self._db = None
+		# guards the use of the connection, separately from the memory
+		self._db_lock = Lock()
+		self._stores = 0
+
+	def persist(self, file: str) -> None:
+		"""Persist ranges to a SQLite database
+
+		Args:
+			file (str): The filepath of the database
+		"""
+		db = connect(
+			file,
+			timeout=PERSIST_TIMEOUT,
+			check_same_thread=False,
+			isolation_level=None
+		)
+		db.execute("PRAGMA journal_mode = WAL;")
+		db.execute("PRAGMA synchronous = NORMAL;")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS pwned_ranges(
+				prefix VARCHAR(5) PRIMARY KEY,
+				expires REAL NOT NULL,
+				range BLOB NOT NULL
+			);
+		""")
+		db.execute(
+			"CREATE INDEX IF NOT EXISTS pwned_ranges_expires ON pwned_ranges(expires);"
+		)
+		with self._db_lock:
+			self._db = db
+			try:
+				self._prune()
+			except Error:
+				# another process is writing; pruned on a later store
+				pass
+		return
+
+	def _prune(self) -> None:
+		"""Remove the expired ranges from the table, and the ranges that
+		expire first when there are more than persist_max_size.
+		Requires the db lock to be held.
+		"""
+		self._db.execute("DELETE FROM pwned_ranges WHERE expires <= ?;", (time(),))
+		self._db.execute("""
+			DELETE FROM pwned_ranges
+			WHERE prefix IN (
+				SELECT prefix
+				FROM pwned_ranges
+				ORDER BY expires DESC
+				LIMIT -1 OFFSET ?
+			);
+			""",
+			(self.persist_max_size,)
+		)
+		return
+
+	def _load(self, prefix: str) -> Union[Tuple[float, bytes], None]:
+		"""Get a range from the table
+
+		Args:
+			prefix (str): The prefix of the range
+
+		Returns:
+			Union[Tuple[float, bytes], None]: The epoch at which the range expires and the range, or None if it's not in the table
+		"""
+		with self._db_lock:
+			if self._db is None:
+				return
+			try:
+				return self._db.execute(
+					"SELECT expires, range FROM pwned_ranges WHERE prefix = ?;",
+					(prefix,)
+				).fetchone()
+			except Error:
+				return
+
+	def _save(self, prefix: str, expires: float, pwned_range: bytes) -> None:
+		"""Put a range in the table
+
+		Args:
+			prefix (str): The prefix of the range
+			expires (float): The epoch at which the range expires
+			pwned_range (bytes): The range as compact sorted records
+		"""
+		with self._db_lock:
+			if self._db is None:
+				return
+			try:
+				self._db.execute(
+					"INSERT OR REPLACE INTO pwned_ranges VALUES (?,?,?);",
+					(prefix, expires, pwned_range)
+				)
+				self._stores += 1
+				if self._stores % PRUNE_INTERVAL == 0:
+					self._prune()
+			except Error:
+				pass
+		return
+
+	def _store(self, prefix: str, expires: float, pwned_range: bytes) -> None:
+		"""Put a range in memory, evicting the least recently used one if
+		the cache is full. Requires the lock to be held.
+
+		Args:
+			prefix (str): The prefix of the range
+			expires (float): The epoch at which the range expires
+			pwned_range (bytes): The range as compact sorted records
+		"""
+		self._ranges[prefix] = (expires, pwned_range)
+		self._ranges.move_to_end(prefix)
+		while len(self._ranges) > self.max_size:
+			self._ranges.popitem(last=False)
+		return
+
+	def get(self, prefix: str) -> bytes:
+		"""Get a range, from the cache if possible and otherwise from the api
+
+		Args:
+			prefix (str): The first five characters of the SHA-1 hex digest
+
+		Returns:
+			bytes: The range as compact sorted records
+		"""
+		now = time()
+		with self._lock:
+			entry = self._ranges.get(prefix)
+			if entry is not None and entry[0] > now:
+				self._ranges.move_to_end(prefix)
+				self.hits += 1
+				return entry[1]
+
+		if entry is None:
+			entry = self._load(prefix)
+			if entry is not None and entry[0] > now:
+				with self._lock:
+					self._store(prefix, entry[0], entry[1])
+					self.hits += 1
+				return entry[1]
+
+		with self._lock:
+			self.misses += 1
+
+		pwned_range = _fetch_range(prefix)
+		expires = time() + self.ttl
+
+		with self._lock:
+			self._store(prefix, expires, pwned_range)
+		self._save(prefix, expires, pwned_range)
+		return pwned_range
+
+	def count(self, hash: str) -> int:
+		"""Get how many times a password has been seen in breaches
+
+		Args:
+			hash (str): The SHA-1 hex digest of the password
+
+		Returns:
+			int: The amount of times the password has been seen
+		"""
+		pwned_range = self.get(hash[:PREFIX_LENGTH])
+		return search_records(
+			pwned_range,
+			0,
+			len(pwned_range) // RECORD_SIZE,
+			RECORD_SIZE,
+			_suffix_key(hash[PREFIX_LENGTH:])
+		) or 0
+
+	def stats(self) -> dict:
+		"""Get the statistics of the cache
+
+		Returns:
+			dict: The hits, misses and amount of ranges in memory
+		"""
+		with self._lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'size': len(self._ranges)
+			}
+
+range_cache = RangeCache()
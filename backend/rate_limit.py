@@ -0,0 +1,67 @@
+#-*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Hashable
+
+MAX_KEYS = 100_000
+
+class TokenBucketLimiter:
+	"""Token bucket per key (e.g. client address or username). Every key can
+	do burst requests at once and gets rate new ones per second after that.
+	Only the most recently used max_keys keys are tracked; a key that is
+	forgotten starts over with a full bucket.
+	"""
+	def __init__(self, rate: float, burst: int, max_keys: int = MAX_KEYS):
+		self.rate = rate
+		self.burst = burst
+		self.max_keys = max_keys
+		self._buckets: OrderedDict = OrderedDict()
+		self._lock = Lock()
+		self.allowed = 0
+		self.rejected = 0
+
+	def acquire(self, key: Hashable) -> float:
+		"""Take a token from the bucket of a key if it has one
+
+		Args:
+			key (Hashable): The key
+
+		Returns:
+			float: 0 if a token was taken, otherwise the amount of seconds until the bucket has a token again
+		"""
+		now = monotonic()
+		with self._lock:
+			tokens, last = self._buckets.pop(key, (self.burst, now))
+			tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+			if tokens >= 1:
+				tokens -= 1
+				retry_after = 0.0
+				self.allowed += 1
+			else:
+				retry_after = (1 - tokens) / self.rate
+				self.rejected += 1
+
+			self._buckets[key] = (tokens, now)
+			if len(self._buckets) > self.max_keys:
+				self._buckets.popitem(last=False)
+		return retry_after
+
+	def stats(self) -> dict:
+		"""Get the statistics of the limiter
+
+		Returns:
+			dict: The amount of keys tracked and requests allowed and rejected
+		"""
+		with self._lock:
+			return {
+				'keys': len(self._buckets),
+				'allowed': self.allowed,
+				'rejected': self.rejected
+			}
+
+# Logins and registrations per client address, and per username per client address
+address_limiter = TokenBucketLimiter(rate=1 / 6, burst=10)
+username_limiter = TokenBucketLimiter(rate=1 / 12, burst=5)
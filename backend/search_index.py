@@ -0,0 +1,146 @@
+#-*- coding: utf-8 -*-
+
+from heapq import nsmallest
+from re import compile
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+FIELDS = (('title', 3), ('username', 2), ('url', 1))
+GRAM_SIZE = 3
+WORD_SPLITTER = compile(r'\W+')
+
+def _grams(text: str) -> Set[str]:
+	"""Get the trigrams of a text
+
+	Args:
+		text (str): The text
+
+	Returns:
+		Set[str]: The trigrams
+	"""
+	return {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+def _words(text: str) -> Set[str]:
+	"""Get the words of a text
+
+	Args:
+		text (str): The text
+
+	Returns:
+		Set[str]: The words
+	"""
+	return set(filter(None, WORD_SPLITTER.split(text)))
+
+class SearchIndex:
+	"""Trigram index over the title, username and url of vault entries.
+	Queries match anywhere in a field. Queries of at least three characters
+	are looked up in the trigrams, shorter queries scan the fields. Results
+	are ranked on where the query matches (exact > start of field > start of
+	word > anywhere) and in which field (title > username > url).
+	"""
+	def __init__(self, entries: Iterable[dict] = ()):
+		self._texts: Dict[int, Tuple[str, ...]] = {}
+		self._grams: Dict[str, Set[int]] = {}
+		for entry in entries:
+			self.add(entry)
+
+	def add(self, entry: dict) -> None:
+		"""Add an entry to the index
+
+		Args:
+			entry (dict): The decrypted vault entry
+		"""
+		id = entry['id']
+		texts = tuple(
+			'' if entry[field] is None else str(entry[field]).lower()
+			for field, _ in FIELDS
+		)
+		self._texts[id] = texts
+
+		for text in texts:
+			for gram in _grams(text):
+				self._grams.setdefault(gram, set()).add(id)
+		return
+
+	def remove(self, id: int) -> None:
+		"""Remove an entry from the index if it's in it
+
+		Args:
+			id (int): The id of the entry
+		"""
+		texts = self._texts.pop(id, None)
+		if texts is None:
+			return
+
+		grams = set()
+		for text in texts:
+			grams |= _grams(text)
+
+		for gram in grams:
+			postings = self._grams[gram]
+			postings.discard(id)
+			if not postings:
+				del self._grams[gram]
+		return
+
+	def _score(self, query: str, id: int) -> int:
+		"""Score how well an entry matches the query
+
+		Args:
+			query (str): The lowercase query
+			id (int): The id of the entry
+
+		Returns:
+			int: The score. 0 means no match
+		"""
+		score = 0
+		for text, (_, weight) in zip(self._texts[id], FIELDS):
+			if text == query:
+				score += 4 * weight
+			elif text.startswith(query):
+				score += 3 * weight
+			elif any(w.startswith(query) for w in _words(text)):
+				score += 2 * weight
+			elif query in text:
+				score += weight
+		return score
+
+	def search(self, query: str, limit: Union[int, None] = None) -> List[int]:
+		"""Search for entries
+
+		Args:
+			query (str): The term to search for
+			limit (Union[int, None], optional): The maximum amount of results. Defaults to None.
+
+		Returns:
+			List[int]: The ids of the matching entries, best match first
+		"""
+		query = query.lower().strip()
+		if not query:
+			return []
+
+		if len(query) >= GRAM_SIZE:
+			# entries that have all trigrams of the query
+			postings = sorted(
+				(self._grams.get(gram, set()) for gram in _grams(query)),
+				key=len
+			)
+			candidates = postings[0].intersection(*postings[1:])
+		else:
+			# too short for trigrams; scan the fields
+			candidates = [
+				id
+				for id, texts in self._texts.items()
+				if any(query in text for text in texts)
+			]
+
+		results = []
+		for id in candidates:
+			score = self._score(query, id)
+			if score:
+				results.append((-score, self._texts[id], id))
+
+		if limit is None:
+			results.sort()
+		else:
+			results = nsmallest(limit, results)
+		return [r[-1] for r in results]
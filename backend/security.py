@@ -1,12 +1,47 @@
 #-*- coding: utf-8 -*-
 
+from argparse import ArgumentParser
 from base64 import urlsafe_b64encode
-from hashlib import pbkdf2_hmac
+from concurrent.futures import (BrokenExecutor, Executor,
+                                ProcessPoolExecutor, ThreadPoolExecutor)
+from hashlib import pbkdf2_hmac, scrypt
+from multiprocessing import get_context
+from os import cpu_count
 from secrets import token_bytes
+from signal import SIG_IGN, SIGINT, signal
+from statistics import median
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
 from typing import Tuple, Union
 
 from cryptography.fernet import Fernet
 
+from backend.custom_exceptions import ServerBusy
+from backend.metrics import Histogram
+
+# The cost of pbkdf2_sha256 is the amount of iterations,
+# the cost of scrypt is the CPU/memory cost (N), a power of 2
+KDF_ALGORITHMS = ('pbkdf2_sha256', 'scrypt')
+DEFAULT_KDF = ('pbkdf2_sha256', 100_000)
+KDF_MIN_COST = {'pbkdf2_sha256': 100_000, 'scrypt': 2 ** 14}
+KDF_TARGET_TIME = 0.25 # seconds
+SCRYPT_BLOCK_SIZE = 8
+SCRYPT_PARALLELISM = 1
+KDF_WORKERS = min(cpu_count() or 1, 4)
+KDF_MAX_PENDING = 5 # derivations running or waiting; keep below the amount of server threads
+
+crypt_seconds = Histogram(
+	'onepass_crypt_duration_seconds',
+	'Time to encrypt or decrypt a value or the values of an entry',
+	('operation',)
+)
+kdf_seconds = Histogram(
+	'onepass_kdf_duration_seconds',
+	'Time to hash a master password, including waiting for a worker',
+	('algorithm',),
+	buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+
 class Crypt:
 	def __init__(self, key: bytes):
 		self.cipher = Fernet(key)
@@ -44,22 +79,23 @@ class Crypt:
 		if encrypted_data is None:
 			return
 
-		if isinstance(encrypted_data, bytes):
-			#bytes
-			result = self.cipher.decrypt(encrypted_data)
-			if decode == True:
-				result = result.decode()
-			return result
+		with crypt_seconds.time('decrypt'):
+			if isinstance(encrypted_data, bytes):
+				#bytes
+				result = self.cipher.decrypt(encrypted_data)
+				if decode == True:
+					result = result.decode()
+				return result
 
-		#dict
-		for k,v in encrypted_data.items():
-			if isinstance(v, bytes):
-				encrypted_data[k] = self.decode_data(
-					self.cipher.decrypt(v),
-					decode
-				)
+			#dict
+			for k,v in encrypted_data.items():
+				if isinstance(v, bytes):
+					encrypted_data[k] = self.decode_data(
+						self.cipher.decrypt(v),
+						decode
+					)
 
-		return encrypted_data
+			return encrypted_data
 
 	def encrypt(
 		self,
@@ -76,49 +112,238 @@ class Crypt:
 		if data is None:
 			return
 
-		if isinstance(data, dict):
-			#dict
-			for k, v in data.items():
-				if isinstance(v, str):
-					v = v.encode()
-				if isinstance(v, bytes):
-					data[k] = self.cipher.encrypt(v)
-			return data
+		with crypt_seconds.time('encrypt'):
+			if isinstance(data, dict):
+				#dict
+				for k, v in data.items():
+					if isinstance(v, str):
+						v = v.encode()
+					if isinstance(v, bytes):
+						data[k] = self.cipher.encrypt(v)
+				return data
+
+			#str
+			if isinstance(data, str):
+				data = data.encode()
+
+			#bytes/(str->bytes)
+			result = self.cipher.encrypt(data)
+			return result
+
+def _derive_key(salt: bytes, data: str, algorithm: str, cost: int) -> bytes:
+	"""Hash a string using the supplied salt. Runs in the worker processes of
+	the KDFExecutor.
+
+	Args:
+		salt (bytes): The salt to use when hashing
+		data (str): The data to hash
+		algorithm (str): The key derivation function, one of KDF_ALGORITHMS
+		cost (int): The cost parameter of the key derivation function
+
+	Raises:
+		ValueError: The algorithm is not supported
+
+	Returns:
+		bytes: The b64 encoded hash of the supplied data
+	"""
+	if algorithm == 'pbkdf2_sha256':
+		result = pbkdf2_hmac('sha256', data.encode(), salt, cost)
+	elif algorithm == 'scrypt':
+		result = scrypt(
+			data.encode(),
+			salt=salt,
+			n=cost,
+			r=SCRYPT_BLOCK_SIZE,
+			p=SCRYPT_PARALLELISM,
+			maxmem=256 * SCRYPT_BLOCK_SIZE * cost,
+			dklen=32
+		)
+	else:
+		raise ValueError(f'Unsupported key derivation function: {algorithm}')
+	return urlsafe_b64encode(result)
+
+def _init_worker() -> None:
+	"""Let a worker process of the KDFExecutor ignore Ctrl+C; the server
+	process stops it on shutdown
+	"""
+	signal(SIGINT, SIG_IGN)
+	return
+
+class KDFExecutor:
+	"""Runs the key derivations in a small pool of worker processes, so that
+	they don't take up the CPU of the server process. At most max_pending
+	derivations can be running or waiting for a worker at the same time,
+	so that a burst of logins can't occupy all server threads. Beyond that,
+	derivations are refused.
+	"""
+	def __init__(
+		self,
+		max_workers: int = KDF_WORKERS,
+		max_pending: int = KDF_MAX_PENDING
+	):
+		self.max_workers = max_workers
+		self.max_pending = max_pending
+		self._executor: Union[Executor, None] = None
+		self._lock = Lock()
+		self._slots = BoundedSemaphore(max_pending)
+		self.pending = 0
+		self.max_pending_seen = 0
+		self.completed = 0
+		self.rejected = 0
+		self.total_time = 0.0
+
+	def _get_executor(self) -> Executor:
+		"""Get the pool of workers, starting it if needed. Requires the lock.
+
+		Returns:
+			Executor: The pool
+		"""
+		if self._executor is None:
+			try:
+				# spawn instead of fork, as the server process runs threads
+				self._executor = ProcessPoolExecutor(
+					self.max_workers,
+					mp_context=get_context('spawn'),
+					initializer=_init_worker
+				)
+			except (ImportError, NotImplementedError, OSError):
+				# no working multiprocessing on this platform
+				self._executor = ThreadPoolExecutor(
+					self.max_workers,
+					thread_name_prefix='kdf'
+				)
+		return self._executor
+
+	def derive(self, salt: bytes, data: str, algorithm: str, cost: int) -> bytes:
+		"""Hash a string using the supplied salt in one of the workers
+
+		Args:
+			salt (bytes): The salt to use when hashing
+			data (str): The data to hash
+			algorithm (str): The key derivation function, one of KDF_ALGORITHMS
+			cost (int): The cost parameter of the key derivation function
 
-		#str
-		if isinstance(data, str):
-			data = data.encode()
+		Raises:
+			ServerBusy: Too many derivations are already running or waiting
 
-		#bytes/(str->bytes)
-		result = self.cipher.encrypt(data)
-		return result
+		Returns:
+			bytes: The b64 encoded hash of the supplied data
+		"""
+		if not self._slots.acquire(blocking=False):
+			with self._lock:
+				self.rejected += 1
+			raise ServerBusy(self.retry_after())
+
+		start = perf_counter()
+		try:
+			with self._lock:
+				self.pending += 1
+				self.max_pending_seen = max(self.max_pending_seen, self.pending)
+				executor = self._get_executor()
+				future = executor.submit(_derive_key, salt, data, algorithm, cost)
+			return future.result()
+
+		except BrokenExecutor:
+			# a worker died; start a new pool for the next derivation
+			with self._lock:
+				if self._executor is executor:
+					self._executor = None
+			raise
+
+		finally:
+			with self._lock:
+				self.pending -= 1
+				self.completed += 1
+				self.total_time += perf_counter() - start
+			self._slots.release()
+
+	def has_capacity(self) -> bool:
+		"""Check, without reserving anything, if a derivation would be accepted now
 
-def get_hash(salt: bytes, data: str) -> bytes:
+		Returns:
+			bool: Wether less than max_pending derivations are running or waiting
+		"""
+		return self.pending < self.max_pending
+
+	def retry_after(self) -> float:
+		"""Estimate when the derivations that are running or waiting now are done
+
+		Returns:
+			float: The amount of seconds
+		"""
+		with self._lock:
+			if not self.completed:
+				return 1.0
+			average = self.total_time / self.completed
+			return average * max(self.pending, 1) / self.max_workers
+
+	def stats(self) -> dict:
+		"""Get the statistics of the executor
+
+		Returns:
+			dict: The amount of workers, derivations running or waiting (now and at most), completed and refused and the total time they took including waiting
+		"""
+		with self._lock:
+			return {
+				'workers': self.max_workers,
+				'pending': self.pending,
+				'max_pending': self.max_pending_seen,
+				'completed': self.completed,
+				'rejected': self.rejected,
+				'total_time': self.total_time
+			}
+
+	def stop(self) -> None:
+		"""Stop the workers
+		"""
+		with self._lock:
+			if self._executor is not None:
+				self._executor.shutdown()
+				self._executor = None
+		return
+
+kdf_executor = KDFExecutor()
+
+def get_hash(
+	salt: bytes,
+	data: str,
+	algorithm: str = DEFAULT_KDF[0],
+	cost: int = DEFAULT_KDF[1]
+) -> bytes:
 	"""Hash a string using the supplied salt
 
 	Args:
-		salt (bytes): The salt to use wwhen hashing
+		salt (bytes): The salt to use when hashing
 		data (str): The data to hash
+		algorithm (str, optional): The key derivation function, one of KDF_ALGORITHMS. Defaults to DEFAULT_KDF[0].
+		cost (int, optional): The cost parameter of the key derivation function. Defaults to DEFAULT_KDF[1].
 
 	Returns:
 		bytes: The b64 encoded hash of the supplied password
 	"""
-	return urlsafe_b64encode(
-		pbkdf2_hmac('sha256', data.encode(), salt, 100_000)
-	)
+	start = perf_counter()
+	result = kdf_executor.derive(salt, data, algorithm, cost)
+	kdf_seconds.observe(perf_counter() - start, algorithm)
+	return result
 
-def generate_key(password: str) -> Tuple[bytes, bytes]:
+def generate_key(
+	password: str,
+	algorithm: str = DEFAULT_KDF[0],
+	cost: int = DEFAULT_KDF[1]
+) -> Tuple[bytes, bytes]:
 	"""Generate a salt and encrypted key based on a given master password
 
 	Args:
 		password (str): The master password to generate for
+		algorithm (str, optional): The key derivation function to hash the master password with. Defaults to DEFAULT_KDF[0].
+		cost (int, optional): The cost parameter of the key derivation function. Defaults to DEFAULT_KDF[1].
 
 	Returns:
 		Tuple[bytes, bytes]: The salt (1) and encrypted key (2)
 	"""
 	#hash the master password
 	salt = token_bytes()
-	hashed_password = get_hash(salt, password)
+	hashed_password = get_hash(salt, password, algorithm, cost)
 	del password
 
 	#encrypt key with hashed master password as cipher
@@ -126,3 +351,79 @@ def generate_key(password: str) -> Tuple[bytes, bytes]:
 	encrypted_key = Crypt(hashed_password).encrypt(key)
 
 	return salt, encrypted_key
+
+def calibrate_kdf(
+	algorithm: str = DEFAULT_KDF[0],
+	target_time: float = KDF_TARGET_TIME,
+	rounds: int = 5
+) -> Tuple[int, float]:
+	"""Find the cost of a key derivation function at which hashing takes
+	about the target time on this machine. The cost is never lower than
+	KDF_MIN_COST.
+
+	Args:
+		algorithm (str, optional): The key derivation function, one of KDF_ALGORITHMS. Defaults to DEFAULT_KDF[0].
+		target_time (float, optional): The time one hash should take in seconds. Defaults to KDF_TARGET_TIME.
+		rounds (int, optional): The amount of times to measure. Defaults to 5.
+
+	Raises:
+		ValueError: The algorithm is not supported
+
+	Returns:
+		Tuple[int, float]: The cost (1) and the time one hash takes at that cost in seconds (2)
+	"""
+	if not algorithm in KDF_ALGORITHMS:
+		raise ValueError(f'Unsupported key derivation function: {algorithm}')
+
+	def measure(cost: int) -> float:
+		timings = []
+		for _ in range(rounds):
+			start = perf_counter()
+			_derive_key(token_bytes(), 'calibration', algorithm, cost)
+			timings.append(perf_counter() - start)
+		return median(timings)
+
+	cost = KDF_MIN_COST[algorithm]
+	duration = measure(cost)
+	if algorithm == 'scrypt':
+		# the time scales with N, which has to be a power of 2
+		while duration * 2 <= target_time:
+			cost *= 2
+			duration *= 2
+	else:
+		cost = max(cost, int(cost * target_time / duration) // 10_000 * 10_000)
+
+	return cost, measure(cost)
+
+if __name__ == '__main__':
+	parser = ArgumentParser(
+		prog='python3 -m backend.security',
+		description='Find the cost of the key derivation function that makes hashing the master password take the target time on this machine'
+	)
+	parser.add_argument('-a', '--algorithm', choices=KDF_ALGORITHMS, default=DEFAULT_KDF[0], help='The key derivation function')
+	parser.add_argument('-t', '--target', type=float, default=KDF_TARGET_TIME, help='The time hashing should take in seconds')
+	parser.add_argument('--save', action='store_true', help='Use the found cost for new accounts and upgrade existing accounts on their next login')
+	parser.add_argument('--database', help='The database file; defaults to db/Onepass.db')
+	args = parser.parse_args()
+
+	cost, duration = calibrate_kdf(args.algorithm, args.target)
+	print(f'{args.algorithm} with cost {cost} takes {duration:.3f}s')
+
+	if args.save:
+		from os.path import abspath, dirname, join
+
+		from flask import Flask
+
+		from backend.db import DBConnection, close_db, setup_db, writer
+		from backend.users import set_kdf_params
+
+		DBConnection.file = abspath(args.database or join(
+			dirname(dirname(abspath(__file__))), 'db', 'Onepass.db'
+		))
+		app = Flask(__name__)
+		app.teardown_appcontext(close_db)
+		with app.app_context():
+			setup_db()
+		set_kdf_params(args.algorithm, cost)
+		writer.stop()
+		print('Saved; accounts are upgraded on their next login')
@@ -0,0 +1,433 @@
+#-*- coding: utf-8 -*-
+
+from base64 import urlsafe_b64encode
+from collections import OrderedDict
+from hashlib import blake2b
+from heapq import heapify, heappop, heappush
+from os import urandom
+from sqlite3 import Connection, connect
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from typing import Dict, List, Tuple, Union
+
+from backend.custom_exceptions import ApiKeyExpired, ApiKeyInvalid
+from backend.security import Crypt
+from backend.users import User
+
+SESSION_TTL = 3600 # seconds
+MAX_SESSIONS = 10_000
+SWEEP_INTERVAL = 60 # seconds
+EXPIRED_MEMORY = 10_000 # recently expired sessions to recognise
+SHARED_TIMEOUT = 5.0 # seconds
+SHARED_CHECK_INTERVAL = 5.0 # seconds
+
+class Session:
+	"""A logged in session: the user, when the session expires and when it
+	was last checked against the shared table (monotonic time)
+	"""
+	__slots__ = ('exp', 'user_data', 'checked')
+
+	def __init__(self, exp: float, user_data: User, checked: float = 0.0):
+		self.exp = exp
+		self.user_data = user_data
+		self.checked = checked
+
+def _hash_api_key(api_key: str) -> bytes:
+	"""Hash an api key for storing, so that the keys themselves aren't kept
+
+	Args:
+		api_key (str): The api key
+
+	Returns:
+		bytes: The hash
+	"""
+	return blake2b(api_key.encode(), digest_size=16).digest()
+
+def _session_cipher(api_key: str) -> Crypt:
+	"""Get the cipher that the vault key of a shared session is encrypted
+	with. It's derived from the api key, which only the client has.
+
+	Args:
+		api_key (str): The api key
+
+	Returns:
+		Crypt: The cipher
+	"""
+	return Crypt(urlsafe_b64encode(
+		blake2b(api_key.encode(), digest_size=32, person=b'onepass-session').digest()
+	))
+
+class SessionStore:
+	"""The sessions of logged in users, by hashed api key. Expired sessions
+	are evicted from a heap ordered on expiry, both when a session is created
+	and by a background sweeper. When max_sessions sessions exist, logging in
+	evicts the session that expires first. The hashes of recently expired
+	sessions are remembered so that using them gives ApiKeyExpired.
+
+	Optionally, sessions are shared with other processes through a SQLite
+	table, so that an api key works in every worker process. Each process then
+	keeps the sessions it has seen in memory as a cache, and checks them
+	against the table at most every SHARED_CHECK_INTERVAL seconds, so that
+	logging out in one process ends the session in all within that time.
+	The table is queried outside of the lock of the memory, so that sessions
+	in memory can be used meanwhile.
+	"""
+	def __init__(
+		self,
+		ttl: float = SESSION_TTL,
+		max_sessions: int = MAX_SESSIONS,
+		sweep_interval: float = SWEEP_INTERVAL
+	):
+		self.ttl = ttl
+		self.max_sessions = max_sessions
+		self.sweep_interval = sweep_interval
+		self._sessions: Dict[bytes, Session] = {}
+		self._heap: List[Tuple[float, bytes]] = []
+		self._expired: OrderedDict = OrderedDict()
+		self._lock = Lock()
+		self._db: Union[Connection, None] = None
+		# guards the use of the connection; taken after _lock when both are
+		self._db_lock = Lock()
+		self._stop = Event()
+		self._thread: Union[Thread, None] = None
+		self.created = 0
+		self.logged_out = 0
+		self.expired = 0
+		self.evicted = 0
+
+	def share(self, file: str) -> None:
+		"""Share sessions with other processes through a SQLite database
+
+		Args:
+			file (str): The filepath of the database
+		"""
+		db = connect(
+			file,
+			timeout=SHARED_TIMEOUT,
+			check_same_thread=False,
+			isolation_level=None
+		)
+		db.execute("PRAGMA journal_mode = WAL;")
+		db.execute("PRAGMA synchronous = NORMAL;")
+		db.execute("""
+			CREATE TABLE IF NOT EXISTS sessions(
+				key BLOB PRIMARY KEY,
+				exp REAL NOT NULL,
+				user_id INTEGER NOT NULL,
+				username VARCHAR(255) NOT NULL,
+				encrypted_key BLOB NOT NULL
+			) WITHOUT ROWID;
+		""")
+		db.execute("CREATE INDEX IF NOT EXISTS sessions_exp ON sessions(exp);")
+		with self._lock, self._db_lock:
+			self._db = db
+		return
+
+	def _start(self) -> None:
+		"""Start the sweeper if it isn't running. Requires the lock.
+		"""
+		if self._thread is None or not self._thread.is_alive():
+			self._stop.clear()
+			self._thread = Thread(target=self._run, name='session_sweeper', daemon=True)
+			self._thread.start()
+		return
+
+	def _run(self) -> None:
+		"""Evict expired sessions every sweep_interval seconds
+		"""
+		while not self._stop.wait(self.sweep_interval):
+			self.sweep()
+		return
+
+	def _pop(self) -> Union[Tuple[bytes, Session], None]:
+		"""Remove the session that expires first. Requires the lock.
+
+		Returns:
+			Union[Tuple[bytes, Session], None]: The hashed api key and the session, or None if there are no sessions
+		"""
+		while self._heap:
+			exp, key = heappop(self._heap)
+			session = self._sessions.get(key)
+			# entries of sessions that were logged out are skipped
+			if session is not None and session.exp == exp:
+				del self._sessions[key]
+				return key, session
+		return
+
+	def _remember_expired(self, key: bytes) -> None:
+		"""Remember that a session expired. Requires the lock.
+
+		Args:
+			key (bytes): The hashed api key of the session
+		"""
+		self._expired[key] = None
+		if len(self._expired) > EXPIRED_MEMORY:
+			self._expired.popitem(last=False)
+		return
+
+	def _sweep(self, now: float) -> None:
+		"""Evict all expired sessions from memory. Requires the lock.
+
+		Args:
+			now (float): The current epoch time
+		"""
+		while self._heap and self._heap[0][0] <= now:
+			popped = self._pop()
+			if popped is None:
+				break
+			key, session = popped
+			if session.exp > now:
+				# the first entry was stale; put the session back
+				self._sessions[key] = session
+				heappush(self._heap, (session.exp, key))
+				break
+			self._remember_expired(key)
+			self.expired += 1
+
+		# drop the entries of logged out sessions once they make up half the heap
+		if len(self._heap) > 2 * len(self._sessions) + 64:
+			self._heap = [(s.exp, k) for k, s in self._sessions.items()]
+			heapify(self._heap)
+		return
+
+	def sweep(self) -> None:
+		"""Evict all expired sessions. Shared sessions are kept for a ttl
+		longer, so that using them still gives ApiKeyExpired.
+		"""
+		now = time()
+		with self._lock:
+			self._sweep(now)
+			with self._db_lock:
+				if self._db is not None:
+					self._db.execute(
+						"DELETE FROM sessions WHERE exp <= ?;",
+						(now - self.ttl,)
+					)
+		return
+
+	def create(self, user_data: User) -> Tuple[str, float]:
+		"""Create a session
+
+		Args:
+			user_data (User): The user that logged in
+
+		Returns:
+			Tuple[str, float]: The api key (1) and the epoch time at which it expires (2)
+		"""
+		now = time()
+		with self._lock:
+			self._start()
+			self._sweep(now)
+			while len(self._sessions) >= self.max_sessions:
+				key, _ = self._pop()
+				self._remember_expired(key)
+				self.evicted += 1
+
+			while 1:
+				api_key = urandom(16).hex() # <- length api key / 2
+				key = _hash_api_key(api_key)
+				if not key in self._sessions:
+					break
+			exp = now + self.ttl
+			self._sessions[key] = Session(exp, user_data, monotonic())
+			heappush(self._heap, (exp, key))
+			self.created += 1
+
+			with self._db_lock:
+				if self._db is not None:
+					self._share(key, api_key, exp, user_data, now)
+		return api_key, exp
+
+	def _share(
+		self,
+		key: bytes,
+		api_key: str,
+		exp: float,
+		user_data: User,
+		now: float
+	) -> None:
+		"""Add a session to the shared table, evicting the sessions that
+		expire first if the table is full. Requires the lock and the db lock.
+
+		Args:
+			key (bytes): The hashed api key
+			api_key (str): The api key
+			exp (float): The epoch time at which the session expires
+			user_data (User): The user that logged in
+			now (float): The current epoch time
+		"""
+		db = self._db
+		db.execute("BEGIN IMMEDIATE;")
+		try:
+			live = db.execute(
+				"SELECT COUNT(*) FROM sessions WHERE exp > ?;", (now,)
+			).fetchone()[0]
+			if live >= self.max_sessions:
+				self.evicted += db.execute("""
+					DELETE FROM sessions
+					WHERE key IN (
+						SELECT key
+						FROM sessions
+						WHERE exp > ?
+						ORDER BY exp
+						LIMIT ?
+					);
+					""",
+					(now, live - self.max_sessions + 1)
+				).rowcount
+			db.execute(
+				"INSERT INTO sessions VALUES (?,?,?,?,?);",
+				(
+					key, exp, user_data.user_id, user_data.username,
+					_session_cipher(api_key).encrypt(user_data.key)
+				)
+			)
+			db.execute("COMMIT;")
+		except Exception:
+			db.execute("ROLLBACK;")
+			raise
+		return
+
+	def _get_shared(
+		self,
+		key: bytes,
+		api_key: str,
+		session: Union[Session, None]
+	) -> Session:
+		"""Check a session against the shared table and keep it in memory.
+		Doesn't require the lock; it's only taken to update the memory.
+
+		Args:
+			key (bytes): The hashed api key
+			api_key (str): The api key
+			session (Union[Session, None]): The session in memory, if any
+
+		Raises:
+			ApiKeyInvalid: There is no session with the api key
+			ApiKeyExpired: The session has expired
+
+		Returns:
+			Session: The session
+		"""
+		with self._db_lock:
+			row = None if self._db is None else self._db.execute(
+				"SELECT exp, user_id, username, encrypted_key FROM sessions WHERE key = ?;",
+				(key,)
+			).fetchone()
+
+		if row is None:
+			# logged out or evicted in another process
+			with self._lock:
+				self._sessions.pop(key, None)
+				if key in self._expired:
+					raise ApiKeyExpired
+			raise ApiKeyInvalid
+
+		exp, user_id, username, encrypted_key = row
+		if exp <= time():
+			raise ApiKeyExpired
+		if session is None:
+			session = Session(exp, User.restore(
+				username,
+				user_id,
+				_session_cipher(api_key).decrypt(encrypted_key, decode=False)
+			))
+
+		with self._lock:
+			current = self._sessions.get(key)
+			if current is None:
+				if session.checked:
+					# logged out or evicted in this process while checking
+					if key in self._expired:
+						raise ApiKeyExpired
+					raise ApiKeyInvalid
+				current = self._sessions[key] = session
+				heappush(self._heap, (exp, key))
+			current.checked = monotonic()
+		return current
+
+	def get(self, api_key: str) -> Tuple[bytes, Session]:
+		"""Get the session of an api key
+
+		Args:
+			api_key (str): The api key
+
+		Raises:
+			ApiKeyInvalid: There is no session with the api key
+			ApiKeyExpired: The session has expired
+
+		Returns:
+			Tuple[bytes, Session]: The hashed api key (1) and the session (2)
+		"""
+		key = _hash_api_key(api_key)
+		with self._lock:
+			session = self._sessions.get(key)
+			if session is not None:
+				if session.exp <= time():
+					raise ApiKeyExpired
+				if (self._db is None
+				or monotonic() - session.checked < SHARED_CHECK_INTERVAL):
+					return key, session
+			elif key in self._expired:
+				raise ApiKeyExpired
+			elif self._db is None:
+				raise ApiKeyInvalid
+		return key, self._get_shared(key, api_key, session)
+
+	def delete(self, key: bytes) -> None:
+		"""End a session
+
+		Args:
+			key (bytes): The hashed api key of the session
+		"""
+		with self._lock:
+			deleted = self._sessions.pop(key, None) is not None
+			with self._db_lock:
+				if self._db is not None:
+					deleted = self._db.execute(
+						"DELETE FROM sessions WHERE key = ?;", (key,)
+					).rowcount > 0
+			if deleted:
+				self.logged_out += 1
+		return
+
+	def stats(self) -> dict:
+		"""Get the statistics of the store. The counts are of this process;
+		with a shared table, 'live' is of all processes.
+
+		Returns:
+			dict: The amount of live sessions and of sessions created, logged out, expired and evicted because of the cap
+		"""
+		with self._db_lock:
+			if self._db is not None:
+				live = self._db.execute(
+					"SELECT COUNT(*) FROM sessions WHERE exp > ?;", (time(),)
+				).fetchone()[0]
+			else:
+				live = None
+		with self._lock:
+			if live is None:
+				live = len(self._sessions)
+			return {
+				'live': live,
+				'created': self.created,
+				'logged_out': self.logged_out,
+				'expired': self.expired,
+				'evicted': self.evicted
+			}
+
+	def stop(self) -> None:
+		"""Stop the sweeper
+		"""
+		with self._lock:
+			self._stop.set()
+			thread, self._thread = self._thread, None
+		if thread is not None:
+			thread.join()
+		with self._lock, self._db_lock:
+			if self._db is not None:
+				self._db.close()
+				self._db = None
+		return
+
+sessions = SessionStore()
@@ -1,12 +1,17 @@
 #-*- coding: utf-8 -*-
 
+from secrets import token_bytes
+from typing import Tuple
+
 from cryptography.fernet import InvalidToken
 
-from backend.custom_exceptions import (AccessUnauthorized, UsernameInvalid,
-                                       UsernameTaken, UserNotFound)
-from backend.db import get_db
-from backend.passwords import Vault
-from backend.security import Crypt, generate_key, get_hash
+from backend.custom_exceptions import (AccessUnauthorized, ServerBusy,
+                                       UsernameInvalid, UsernameTaken,
+                                       UserNotFound)
+from backend.db import Extended_Cursor, get_db, writer
+from backend.passwords import Vault, bump_vault_version
+from backend.security import (DEFAULT_KDF, KDF_ALGORITHMS, Crypt,
+                              generate_key, get_hash)
 
 ONEPASS_USERNAME_CHARACTERS = 'abcedfghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-.!@$'
 ONEPASS_INVALID_USERNAMES = ['users','api']
@@ -17,7 +22,11 @@ class User:
 	def __init__(self, username: str, master_password: str):
 		# fetch data of user to check if user exists and to check if password is correct
 		result = get_db(dict).execute(
-			"SELECT id, salt, encrypted_key FROM users WHERE username = ?", 
+			"""
+			SELECT id, salt, encrypted_key, kdf_algorithm, kdf_cost
+			FROM users
+			WHERE username = ?
+			""", 
 			(username,)
 		).fetchone()
 		if result is None:
@@ -26,7 +35,10 @@ class User:
 		self.user_id = result['id']
 
 		# check password
-		hash_master_password = get_hash(result['salt'], master_password)
+		hash_master_password = get_hash(
+			result['salt'], master_password,
+			result['kdf_algorithm'], result['kdf_cost']
+		)
 		try:
 			self.key = Crypt(hash_master_password).decrypt(
 				result['encrypted_key'], decode=False
@@ -34,7 +46,63 @@ class User:
 			self.salt = result['salt']
 		except InvalidToken:
 			raise AccessUnauthorized
-			
+
+		# upgrade to the key derivation function currently configured
+		kdf = get_kdf_params()
+		if (result['kdf_algorithm'], result['kdf_cost']) != kdf:
+			try:
+				self._rewrap_key(master_password, result['encrypted_key'], kdf)
+			except ServerBusy:
+				# try again on a next login
+				pass
+
+	def _rewrap_key(
+		self,
+		master_password: str,
+		old_encrypted_key: bytes,
+		kdf: Tuple[str, int]
+	) -> None:
+		"""Encrypt the key of the user with the master password hashed using
+		other key derivation parameters
+
+		Args:
+			master_password (str): The master password
+			old_encrypted_key (bytes): The currently stored encrypted key. Isn't replaced if it has been changed meanwhile.
+			kdf (Tuple[str, int]): The key derivation function and its cost
+		"""
+		salt = token_bytes()
+		encrypted_key = Crypt(get_hash(salt, master_password, *kdf)).encrypt(self.key)
+		updated = writer.execute(lambda cursor: cursor.execute(
+			"""
+			UPDATE users
+			SET salt = ?, encrypted_key = ?, kdf_algorithm = ?, kdf_cost = ?
+			WHERE id = ? AND encrypted_key = ?;
+			""",
+			(salt, encrypted_key, *kdf, self.user_id, old_encrypted_key)
+		).rowcount)
+		if updated:
+			self.salt = salt
+		return
+
+	@classmethod
+	def restore(cls, username: str, user_id: int, key: bytes) -> "User":
+		"""Get the user of a session that was started in another process,
+		without checking the master password again
+
+		Args:
+			username (str): The username of the user
+			user_id (int): The id of the user
+			key (bytes): The decrypted key of the vault of the user
+
+		Returns:
+			User: The user
+		"""
+		user = cls.__new__(cls)
+		user.username = username
+		user.user_id = user_id
+		user.key = key
+		return user
+
 	@property
 	def vault(self) -> Vault:
 		"""Get access to the vault of the user account
@@ -53,24 +121,63 @@ class User:
 			new_master_password (str): The new master password
 		"""		
 		#encrypt raw key with new password
-		hash_master_password = get_hash(self.salt, new_master_password)
+		kdf = get_kdf_params()
+		salt = token_bytes()
+		hash_master_password = get_hash(salt, new_master_password, *kdf)
 		encrypted_key = Crypt(hash_master_password).encrypt(self.key)
 
 		#update database
-		get_db().execute(
-			"UPDATE users SET encrypted_key = ? WHERE id = ?",
-			(encrypted_key, self.user_id)
-		)
+		writer.execute(lambda cursor: cursor.execute(
+			"""
+			UPDATE users
+			SET salt = ?, encrypted_key = ?, kdf_algorithm = ?, kdf_cost = ?
+			WHERE id = ?
+			""",
+			(salt, encrypted_key, *kdf, self.user_id)
+		))
+		self.salt = salt
 		return
 
 	def delete(self) -> None:
 		"""Delete the user account
 		"""		
-		cursor = get_db()
-		cursor.execute("DELETE FROM users WHERE id = ?", (self.user_id,))
-		cursor.execute("DELETE FROM vault WHERE user_id = ?", (self.user_id,))
+		def delete_user(cursor: Extended_Cursor) -> None:
+			cursor.execute("DELETE FROM vault WHERE user_id = ?", (self.user_id,))
+			cursor.execute("DELETE FROM vault_changes WHERE user_id = ?", (self.user_id,))
+			cursor.execute("DELETE FROM users WHERE id = ?", (self.user_id,))
+			return
+
+		writer.execute(delete_user)
+		bump_vault_version(self.user_id)
 		return
 
+def get_kdf_params() -> Tuple[str, int]:
+	"""Get the key derivation function and cost to hash master passwords with
+
+	Returns:
+		Tuple[str, int]: The name of the key derivation function (1) and its cost (2)
+	"""
+	config = dict(get_db().execute(
+		"SELECT key, value FROM config WHERE key IN ('kdf_algorithm', 'kdf_cost');"
+	).fetchall())
+	if not config.get('kdf_algorithm') in KDF_ALGORITHMS or not 'kdf_cost' in config:
+		return DEFAULT_KDF
+	return config['kdf_algorithm'], int(config['kdf_cost'])
+
+def set_kdf_params(algorithm: str, cost: int) -> None:
+	"""Set the key derivation function and cost to hash master passwords with.
+	Existing accounts are upgraded on their next login.
+
+	Args:
+		algorithm (str): The name of the key derivation function, one of KDF_ALGORITHMS
+		cost (int): The cost parameter of the key derivation function
+	"""
+	writer.execute(lambda cursor: cursor.executemany(
+		"INSERT OR REPLACE INTO config(key, value) VALUES (?, ?);",
+		(('kdf_algorithm', algorithm), ('kdf_cost', cost))
+	))
+	return
+
 def _check_username(username: str) -> None:
 	"""Check if username is valid
 
@@ -103,23 +210,27 @@ def register_user(username: str, password: str) -> int:
 	#check if username is valid
 	_check_username(username)
 
-	cursor = get_db()
-
 	#check if username isn't already taken
-	if cursor.exists("SELECT username FROM users WHERE username = ?", (username,)):
+	if get_db().exists("SELECT username FROM users WHERE username = ?", (username,)):
 		raise UsernameTaken
 
 	#generate salt and key exclusive for user
-	salt, encrypted_key = generate_key(password=password)
+	kdf = get_kdf_params()
+	salt, encrypted_key = generate_key(password, *kdf)
 	del password
 
-	#add user to userlist
-	user_id = cursor.execute(
-		"""
-		INSERT INTO users(username, salt, encrypted_key)
-		VALUES (?,?,?);
-		""",
-		(username, salt, encrypted_key)
-	).lastrowid
+	#add user to userlist, checking again as it could've been taken meanwhile
+	def add_user(cursor: Extended_Cursor) -> int:
+		if cursor.exists("SELECT username FROM users WHERE username = ?", (username,)):
+			raise UsernameTaken
+		return cursor.execute(
+			"""
+			INSERT INTO users(username, salt, encrypted_key, kdf_algorithm, kdf_cost)
+			VALUES (?,?,?,?,?);
+			""",
+			(username, salt, encrypted_key, *kdf)
+		).lastrowid
+
+	user_id = writer.execute(add_user)
 
 	return user_id
@@ -1,18 +1,28 @@
 #-*- coding: utf-8 -*-
 
-from os import urandom
-from time import time
+from io import BytesIO
+from json import dumps
 from typing import Any, Tuple, Union
 
-from flask import Blueprint, g, request
+from flask import (Blueprint, Response, g, make_response, request,
+                   stream_with_context)
 
-from backend.custom_exceptions import (AccessUnauthorized, KeyNotFound,
-                                       PasswordNotFound, UsernameInvalid,
-                                       UsernameTaken, UserNotFound)
+from backend.custom_exceptions import (AccessUnauthorized, ApiKeyExpired,
+                                       ApiKeyInvalid, BatchOperationFailed,
+                                       BatchTooLarge, CursorInvalid,
+                                       DatabaseUnavailable, ImportInvalid,
+                                       KeyNotFound, PasswordNotFound,
+                                       ServerBusy, TooManyRequests,
+                                       UsernameInvalid, UsernameTaken,
+                                       UserNotFound)
+from backend.importer import import_export
+from backend.passwords import CHANGES_PAGE_SIZE
+from backend.rate_limit import address_limiter, username_limiter
+from backend.security import kdf_executor
+from backend.sessions import sessions
 from backend.users import User, register_user
 
 api = Blueprint('api', __name__)
-api_key_map = {}
 
 """
 AUTHENTICATION:
@@ -22,27 +32,88 @@ AUTHENTICATION:
 
 	If no api key is supplied or it is invalid, 401 'ApiKeyInvalid' is returned.
 	If the api key supplied has expired, 401 'ApiKeyExpired' is returned.
+
+CACHING:
+	GET /vault, GET /vault/search, GET /vault/changes and GET /vault/<pw_id> return an ETag header that changes whenever the vault changes.
+	Send it back in the If-None-Match header to get 304 with an empty body when the vault is unchanged.
+
+ERRORS:
+	If a change could not be saved in time because the database is too busy, 503 'DatabaseUnavailable' is returned.
+	If all database connections stay in use for too long or the database stays locked by another process, 429 'ServerBusy' is returned with a Retry-After header.
 """
 
-def return_api(result: Any, error: str=None, code: int=200) -> Tuple[dict, int]:
-	return {'error': error, 'result': result}, code
+def return_api(result: Any, error: str=None, code: int=200, headers: dict=None) -> Tuple[dict, int, dict]:
+	return {'error': error, 'result': result}, code, headers or {}
 
 def auth(method):
 	"""Used as decorator and, if applied to route, restricts the route to authorized users and supplies user specific info
 	"""
 	def wrapper(*args,**kwargs):
-		hashed_api_key = hash(request.values.get('api_key',''))
-		if not hashed_api_key in api_key_map:
-			return return_api({}, 'ApiKeyInvalid', 401)
-		
-		exp = api_key_map[hashed_api_key]['exp']
-		if exp <= time():
-			return return_api({}, 'ApiKeyExpired', 401)
+		try:
+			hashed_api_key, session = sessions.get(request.values.get('api_key',''))
+		except (ApiKeyInvalid, ApiKeyExpired) as e:
+			return return_api(**e.api_response)
 		
 		# Api key valid
 		g.hashed_api_key = hashed_api_key
-		g.exp = exp
-		g.user_data = api_key_map[hashed_api_key]['user_data']
+		g.exp = session.exp
+		g.user_data = session.user_data
+		return method(*args, **kwargs)
+
+	wrapper.__name__ = method.__name__
+	return wrapper
+
+def read_only(method):
+	"""Used as decorator and, if applied to route, makes GET requests to the route use a read-only database connection
+	"""
+	def wrapper(*args, **kwargs):
+		if request.method == 'GET':
+			g.db_read_only = True
+		return method(*args, **kwargs)
+
+	wrapper.__name__ = method.__name__
+	return wrapper
+
+def vault_etag(method):
+	"""Used as decorator and, if applied to route, tags the responses to GET requests with the version of the vault (ETag) and answers 304 without reading the vault when the client sends the current tag in If-None-Match
+	"""
+	def wrapper(*args, **kwargs):
+		if request.method != 'GET':
+			return method(*args, **kwargs)
+
+		tag = g.user_data.vault.etag()
+		if request.if_none_match.contains_weak(tag):
+			response = make_response('', 304)
+		else:
+			response = make_response(method(*args, **kwargs))
+			if response.status_code != 200:
+				return response
+		response.set_etag(tag)
+		response.headers['Cache-Control'] = 'private, no-cache'
+		return response
+
+	wrapper.__name__ = method.__name__
+	return wrapper
+
+def admission_control(method):
+	"""Used as decorator and, if applied to route, rejects the request before doing any work when the client address, or the client address for the username given, has made too many attempts lately, or when the server is too busy hashing master passwords. The username is limited per address, so that others can't lock a user out.
+	"""
+	def wrapper(*args, **kwargs):
+		retry_after = address_limiter.acquire(request.remote_addr)
+		if retry_after:
+			raise TooManyRequests(retry_after)
+
+		data = request.get_json(silent=True)
+		if isinstance(data, dict) and isinstance(data.get('username'), str):
+			retry_after = username_limiter.acquire(
+				(data['username'], request.remote_addr)
+			)
+			if retry_after:
+				raise TooManyRequests(retry_after)
+
+		if not kdf_executor.has_capacity():
+			raise ServerBusy(kdf_executor.retry_after())
+
 		return method(*args, **kwargs)
 
 	wrapper.__name__ = method.__name__
@@ -55,7 +126,9 @@ def error_handler(method):
 		try:
 			return method(*args, **kwargs)
 		except (UsernameTaken, UsernameInvalid, UserNotFound,
-				AccessUnauthorized, PasswordNotFound, KeyNotFound) as e:
+				AccessUnauthorized, PasswordNotFound, KeyNotFound,
+				CursorInvalid, ImportInvalid, BatchOperationFailed,
+				TooManyRequests, DatabaseUnavailable, BatchTooLarge) as e:
 			return return_api(**e.api_response)
 
 	wrapper.__name__ = method.__name__
@@ -77,6 +150,7 @@ def check_keys(data: Union[dict, str, None], keys: Tuple[str,...]) -> None:
 
 @api.route('/auth/login', methods=['POST'])
 @error_handler
+@admission_control
 def api_login():
 	"""
 	Endpoint: /auth/login
@@ -96,6 +170,9 @@ def api_login():
 					PasswordInvalid: The password given is not correct for the user account
 				404:
 					UsernameNotFound: The username was not found
+				429:
+					TooManyRequests: Too many attempts from this address, or for this username from this address; the Retry-After header holds the seconds to wait
+					ServerBusy: Too many logins and registrations are being processed; the Retry-After header holds the seconds to wait
 	"""
 	data = request.get_json()
 
@@ -106,18 +183,7 @@ def api_login():
 	user = User(data['username'], data['master_password'])
 
 	#login valid
-	while 1:
-		api_key = urandom(16).hex() # <- length api key / 2
-		hashed_api_key = hash(api_key)
-		if not hashed_api_key in api_key_map:
-			break
-	exp = time() + 3600
-	api_key_map.update({
-		hashed_api_key: {
-			'exp': exp,
-			'user_data': user
-		}
-	})
+	api_key, exp = sessions.create(user)
 
 	result = {'api_key': api_key, 'expires': exp}
 	return return_api(result)
@@ -136,12 +202,13 @@ def api_logout():
 				200:
 					Logout successful
 	"""
-	api_key_map.pop(g.hashed_api_key)
+	sessions.delete(g.hashed_api_key)
 	return return_api({})
 
 @api.route('/auth/status', methods=['GET'])
 @error_handler
 @auth
+@read_only
 def api_status():
 	"""
 	Endpoint: /auth/status
@@ -154,8 +221,8 @@ def api_status():
 					The username of the logged in account and the expiration time of the api key (epoch)
 	"""
 	result = {
-		'expires': api_key_map[g.hashed_api_key]['exp'],
-		'username': api_key_map[g.hashed_api_key]['user_data'].username
+		'expires': g.exp,
+		'username': g.user_data.username
 	}
 	return return_api(result)
 
@@ -165,6 +232,7 @@ def api_status():
 
 @api.route('/user/add', methods=['POST'])
 @error_handler
+@admission_control
 def api_add_user():
 	"""
 	Endpoint: /user/add
@@ -182,6 +250,9 @@ def api_add_user():
 					KeyNotFound: One of the required parameters was not given
 					UsernameInvalid: The username given is not allowed
 					UsernameTaken: The username given is already in use
+				429:
+					TooManyRequests: Too many attempts from this address, or for this username from this address; the Retry-After header holds the seconds to wait
+					ServerBusy: Too many logins and registrations are being processed; the Retry-After header holds the seconds to wait
 	"""
 	data = request.get_json()
 
@@ -210,6 +281,8 @@ def api_manage_user():
 					Password updated successfully
 				400:
 					KeyNotFound: One of the required parameters was not given
+				429:
+					ServerBusy: Too many logins and registrations are being processed; the Retry-After header holds the seconds to wait
 		DELETE:
 			Description: Delete the user account
 			Returns:
@@ -229,7 +302,7 @@ def api_manage_user():
 	elif request.method == 'DELETE':
 		#delete user
 		g.user_data.delete()
-		api_key_map.pop(g.hashed_api_key)
+		sessions.delete(g.hashed_api_key)
 		return return_api({})
 
 #===================
@@ -239,6 +312,8 @@ def api_manage_user():
 @api.route('/vault', methods=['GET','POST'])
 @error_handler
 @auth
+@read_only
+@vault_etag
 def api_vault_list():
 	"""
 	Endpoint: /vault
@@ -249,9 +324,16 @@ def api_vault_list():
 			Description: Get the contents of the vault
 			Parameters (url):
 				sort_by: how to sort the result. Allowed values are 'title', 'title_reversed', 'date_added' and 'date_added_reversed'
+				limit: return the result in pages of this size
+				cursor: the next_cursor returned with the previous page
 			Returns:
 				200:
-					The id, title, url and username of every password in the vault
+					The id, title, url and username of every password in the vault.
+					When limit is given, an object with the entries on the page ('entries') and the cursor for the next page ('next_cursor', null on the last page)
+				304:
+					The vault hasn't changed since the response with the ETag given in the If-None-Match header
+				400:
+					CursorInvalid: The cursor given is not valid
 		POST:
 			Description: Add a password to the vault
 			Parameters (body (content-type: application/json)):
@@ -267,7 +349,16 @@ def api_vault_list():
 	"""
 	if request.method == 'GET':
 		sort_by = request.values.get('sort_by','title')
-		result = g.user_data.vault.fetchall(sort_by=sort_by)
+		limit = request.values.get('limit', type=int)
+		if limit is None:
+			result = g.user_data.vault.fetchall(sort_by=sort_by)
+		else:
+			entries, next_cursor = g.user_data.vault.fetchpage(
+				sort_by,
+				max(limit, 1),
+				request.values.get('cursor')
+			)
+			result = {'entries': entries, 'next_cursor': next_cursor}
 		return return_api(result)
 	
 	elif request.method == 'POST':
@@ -283,6 +374,8 @@ def api_vault_list():
 @api.route('/vault/search', methods=['GET'])
 @error_handler
 @auth
+@read_only
+@vault_etag
 def api_vault_query():
 	"""
 	Endpoint: /vault/search
@@ -291,22 +384,97 @@ def api_vault_query():
 	Methods:
 		GET:
 			Parameters (url):
-				query (required): The search term
+				query (required): The search term. It matches anywhere in the title, username or url
+				limit: return the results in pages of this size
+				cursor: the next_cursor returned with the previous page
 			Returns:
 				200:
-					The search results, listed like GET /vault
+					The search results, listed like GET /vault, best match first
+				304:
+					The vault hasn't changed since the response with the ETag given in the If-None-Match header
 				400:
 					KeyNotFound: One of the required parameters was not given
+					CursorInvalid: The cursor given is not valid
 	"""
 	query = request.values.get('query')
 	check_keys(query, ('query',))
+	limit = request.values.get('limit', type=int)
 
-	result = g.user_data.vault.search(query)
+	if limit is None:
+		result = g.user_data.vault.search(query)
+	else:
+		entries, next_cursor = g.user_data.vault.searchpage(
+			query,
+			max(limit, 1),
+			request.values.get('cursor')
+		)
+		result = {'entries': entries, 'next_cursor': next_cursor}
+	return return_api(result)
+
+@api.route('/vault/changes', methods=['GET'])
+@error_handler
+@auth
+@read_only
+@vault_etag
+def api_vault_changes():
+	"""
+	Endpoint: /vault/changes
+	Description: Get what changed in the vault since the last sync, to keep a local copy of the vault up to date
+	Requires being logged in: Yes
+	Methods:
+		GET:
+			Parameters (url):
+				since: the 'since' returned by the previous sync. Leave out or give 0 for the first sync.
+				limit: the maximum amount of changes to return
+			Returns:
+				200:
+					The id, title, url and username of the entries added or updated since then ('entries'), the ids of the entries deleted since then ('deleted'), the value to give as since on the next sync ('since') and wether there are more changes waiting ('more').
+					When 'reset' is true, the entries are the whole vault and replace the local copy. This happens on the first sync and when the last sync is too long ago.
+				304:
+					The vault hasn't changed since the response with the ETag given in the If-None-Match header
+	"""
+	since = request.values.get('since', 0, type=int)
+	limit = request.values.get('limit', CHANGES_PAGE_SIZE, type=int)
+	result = g.user_data.vault.changes(max(since, 0), max(limit, 1))
+	return return_api(result)
+
+@api.route('/vault/batch', methods=['POST'])
+@error_handler
+@auth
+def api_vault_batch():
+	"""
+	Endpoint: /vault/batch
+	Description: Add, edit and delete multiple password entries in one go. All operations are done in one transaction: either all of them succeed or none of them are done.
+	Requires being logged in: Yes
+	Methods:
+		POST:
+			Parameters (body (content-type: application/json)):
+				operations (required): list of at most 500 operations. Each operation has an action and the parameters of that action:
+					'add': title (required), url, username, password, like POST /vault
+					'update': id (required) and the fields to change (title, url, username, password). Fields not given are left unchanged.
+					'delete': id (required)
+			Returns:
+				200:
+					A list with the result of each operation: all info about the password entry for 'add' and 'update', an empty object for 'delete'
+				400:
+					KeyNotFound: One of the required parameters was not given. For an operation, the result holds the index of the operation.
+					BatchTooLarge: More operations were given than are allowed in one batch. The result holds the maximum ('max_operations').
+				404:
+					PasswordNotFound: No password entry found in the vault with the id of an operation. The result holds the index of the operation.
+	"""
+	data = request.get_json()
+	check_keys(data, ('operations',))
+	if not isinstance(data['operations'], list):
+		raise KeyNotFound('operations')
+
+	result = g.user_data.vault.batch(data['operations'])
 	return return_api(result)
 
 @api.route('/vault/<pw_id>', methods=['GET','PUT','DELETE'])
 @error_handler
 @auth
+@read_only
+@vault_etag
 def api_get_password(pw_id: int):
 	"""
 	Endpoint: /vault/<pw_id>
@@ -320,6 +488,8 @@ def api_get_password(pw_id: int):
 			Returns:
 				200:
 					All info about the password entry
+				304:
+					The vault hasn't changed since the response with the ETag given in the If-None-Match header
 				404:
 					No password entry found in the vault with the given id
 		PUT:
@@ -361,6 +531,7 @@ def api_get_password(pw_id: int):
 @api.route('/vault/<pw_id>/check', methods=['GET'])
 @error_handler
 @auth
+@read_only
 def api_check_password(pw_id: int):
 	"""
 	Endpoint: /vault/<pw_id>/check
@@ -373,9 +544,111 @@ def api_check_password(pw_id: int):
 		GET:
 			Returns:
 				200:
-					The results are in on the password
+					The results are in on the password. 'common_passwords_loaded' is false while the list of most used passwords is still being loaded
 				404:
 					No password entry found in the vault with the given id
 	"""
 	result = g.user_data.vault.fetchone(pw_id).check()
 	return return_api(result)
+
+@api.route('/vault/check', methods=['GET'])
+@error_handler
+@auth
+@read_only
+def api_check_vault():
+	"""
+	Endpoint: /vault/check
+	Description: Check how good all passwords in the vault are
+	Requires being logged in: Yes
+	Methods:
+		GET:
+			Returns:
+				200:
+					A stream of newline delimited json (content-type: application/x-ndjson), one line per password entry as soon as its check is done. Each line holds the id of the entry and the results like GET /vault/<pw_id>/check, or the error 'CheckFailed'. Entries without a password are skipped.
+	"""
+	results = g.user_data.vault.check_all()
+	return Response(
+		(dumps(result) + '\n' for result in results),
+		mimetype='application/x-ndjson'
+	)
+
+@api.route('/vault/export', methods=['GET'])
+@error_handler
+@auth
+def api_export_vault():
+	"""
+	Endpoint: /vault/export
+	Description: Export all passwords in the vault
+	Requires being logged in: Yes
+	Methods:
+		GET:
+			Parameters (url):
+				format: 'ndjson' for the decrypted entries or 'encrypted' for a backup that can only be decrypted with the master password. Defaults to 'ndjson'.
+			Returns:
+				200:
+					A stream of newline delimited json (content-type: application/x-ndjson), sent as an attachment, one line per password entry in order of date added.
+					'ndjson': the id, title, url, username and password of each entry.
+					'encrypted': first a header with the salt, the encrypted key and the key derivation function and cost of the user, then the entries as stored in the database (fernet tokens). The key is decrypted with the base64 encoded hash of the master password (pbkdf2_sha256: cost is the amount of iterations, scrypt: cost is N, r=8, p=1) and the fields with the key.
+	"""
+	encrypted = request.values.get('format', 'ndjson') == 'encrypted'
+	entries = g.user_data.vault.export(encrypted=encrypted)
+	return Response(
+		(dumps(entry) + '\n' for entry in entries),
+		mimetype='application/x-ndjson',
+		headers={'Content-Disposition': 'attachment; filename="Onepass_{}.ndjson"'.format(
+			'backup' if encrypted else 'export'
+		)}
+	)
+
+@api.route('/vault/import', methods=['POST'])
+@error_handler
+@auth
+def api_import_vault():
+	"""
+	Endpoint: /vault/import
+	Description: Import the export of another password manager into the vault
+	Requires being logged in: Yes
+	Methods:
+		POST:
+			Parameters (url):
+				format (optional): 'csv' or 'json'. Defaults to the type of the uploaded file or body
+			Parameters (body):
+				The export as the raw body or as the multipart file 'file'. CSV exports need a header row; JSON exports are a list of entries or an object with the entries under 'items'. Columns/keys that are recognised: title/name, url/login_uri/website, username/login_username, password/login_password.
+			Returns:
+				200:
+					A stream of newline delimited json (content-type: application/x-ndjson) with the amount of imported and skipped entries after each batch. The last line has 'done' set to true. If the export turns out to be invalid halfway, the last line has the error 'ImportInvalid' instead; the entries before it stay imported.
+				400:
+					ImportInvalid: The export is not valid CSV or JSON or has no entries
+	"""
+	upload = request.files.get('file')
+	if upload is not None:
+		# take over the spooled upload; files of the request are closed
+		# when the request ends, which is before the import has streamed
+		stream, mimetype, filename = upload.stream, upload.mimetype, upload.filename or ''
+		upload.stream = BytesIO()
+	else:
+		stream, mimetype, filename = request.stream, request.mimetype, ''
+
+	format = request.values.get('format')
+	if format is None:
+		is_json = mimetype.endswith('json') or filename.lower().endswith('.json')
+		format = 'json' if is_json else 'csv'
+	if not format in ('csv', 'json'):
+		raise ImportInvalid
+
+	progress = import_export(g.user_data.vault, stream, format)
+
+	def lines():
+		try:
+			for result in progress:
+				yield dumps(result) + '\n'
+		except ImportInvalid as e:
+			yield dumps({'error': e.api_response['error'], 'result': {}}) + '\n'
+		finally:
+			if upload is not None:
+				stream.close()
+
+	return Response(
+		stream_with_context(lines()),
+		mimetype='application/x-ndjson'
+	)
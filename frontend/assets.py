@@ -0,0 +1,265 @@
+#-*- coding: utf-8 -*-
+
+"""
+Build step and serving of the static files.
+
+The build copies the files in frontend/static to frontend/build under a name
+that contains a hash of their content, so that browsers can cache them
+forever. References to other static files in CSS and JS are rewritten to
+the fingerprinted names. Text files get a gzip variant (and a brotli variant
+if the brotli module is installed). When Pillow is installed, photos are
+resized to at most IMAGE_MAX_WIDTH pixels wide and also saved as WebP.
+
+Run the build after changing static files:
+	python3 -m frontend.assets
+
+Without a build, the templates refer to the files in frontend/static.
+"""
+
+from gzip import compress as gzip_compress
+from hashlib import blake2b
+from io import BytesIO
+from json import dump, load
+from mimetypes import guess_type
+from os import makedirs, walk
+from os.path import dirname, exists, join, relpath, splitext
+from re import compile
+from shutil import rmtree
+from typing import Dict, Union
+
+from flask import Blueprint, request, send_from_directory
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
+
+STATIC_FOLDER = join(dirname(__file__), 'static')
+BUILD_FOLDER = join(dirname(__file__), 'build')
+MANIFEST_FILENAME = 'manifest.json'
+FINGERPRINT_SIZE = 5 # bytes
+ASSET_MAX_AGE = 365 * 24 * 60 * 60 # seconds
+TEXT_EXTENSIONS = ('.css', '.js', '.svg')
+PHOTO_EXTENSIONS = ('.jpeg', '.jpg', '.png')
+IMAGE_MAX_WIDTH = 2560 # pixels
+IMAGE_QUALITY = 80
+# the variants of a file and the encoding to send them with, best first
+ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'))
+STATIC_REFERENCE = compile(r'/static/([\w./-]+)')
+CSS_BACKGROUND = compile(r'(\n(\s*)background-image: url\(/static/([\w./-]+)\);)')
+
+assets = Blueprint('assets', __name__)
+
+_manifest: Union[Dict[str, str], None] = None
+
+def _fingerprinted(path: str, content: bytes) -> str:
+	"""Get the name of a file with a hash of its content in it
+
+	Args:
+		path (str): The path of the file, relative to the static folder
+		content (bytes): The content of the file
+
+	Returns:
+		str: The path with the hash added before the extension
+	"""
+	root, extension = splitext(path)
+	digest = blake2b(content, digest_size=FINGERPRINT_SIZE).hexdigest()
+	return f'{root}.{digest}{extension}'
+
+def _write(manifest: Dict[str, str], path: str, content: bytes) -> None:
+	"""Write a file to the build folder under its fingerprinted name
+
+	Args:
+		manifest (Dict[str, str]): The manifest to add the file to
+		path (str): The path of the file, relative to the static folder
+		content (bytes): The content of the file
+	"""
+	built = _fingerprinted(path, content)
+	target = join(BUILD_FOLDER, built)
+	makedirs(dirname(target), exist_ok=True)
+	with open(target, 'wb') as f:
+		f.write(content)
+
+	if path.endswith(TEXT_EXTENSIONS):
+		with open(target + '.gz', 'wb') as f:
+			f.write(gzip_compress(content, 9))
+		if brotli is not None:
+			with open(target + '.br', 'wb') as f:
+				f.write(brotli.compress(content))
+
+	manifest[path] = built
+	return
+
+def _build_photo(manifest: Dict[str, str], path: str, content: bytes) -> None:
+	"""Add a resized version of a photo and a WebP variant to the build
+
+	Args:
+		manifest (Dict[str, str]): The manifest to add the files to
+		path (str): The path of the photo, relative to the static folder
+		content (bytes): The content of the photo
+	"""
+	image = Image.open(BytesIO(content))
+	if image.width > IMAGE_MAX_WIDTH:
+		image = image.resize(
+			(IMAGE_MAX_WIDTH, round(image.height * IMAGE_MAX_WIDTH / image.width)),
+			Image.LANCZOS
+		)
+
+	output = BytesIO()
+	if path.endswith('.png'):
+		image.save(output, 'PNG', optimize=True)
+	else:
+		image.convert('RGB').save(
+			output, 'JPEG', quality=IMAGE_QUALITY, optimize=True, progressive=True
+		)
+	# keep the original if it's already smaller
+	_write(manifest, path, min(output.getvalue(), content, key=len))
+
+	output = BytesIO()
+	image.save(output, 'WEBP', quality=IMAGE_QUALITY)
+	_write(manifest, splitext(path)[0] + '.webp', output.getvalue())
+	return
+
+def _rewrite(manifest: Dict[str, str], text: str) -> str:
+	"""Point the references to static files in CSS or JS to the built files.
+	Backgrounds that have a WebP variant offer it to browsers that support it.
+
+	Args:
+		manifest (Dict[str, str]): The manifest of the files built so far
+		text (str): The CSS or JS
+
+	Returns:
+		str: The rewritten CSS or JS
+	"""
+	def add_webp(match) -> str:
+		declaration, indent, path = match.groups()
+		webp = manifest.get(splitext(path)[0] + '.webp')
+		if webp is None or not path in manifest:
+			return declaration
+		# browsers that don't support image-set() keep the first declaration
+		return (
+			f'{declaration}\n{indent}background-image: image-set('
+			f'url(/static/{splitext(path)[0]}.webp) type("image/webp"), '
+			f'url(/static/{path}) type("{guess_type(path)[0]}"));'
+		)
+
+	text = CSS_BACKGROUND.sub(add_webp, text)
+	return STATIC_REFERENCE.sub(
+		lambda m: asset_url(m.group(1), manifest),
+		text
+	)
+
+def build() -> Dict[str, str]:
+	"""Build the static files into the build folder
+
+	Returns:
+		Dict[str, str]: The manifest: the fingerprinted path of each file, by original path
+	"""
+	if exists(BUILD_FOLDER):
+		rmtree(BUILD_FOLDER)
+	makedirs(BUILD_FOLDER)
+
+	paths = sorted(
+		relpath(join(folder, name), STATIC_FOLDER).replace('\\', '/')
+		for folder, _, names in walk(STATIC_FOLDER)
+		for name in names
+	)
+	# files that refer to others are built after them
+	paths.sort(key=lambda p: p.endswith(('.css', '.js')))
+
+	manifest = {}
+	for path in paths:
+		with open(join(STATIC_FOLDER, path), 'rb') as f:
+			content = f.read()
+
+		if path.endswith(('.css', '.js')):
+			content = _rewrite(manifest, content.decode()).encode()
+		elif path.endswith(PHOTO_EXTENSIONS) and Image is not None:
+			_build_photo(manifest, path, content)
+			continue
+		_write(manifest, path, content)
+
+	with open(join(BUILD_FOLDER, MANIFEST_FILENAME), 'w') as f:
+		dump(manifest, f, indent=4, sort_keys=True)
+	return manifest
+
+def load_manifest() -> None:
+	"""Start using the built files, if they have been built
+	"""
+	global _manifest
+	manifest_file = join(BUILD_FOLDER, MANIFEST_FILENAME)
+	if exists(manifest_file):
+		with open(manifest_file, 'r') as f:
+			_manifest = load(f)
+	else:
+		_manifest = None
+	return
+
+def asset_url(path: str, manifest: Union[Dict[str, str], None] = None) -> str:
+	"""Get the url of a static file. Used in the templates.
+
+	Args:
+		path (str): The path of the file, relative to the static folder
+		manifest (Union[Dict[str, str], None], optional): The manifest to look the file up in. Defaults to None, which means the manifest of the build.
+
+	Returns:
+		str: The url of the built file, or of the original file if it hasn't been built
+	"""
+	if manifest is None:
+		manifest = _manifest
+	if manifest is not None and path in manifest:
+		return '/assets/' + manifest[path]
+	return '/static/' + path
+
+@assets.app_template_global('asset_url')
+def _asset_url(path: str) -> str:
+	return asset_url(path)
+
+@assets.route('/assets/<path:filename>', methods=['GET'])
+def serve_asset(filename: str):
+	"""Serve a built file, precompressed if the client accepts it. The name
+	changes when the content does, so it may be cached forever.
+	"""
+	mimetype = guess_type(filename)[0]
+	suffix, encoding = '', None
+	if filename.endswith(TEXT_EXTENSIONS):
+		for variant_suffix, variant_encoding in ENCODINGS:
+			if (request.accept_encodings[variant_encoding]
+			and exists(join(BUILD_FOLDER, filename + variant_suffix))):
+				suffix, encoding = variant_suffix, variant_encoding
+				break
+
+	response = send_from_directory(
+		BUILD_FOLDER,
+		filename + suffix,
+		mimetype=mimetype,
+		max_age=ASSET_MAX_AGE
+	)
+	response.cache_control.public = True
+	response.cache_control.immutable = True
+	if filename.endswith(TEXT_EXTENSIONS):
+		response.vary.add('Accept-Encoding')
+	if encoding is not None:
+		response.headers['Content-Encoding'] = encoding
+	return response
+
+if __name__ == '__main__':
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser(
+		prog='python3 -m frontend.assets',
+		description='Build the static files: fingerprint them and generate compressed and resized variants'
+	)
+	parser.parse_args()
+
+	if Image is None:
+		print('Pillow is not installed; images are copied as is')
+	if brotli is None:
+		print('brotli is not installed; only gzip variants are made')
+	manifest = build()
+	print(f'Built {len(manifest)} files into {BUILD_FOLDER}')
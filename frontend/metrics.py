@@ -0,0 +1,167 @@
+#-*- coding: utf-8 -*-
+
+from time import perf_counter
+
+from flask import Blueprint, Response, current_app, g, request
+
+from backend.db import pool, read_pool, writer
+from backend.metrics import Counter, Gauge, Histogram, render
+from backend.range_cache import range_cache
+from backend.rate_limit import address_limiter, username_limiter
+from backend.security import kdf_executor
+from backend.sessions import sessions
+from frontend.responses import response_stats
+
+metrics = Blueprint('metrics', __name__)
+
+request_seconds = Histogram(
+	'onepass_http_request_duration_seconds',
+	'Time until the response to a request is ready to be sent',
+	('route', 'method')
+)
+requests_handled = Counter(
+	'onepass_http_requests',
+	'Requests handled',
+	('route', 'method', 'status')
+)
+
+def start_timer() -> None:
+	"""Note when the handling of a request started. Used as before_request function.
+	"""
+	g.request_start = perf_counter()
+	return
+
+def record_request(response: Response) -> Response:
+	"""Record how long the handling of a request took. Used as after_request function.
+
+	Args:
+		response (Response): The response
+
+	Returns:
+		Response: The same response
+	"""
+	start = g.get('request_start')
+	if start is not None:
+		route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+		request_seconds.observe(perf_counter() - start, route, request.method)
+		requests_handled.inc(route, request.method, str(response.status_code))
+	return response
+
+def _pool_stats(key: str) -> dict:
+	"""Get a statistic of both connection pools
+
+	Args:
+		key (str): The statistic
+
+	Returns:
+		dict: The value per pool
+	"""
+	write_stats, read_stats = pool.stats(), read_pool.stats()
+	return {('write',): write_stats[key], ('read',): read_stats[key]}
+
+def _db_connections() -> dict:
+	"""Get the amount of connections checked out and idle in both pools
+
+	Returns:
+		dict: The amount per pool and state
+	"""
+	connections = {}
+	for name, stats in (('write', pool.stats()), ('read', read_pool.stats())):
+		connections[(name, 'checked_out')] = stats['checked_out']
+		connections[(name, 'idle')] = stats['idle']
+	return connections
+
+def _response_bytes() -> dict:
+	"""Get the bytes of response bodies before and after compression
+
+	Returns:
+		dict: The bytes per endpoint and stage
+	"""
+	result = {}
+	for endpoint, stats in response_stats.stats().items():
+		result[(endpoint, 'uncompressed')] = stats['bytes']
+		result[(endpoint, 'sent')] = stats['bytes_sent']
+	return result
+
+Gauge(
+	'onepass_sessions_live',
+	'Sessions that have not expired',
+	lambda: sessions.stats()['live']
+)
+Gauge(
+	'onepass_db_connections',
+	'Database connections in the pools',
+	_db_connections,
+	('pool', 'state')
+)
+Gauge(
+	'onepass_db_connection_waits',
+	'Times a request had to wait for a free database connection',
+	lambda: _pool_stats('waits'),
+	('pool',),
+	type='counter'
+)
+Gauge(
+	'onepass_db_write_queue_depth',
+	'Database writes waiting for the writer thread',
+	writer.depth
+)
+Gauge(
+	'onepass_db_write_transactions',
+	'Transactions committed by the writer thread',
+	lambda: writer.batches,
+	type='counter'
+)
+Gauge(
+	'onepass_db_writes',
+	'Writes committed by the writer thread',
+	lambda: writer.writes,
+	type='counter'
+)
+Gauge(
+	'onepass_kdf_pending',
+	'Master password hashes running or waiting for a worker',
+	lambda: kdf_executor.stats()['pending']
+)
+Gauge(
+	'onepass_kdf_rejected',
+	'Master password hashes refused because too many were pending',
+	lambda: kdf_executor.stats()['rejected'],
+	type='counter'
+)
+Gauge(
+	'onepass_rate_limited',
+	'Logins and registrations refused by a rate limiter',
+	lambda: {
+		('address',): address_limiter.stats()['rejected'],
+		('username',): username_limiter.stats()['rejected']
+	},
+	('limiter',),
+	type='counter'
+)
+Gauge(
+	'onepass_breach_range_cache_lookups',
+	'Lookups in the cache of pwnedpasswords.com ranges',
+	lambda: {
+		('hit',): range_cache.stats()['hits'],
+		('miss',): range_cache.stats()['misses']
+	},
+	('result',),
+	type='counter'
+)
+Gauge(
+	'onepass_http_response_bytes',
+	'Bytes of response bodies, before compression and as sent',
+	_response_bytes,
+	('endpoint', 'stage'),
+	type='counter'
+)
+
+@metrics.route('/metrics', methods=['GET'])
+def metrics_page():
+	"""Get the metrics in the Prometheus text format. Served on it's own
+	listener, so that it isn't exposed to the users of the vault.
+	"""
+	worker = current_app.config.get('METRICS_WORKER')
+	labels = {'worker': str(worker)} if worker is not None else None
+	return Response(render(labels), mimetype='text/plain; version=0.0.4')
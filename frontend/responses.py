@@ -0,0 +1,172 @@
+#-*- coding: utf-8 -*-
+
+"""
+Serializing and compressing responses.
+
+The JSON provider gives compact output and uses orjson when it's installed,
+which is several times faster than the json module. Responses with a body
+of at least COMPRESS_MIN_SIZE bytes are compressed with gzip or deflate when
+the client accepts it. The amount of bytes sent is counted per endpoint.
+"""
+
+from gzip import compress as gzip_compress
+from threading import Lock
+from typing import Any, Dict, List
+from zlib import compress as deflate_compress
+
+from flask import Response, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+COMPACT_SEPARATORS = (',', ':')
+COMPRESS_MIN_SIZE = 1024 # bytes
+COMPRESS_LEVEL = 6
+COMPRESSIBLE_MIMETYPES = (
+	'application/json', 'application/x-ndjson', 'application/javascript'
+)
+ENCODERS = {
+	'gzip': lambda data: gzip_compress(data, COMPRESS_LEVEL),
+	'deflate': lambda data: deflate_compress(data, COMPRESS_LEVEL)
+}
+
+class CompactJSONProvider(DefaultJSONProvider):
+	"""JSON provider that always gives compact output, with the keys in the
+	order they were added
+	"""
+	compact = True
+	sort_keys = False
+	ensure_ascii = False
+
+	def _dumps_bytes(self, obj: Any) -> bytes:
+		"""Serialize data as compact JSON
+
+		Args:
+			obj (Any): The data to serialize
+
+		Returns:
+			bytes: The UTF-8 encoded JSON
+		"""
+		if orjson is not None:
+			try:
+				return orjson.dumps(obj, default=self.default)
+			except TypeError:
+				# e.g. integers that don't fit in 64 bits
+				pass
+		return super().dumps(obj, separators=COMPACT_SEPARATORS).encode()
+
+	def dumps(self, obj: Any, **kwargs) -> str:
+		"""Serialize data as JSON. Only output without extra arguments (other
+		than the compact separators) is done by the faster encoder.
+
+		Args:
+			obj (Any): The data to serialize
+
+		Returns:
+			str: The JSON
+		"""
+		if kwargs.get('separators', COMPACT_SEPARATORS) == COMPACT_SEPARATORS and (
+			not kwargs.keys() - {'separators'}
+		):
+			return self._dumps_bytes(obj).decode()
+		kwargs.setdefault('separators', COMPACT_SEPARATORS)
+		return super().dumps(obj, **kwargs)
+
+	def response(self, *args, **kwargs) -> Response:
+		"""Serialize data as JSON into a response
+
+		Returns:
+			Response: The response
+		"""
+		obj = self._prepare_response_obj(args, kwargs)
+		return self._app.response_class(
+			self._dumps_bytes(obj) + b'\n',
+			mimetype=self.mimetype
+		)
+
+class ResponseStats:
+	"""The amount of responses and bytes per endpoint. The size of streamed
+	responses isn't known, so only the responses themselves are counted.
+	"""
+	def __init__(self):
+		self._endpoints: Dict[str, List[int]] = {}
+		self._lock = Lock()
+
+	def record(self, endpoint: str, size: int, sent: int) -> None:
+		"""Count a response
+
+		Args:
+			endpoint (str): The endpoint that gave the response
+			size (int): The size of the body before compression
+			sent (int): The size of the body that was sent
+		"""
+		with self._lock:
+			counts = self._endpoints.setdefault(endpoint, [0, 0, 0, 0])
+			counts[0] += 1
+			counts[1] += size
+			counts[2] += sent
+			counts[3] += size != sent
+		return
+
+	def stats(self) -> Dict[str, dict]:
+		"""Get the statistics per endpoint
+
+		Returns:
+			Dict[str, dict]: The amount of responses, bytes before compression, bytes sent and compressed responses of each endpoint
+		"""
+		with self._lock:
+			return {
+				endpoint: {
+					'responses': responses,
+					'bytes': size,
+					'bytes_sent': sent,
+					'compressed': compressed
+				}
+				for endpoint, (responses, size, sent, compressed)
+					in self._endpoints.items()
+			}
+
+response_stats = ResponseStats()
+
+def compress_response(response: Response) -> Response:
+	"""Compress the body of a response if the client accepts it and it's big
+	enough, and count the bytes. Used as after_request function.
+
+	Args:
+		response (Response): The response
+
+	Returns:
+		Response: The (compressed) response
+	"""
+	endpoint = request.endpoint or 'other'
+	if response.is_streamed or response.direct_passthrough:
+		response_stats.record(endpoint, 0, 0)
+		return response
+
+	data = response.get_data()
+	encoding = request.accept_encodings.best_match(ENCODERS)
+	if (
+		encoding is None
+		or len(data) < COMPRESS_MIN_SIZE
+		or 'Content-Encoding' in response.headers
+		or not (
+			response.mimetype in COMPRESSIBLE_MIMETYPES
+			or response.mimetype.startswith('text/')
+		)
+	):
+		response_stats.record(endpoint, len(data), len(data))
+		return response
+
+	compressed = ENCODERS[encoding](data)
+	response.set_data(compressed)
+	response.headers['Content-Encoding'] = encoding
+	response.vary.add('Accept-Encoding')
+	# the compressed body is another representation of the same resource
+	etag, weak = response.get_etag()
+	if etag is not None and not weak:
+		response.set_etag(etag, weak=True)
+	response_stats.record(endpoint, len(data), len(compressed))
+	return response
@@ -21,6 +21,9 @@ function login() {
 		var el = document.getElementById('password-error');
 		el.classList.add('hidden');
 		el.setAttribute('aria-hidden','true');
+		var el = document.getElementById('rate-error');
+		el.classList.add('hidden');
+		el.setAttribute('aria-hidden','true');
 
 		return response.json();
 	})
@@ -48,7 +51,16 @@ function login() {
 			var el = document.getElementById('username-error');
 			el.classList.add('hidden');
 			el.setAttribute('aria-hidden','true');
+		} else if (e === 429) {
+			// Too many attempts
+			var el = document.getElementById('rate-error');
+			el.classList.remove('hidden');
+			el.setAttribute('aria-hidden','false');
+			return;
 		};
+		var el = document.getElementById('rate-error');
+		el.classList.add('hidden');
+		el.setAttribute('aria-hidden','true');
 	});
 };
 
@@ -42,21 +42,56 @@ function logout() {
 	});
 };
 
+// Fetching from vault
+const maxCached = 50;
+const vaultCache = new Map();
+
+function fetchCached(url) {
+	// revalidate earlier responses with their ETag instead of downloading them again
+	const cached = vaultCache.get(url);
+	const headers = cached === undefined ? {} : {'If-None-Match': cached.etag};
+	return fetch(url, {'headers': headers, 'cache': 'no-store'})
+	.then(response => {
+		if (response.status === 304 && cached !== undefined) {
+			return cached.json;
+		};
+		// catch errors
+		if (!response.ok) {
+			return Promise.reject(response.status);
+		};
+		return response.json().then(json => {
+			const etag = response.headers.get('ETag');
+			vaultCache.delete(url);
+			if (etag !== null) {
+				vaultCache.set(url, {'etag': etag, 'json': json});
+				if (vaultCache.size > maxCached) {
+					vaultCache.delete(vaultCache.keys().next().value);
+				};
+			};
+			return json;
+		});
+	});
+};
+
 // Filling vault
-function buildVault(data) {
-	const el = document.getElementById('no-password-message');
-	if (data.length === 0) {
-		// show 'vault empty' message
-		el.classList.remove('hidden');
-		el.setAttribute('aria-hidden','false');
-	} else {
-		// hide 'vault empty' message
-		el.classList.add('hidden');
-		el.setAttribute('aria-hidden','true');
-	};
+const pageSize = 100;
+let vaultRequest = 0;
 
+function buildVault(data, append=false) {
 	const table = document.getElementById('vault');
-	table.innerHTML = '';
+	if (!append) {
+		const el = document.getElementById('no-password-message');
+		if (data.length === 0) {
+			// show 'vault empty' message
+			el.classList.remove('hidden');
+			el.setAttribute('aria-hidden','false');
+		} else {
+			// hide 'vault empty' message
+			el.classList.add('hidden');
+			el.setAttribute('aria-hidden','true');
+		};
+		table.innerHTML = '';
+	};
 	for (i=0; i<data.length; i++) {
 		const obj = data[i];
 
@@ -76,18 +111,25 @@ function buildVault(data) {
 	};
 };
 
-function fetchVault() {
+function fetchVault(cursor=null, request=null) {
+	// a newer fetch supersedes the pages of an older one
+	if (request === null) {
+		request = ++vaultRequest;
+	};
 	const order = document.getElementById('sort-selection').value;
-	fetch(`/api/vault?api_key=${sessionStorage.getItem('api_key')}&sort_by=${order}`)
-	.then(response => {
-		// catch errors
-		if (!response.ok) {
-			return Promise.reject(response.status);
-		};
-		return response.json();
-	})
+	let url = `/api/vault?api_key=${sessionStorage.getItem('api_key')}&sort_by=${order}&limit=${pageSize}`;
+	if (cursor !== null) {
+		url += `&cursor=${encodeURIComponent(cursor)}`;
+	};
+	fetchCached(url)
 	.then(json => {
-		buildVault(json.result);
+		if (request !== vaultRequest) {
+			return;
+		};
+		buildVault(json.result.entries, cursor !== null);
+		if (json.result.next_cursor !== null) {
+			fetchVault(json.result.next_cursor, request);
+		};
 	})
 	.catch(e => {
 		if (e === 401) {
@@ -152,16 +194,9 @@ function toggleSearch() {
 
 function search() {
 	const query = document.getElementById('search-input').value;
-	fetch(`/api/vault/search?query=${query}&api_key=${sessionStorage.getItem('api_key')}`)
-	.then(response => {
-		// catch errors
-		if (!response.ok) {
-			return Promise.reject(response.status);
-		};
-
-		return response.json();
-	})
+	fetchCached(`/api/vault/search?query=${query}&api_key=${sessionStorage.getItem('api_key')}`)
 	.then(json => {
+		vaultRequest++;
 		buildVault(json.result);
 		toggleSearch();
 	})
@@ -189,14 +224,7 @@ function showView(id) {
 	document.getElementById('view-window').classList.remove('hidden');
 	
 	// fill values
-	fetch(`/api/vault/${id}?api_key=${sessionStorage.getItem('api_key')}`)
-	.then(response => {
-		// catch errors
-		if (!response.ok) {
-			return Promise.reject(response.status);
-		};
-		return response.json();
-	})
+	fetchCached(`/api/vault/${id}?api_key=${sessionStorage.getItem('api_key')}`)
 	.then(json => {
 		document.getElementById('view-title-input').value = json.result.title;
 		document.getElementById('view-url-input').value = json.result.url;
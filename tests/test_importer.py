@@ -0,0 +1,48 @@
+#-*- coding: utf-8 -*-
+
+from io import BytesIO
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from backend import importer
+from backend.custom_exceptions import ImportInvalid
+from backend.importer import parse_json
+
+def _parse(document: str) -> list:
+	return list(parse_json(BytesIO(document.encode())))
+
+class TestParseJson(TestCase):
+	def test_read_sizes(self):
+		"""Values split over reads, like numbers, are parsed the same for every read size"""
+		document = '{"x": 1.5e10, "flag": true, "n": null, "items": [{"name": "a", "password": "p", "v": -0.25E+3}]}'
+		expected = [{'title': 'a', 'url': None, 'username': None, 'password': 'p'}]
+		for read_size in range(1, 16):
+			with self.subTest(read_size=read_size), patch.object(importer, 'READ_SIZE', read_size):
+				self.assertEqual(_parse(document), expected)
+
+	def test_list(self):
+		for read_size in (1, 2, 65_536):
+			with self.subTest(read_size=read_size), patch.object(importer, 'READ_SIZE', read_size):
+				self.assertEqual(
+					[e['title'] for e in _parse(' [{"title": "a"}, {"title": 12}] ')],
+					['a', '12']
+				)
+
+	def test_invalid(self):
+		for document in (
+			'[{"title": "a"}] trailing',
+			'{"items": [{"title": "a"}]} trailing',
+			'{"items": [1, 2],}',
+			'[{"title": "a"},]',
+			'{"items": [1 2]}',
+			'{"items": [1.5x]}',
+			'{"other": 1}',
+			'{"items": [1]'
+		):
+			for read_size in (1, 3, 65_536):
+				with self.subTest(document=document, read_size=read_size), patch.object(importer, 'READ_SIZE', read_size):
+					with self.assertRaises(ImportInvalid):
+						_parse(document)
+
+if __name__ == '__main__':
+	main()